@@ -2,6 +2,7 @@ from sqlalchemy import and_, or_, desc, asc, func, bindparam
 from sqlalchemy.orm import subqueryload, contains_eager
 from inbox.api.err import InputError
 from inbox.api.validation import valid_public_id
+from inbox.api.pagination import Sort
 from inbox.models import (Contact, Event, Calendar, Message,
                           MessageContactAssociation, Thread,
                           Block, Part, MessageCategory, Category,
@@ -11,6 +12,9 @@ from inbox.sqlalchemy_ext.util import bakery
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope_by_shard_id
 
+MESSAGE_SORT = Sort(Message, Message.received_date, ascending=False)
+EVENT_SORT = Sort(Event, Event.start, ascending=True)
+
 
 def contact_subquery(db_session, namespace_id, email_address, field):
     return db_session.query(Message.thread_id) \
@@ -26,7 +30,8 @@ def contact_subquery(db_session, namespace_id, email_address, field):
 def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
             any_email, thread_public_id, started_before, started_after,
             last_message_before, last_message_after, filename, in_, unread,
-            starred, limit, offset, view, db_session, sort_field='recentdate', sort_order='desc'):
+            starred, limit, offset, view, db_session, sort_field='recentdate', sort_order='desc',
+            page_token=None):
 
     if view == 'count':
         query = db_session.query(func.count(Thread.id))
@@ -129,20 +134,12 @@ def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
         expand = (view == 'expanded')
         query = query.options(*Thread.api_loading_options(expand))
 
-    #Sort by field and direction
-    sort_field = sort_field.lower() if sort_field is not None else None
-    sort_order = sort_order.lower() if sort_order is not None else None
-    db_sort_field = Thread.recentdate
-    db_sort_order = desc
+    sort = thread_sort(sort_field, sort_order)
+    if page_token is not None:
+        sort.validate(page_token)
+        query = query.filter(sort.after(page_token.value, page_token.id))
 
-    sort_field_mapping = {'subject': Thread.subject, 'date': Thread.recentdate, 'start_date': Thread.subjectdate}
-    if sort_field in sort_field_mapping:
-        db_sort_field = sort_field_mapping[sort_field]
-
-    if sort_order == 'asc':
-        db_sort_order = asc
-
-    query = query.order_by(db_sort_order(db_sort_field)).limit(limit)
+    query = query.order_by(*sort.order_by()).limit(limit)
 
     if offset:
         query = query.offset(offset)
@@ -153,12 +150,26 @@ def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
     return query.all()
 
 
+def thread_sort(sort_field=None, sort_order=None):
+    """The Sort for the /threads endpoint's sort_field and sort_order."""
+    #Sort by field and direction
+    sort_field = sort_field.lower() if sort_field is not None else None
+    sort_order = sort_order.lower() if sort_order is not None else None
+    db_sort_field = Thread.recentdate
+
+    sort_field_mapping = {'subject': Thread.subject, 'date': Thread.recentdate, 'start_date': Thread.subjectdate}
+    if sort_field in sort_field_mapping:
+        db_sort_field = sort_field_mapping[sort_field]
+
+    return Sort(Thread, db_sort_field, ascending=(sort_order == 'asc'))
+
+
 def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
                        cc_addr, bcc_addr, any_email, thread_public_id,
                        started_before, started_after, last_message_before,
                        last_message_after, received_before, received_after,
                        filename, in_, unread, starred, limit, offset, view,
-                       db_session):
+                       db_session, page_token=None):
     # Warning: complexities ahead. This function sets up the query that gets
     # results for the /messages API. It loads from several tables, supports a
     # variety of views and filters, and is performance-critical for the API. As
@@ -194,6 +205,10 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         'limit': limit,
         'offset': offset
     }
+    if page_token is not None:
+        MESSAGE_SORT.validate(page_token)
+        param_dict['page_token_value'] = page_token.value
+        param_dict['page_token_id'] = page_token.id
 
     if view == 'count':
         query = bakery(lambda s: s.query(func.count(Message.id)))
@@ -349,7 +364,13 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         return {"count": res}
 
 
-    query += lambda q: q.order_by(desc(Message.received_date))
+    if page_token is not None:
+        # received_date isn't nullable, so the filter's shape doesn't depend
+        # on the token.
+        query += lambda q: q.filter(MESSAGE_SORT.after(
+            bindparam('page_token_value'), bindparam('page_token_id')))
+
+    query += lambda q: q.order_by(*MESSAGE_SORT.order_by())
     query += lambda q: q.limit(bindparam('limit'))
     if offset:
         query += lambda q: q.offset(bindparam('offset'))
@@ -494,7 +515,15 @@ def recurring_events(filters, starts_before, starts_after, ends_before,
 def events(namespace_id, event_public_id, calendar_public_id, title,
            description, location, busy, starts_before, starts_after,
            ends_before, ends_after, limit, offset, view,
-           expand_recurring, show_cancelled, db_session):
+           expand_recurring, show_cancelled, db_session, page_token=None):
+
+    if page_token is not None:
+        if expand_recurring:
+            # Recurring events are expanded in memory, so there's nothing to
+            # seek through.
+            raise InputError("page_token can't be used with "
+                             "expand_recurring. Use offset instead.")
+        EVENT_SORT.validate(page_token)
 
     query = db_session.query(Event)
 
@@ -558,7 +587,10 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
     else:
         if view == 'count':
             return {"count": query.one()[0]}
-        query = query.order_by(asc(Event.start)).limit(limit)
+        if page_token is not None:
+            query = query.filter(EVENT_SORT.after(page_token.value,
+                                                  page_token.id))
+        query = query.order_by(*EVENT_SORT.order_by()).limit(limit)
         if offset:
             query = query.offset(offset)
         # Eager-load some objects in order to make constructing API
@@ -571,7 +603,15 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
         return all_events
 
 
-def messages_for_contact_scores(db_session, namespace_id, starts_after=None):
+def messages_for_contact_scores(db_session, namespace_id, starts_after=None,
+                                message_ids=None, after_id=None, max_id=None,
+                                limit=None):
+    """
+    The sent messages to score the namespace's contacts with. The messages
+    can be restricted to the ones with the given ids, or paged through in
+    order of id with `after_id` and `limit`.
+
+    """
     query = (db_session.query(
         Message.to_addr, Message.cc_addr, Message.bcc_addr,
         Message.id, Message.received_date.label('date'))
@@ -584,6 +624,14 @@ def messages_for_contact_scores(db_session, namespace_id, starts_after=None):
 
     if starts_after:
         query = query.filter(Message.received_date > starts_after)
+    if message_ids is not None:
+        query = query.filter(Message.id.in_(message_ids))
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+    if max_id is not None:
+        query = query.filter(Message.id <= max_id)
+    if limit is not None:
+        query = query.order_by(Message.id).limit(limit)
 
     return query.all()
 
@@ -0,0 +1,125 @@
+"""
+A process-local cache of API access tokens to the namespaces they belong to.
+
+An access token is a namespace's public id, which could be on any shard, so
+resolving one without the cache means querying every shard. Entries expire
+after API_TOKEN_CACHE_TTL seconds, and once we know which shard a token's
+namespace is on, we look for it there first when its entry expires.
+
+Tokens that don't belong to any namespace are cached too, for
+API_TOKEN_CACHE_NEGATIVE_TTL seconds and separately from valid ones, so that
+requests with bad tokens can't evict the entries of good ones.
+
+Entries are invalidated when their account is deleted through the API, and
+when the namespace turns out to be gone. Other processes' changes are picked
+up when entries expire.
+
+"""
+import time
+from collections import namedtuple, OrderedDict
+
+from inbox.config import config
+from inbox.ignition import engine_manager
+from inbox.models import Namespace
+from inbox.models.session import global_session_scope, session_scope_by_shard_id
+from inbox.util.stats import statsd_client
+
+TTL = config.get('API_TOKEN_CACHE_TTL', 60)
+NEGATIVE_TTL = config.get('API_TOKEN_CACHE_NEGATIVE_TTL', 10)
+MAX_SIZE = config.get('API_TOKEN_CACHE_SIZE', 10000)
+
+CachedNamespace = namedtuple('CachedNamespace',
+                             ['namespace_id', 'account_id', 'shard_id'])
+
+_cache = None
+
+
+def get_namespace_cache():
+    global _cache
+    if _cache is None:
+        _cache = NamespaceCache(MAX_SIZE, TTL, NEGATIVE_TTL)
+    return _cache
+
+
+class NamespaceCache(object):
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._namespaces = _LRU(max_size)
+        self._unknown = _LRU(max_size)
+
+    def resolve(self, public_id):
+        """
+        Return the CachedNamespace for the namespace with the given public
+        id, or None if there isn't one.
+
+        """
+        now = time.time()
+        entry = self._namespaces.get(public_id)
+        if entry is not None and entry[0] > now:
+            statsd_client.incr('api.namespace_cache.hit')
+            return entry[1]
+        if entry is None:
+            unknown = self._unknown.get(public_id)
+            if unknown is not None and unknown > now:
+                statsd_client.incr('api.namespace_cache.hit')
+                return None
+
+        statsd_client.incr('api.namespace_cache.miss')
+        namespace = _lookup(public_id,
+                            entry[1].shard_id if entry is not None else None)
+        self.invalidate(public_id)
+        if namespace is None:
+            self._unknown.put(public_id, now + self.negative_ttl)
+        else:
+            self._namespaces.put(public_id, (now + self.ttl, namespace))
+        return namespace
+
+    def invalidate(self, public_id):
+        self._namespaces.pop(public_id)
+        self._unknown.pop(public_id)
+
+
+class _LRU(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        return self._items.pop(key, None)
+
+
+def _lookup(public_id, shard_id=None):
+    if shard_id is not None:
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            namespace = _query(db_session, public_id)
+        if namespace is not None:
+            return namespace
+    # We don't know which shard the namespace is on, so ask all of them.
+    with global_session_scope() as db_session:
+        return _query(db_session, public_id)
+
+
+def _query(db_session, public_id):
+    row = db_session.query(Namespace.id, Namespace.account_id). \
+        filter(Namespace.public_id == public_id).first()
+    if row is None:
+        return None
+    namespace_id, account_id = row
+    return CachedNamespace(namespace_id, account_id,
+                           engine_manager.shard_key_for_id(namespace_id))
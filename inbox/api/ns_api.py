@@ -30,6 +30,7 @@ from inbox.api.sending import (send_draft, send_raw_mime, send_draft_copy,
 from inbox.api.update import update_message, update_thread
 from inbox.api.kellogs import APIEncoder
 from inbox.api import filtering
+from inbox.api.namespace_cache import get_namespace_cache
 from inbox.api.validation import (valid_account, get_attachments, get_calendar,
                                   get_recipients, get_draft, valid_public_id,
                                   valid_event, valid_event_update, timestamp,
@@ -39,13 +40,14 @@ from inbox.api.validation import (valid_account, get_attachments, get_calendar,
                                   valid_delta_object_types, valid_display_name,
                                   noop_event_update, valid_category_type,
                                   comma_separated_email_list,
-                                  get_sending_draft)
+                                  get_sending_draft, page_token)
 from inbox.config import config
 from inbox.contacts.algorithms import (calculate_contact_scores,
                                        calculate_group_scores,
                                        calculate_group_counts, is_stale)
 import inbox.contacts.crud
-from inbox.contacts.search import ContactSearchClient
+from inbox.contacts.rankings import ContactScores
+from inbox.contacts.search import get_contact_search_client
 from inbox.sendmail.base import (create_message_from_json, update_draft,
                                  delete_draft, create_draft_from_mime,
                                  SendMailException)
@@ -56,6 +58,7 @@ from inbox.models.session import new_session, session_scope
 from inbox.models.util import delete_namespace
 from inbox.search.base import get_search_client, SearchBackendException, SearchStoreException
 from inbox.transactions import delta_sync
+from inbox.transactions.notifier import get_change_notifier
 from inbox.api.err import (err, APIException, NotFoundError, InputError,
                            AccountDoesNotExistError, log_exception)
 from inbox.events.ical import generate_rsvp, send_rsvp
@@ -147,6 +150,7 @@ def start():
     if not g.namespace:
         # The only way this can occur is if there used to be an account that
         # was deleted, but the API access cache entry has not been expired yet.
+        get_namespace_cache().invalidate(g.namespace_public_id)
         raise AccountDoesNotExistError()
 
     request.environ['log_context']['account_id'] = g.namespace.account_id
@@ -267,6 +271,7 @@ def account_delete():
         raise InputError('Account {} deletion failed.'.
                          format(account.email_address))
 
+    get_namespace_cache().invalidate(g.namespace.public_id)
     clear_heartbeat_status(g.namespace.account_id)
 
     return g.encoder.jsonify(None)
@@ -295,6 +300,7 @@ def thread_query_api():
     g.parser.add_argument('view', type=view, location='args')
     g.parser.add_argument('sort_field', type=bounded_str, location='args') #Nils: Field by which should be sorted
     g.parser.add_argument('sort_order', type=bounded_str, location='args') #Nils: asc/desc sort order
+    g.parser.add_argument('page_token', type=page_token, location='args')
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -320,12 +326,77 @@ def thread_query_api():
         view=args['view'],
         db_session=g.db_session,
         sort_field=args['sort_field'],
-        sort_order=args['sort_order'])
+        sort_order=args['sort_order'],
+        page_token=args['page_token'])
 
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id,
                          args['view'] == 'expanded')
-    return encoder.jsonify(threads)
+    return _paginated_response(
+        encoder, threads, filtering.thread_sort(args['sort_field'],
+                                                args['sort_order']),
+        args['limit'])
+
+
+def _paginated_response(encoder, results, sort, limit):
+    response = encoder.jsonify(results)
+    next_page_token = sort.next_page_token(results, limit, g.db_session,
+                                           g.namespace.id)
+    if next_page_token is not None:
+        response.headers['X-Next-Page-Token'] = next_page_token
+    return response
+
+
+def _blockstore_response(data_sha256, mimetype):
+    """
+    Stream the blockstore data with the given hash, rather than reading it all
+    into memory, answering conditional and Range requests. The ETag is the
+    data's hash. Returns None if the blockstore doesn't have the data.
+
+    """
+    etag = data_sha256
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    blob = blockstore.open_from_blockstore(data_sha256)
+    if blob is None:
+        return None
+
+    start, stop = 0, blob.size
+    status = 200
+    # We don't support multipart responses, so send all of the data for
+    # requests for several ranges. Likewise if the client's copy of the rest
+    # of the data is of a different version.
+    if request.range is not None and len(request.range.ranges) == 1 and \
+            request.headers.get('If-Range', etag).strip('"') == etag:
+        range_ = request.range.range_for_length(blob.size)
+        if range_ is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(blob.size)
+            return response
+        start, stop = range_
+        status = 206
+
+    response = Response(blob.stream(start, stop), status=status,
+                        mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, stop - 1, blob.size)
+    response.set_etag(etag)
+    return response
+
+
+def _search_response(search_client, results):
+    response = g.encoder.jsonify(results)
+    # Searches that had to give up on some of the account's folders say so.
+    # (Streaming searches end with a {"partial": true} line instead.)
+    if getattr(search_client, 'partial', False):
+        response.headers['X-Search-Partial'] = 'true'
+    return response
 
 
 @app.route('/threads/search', methods=['GET'])
@@ -342,7 +413,7 @@ def thread_search_api():
         results = search_client.search_threads(g.db_session, args['q'],
                                                offset=args['offset'],
                                                limit=args['limit'])
-        return g.encoder.jsonify(results)
+        return _search_response(search_client, results)
     except SearchBackendException as exc:
         kwargs = {}
         if exc.server_error:
@@ -460,7 +531,7 @@ def message_query_api():
     g.parser.add_argument('unread', type=strict_bool, location='args')
     g.parser.add_argument('starred', type=strict_bool, location='args')
     g.parser.add_argument('view', type=view, location='args')
-
+    g.parser.add_argument('page_token', type=page_token, location='args')
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -487,12 +558,14 @@ def message_query_api():
         limit=args['limit'],
         offset=args['offset'],
         view=args['view'],
-        db_session=g.db_session
+        db_session=g.db_session,
+        page_token=args['page_token']
     )
 
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id, args['view'] == 'expanded')
-    return encoder.jsonify(messages)
+    return _paginated_response(encoder, messages, filtering.MESSAGE_SORT,
+                               args['limit'])
 
 
 @app.route('/messages/search', methods=['GET'])
@@ -508,7 +581,7 @@ def message_search_api():
         results = search_client.search_messages(g.db_session, args['q'],
                                                 offset=args['offset'],
                                                 limit=args['limit'])
-        return g.encoder.jsonify(results)
+        return _search_response(search_client, results)
     except SearchBackendException as exc:
         kwargs = {}
         if exc.server_error:
@@ -563,9 +636,9 @@ def message_read_api(public_id):
         raise NotFoundError("Couldn't find message {0}".format(public_id))
 
     if request.headers.get('Accept', None) == 'message/rfc822':
-        raw_message = blockstore.get_from_blockstore(message.data_sha256)
-        if raw_message is not None:
-            return Response(raw_message, mimetype='message/rfc822')
+        response = _blockstore_response(message.data_sha256, 'message/rfc822')
+        if response is not None:
+            return response
         else:
             # Try getting the message from the email provider.
             account = g.namespace.account
@@ -889,7 +962,7 @@ def contact_search_api():
                       ' url parameter')
         raise InputError(err_string)
 
-    search_client = ContactSearchClient(g.namespace.id)
+    search_client = get_contact_search_client(g.namespace.id)
     results = search_client.search_contacts(g.db_session, args['q'],
                                             offset=args['offset'],
                                             limit=args['limit'])
@@ -925,6 +998,7 @@ def event_api():
     g.parser.add_argument('expand_recurring', type=strict_bool,
                           location='args')
     g.parser.add_argument('show_cancelled', type=strict_bool, location='args')
+    g.parser.add_argument('page_token', type=page_token, location='args')
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -945,9 +1019,14 @@ def event_api():
         view=args['view'],
         expand_recurring=args['expand_recurring'],
         show_cancelled=args['show_cancelled'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=args['page_token'])
 
-    return g.encoder.jsonify(results)
+    if args['expand_recurring']:
+        # Expanded recurring events can't be seeked to.
+        return g.encoder.jsonify(results)
+    return _paginated_response(g.encoder, results, filtering.EVENT_SORT,
+                               args['limit'])
 
 
 @app.route('/events/', methods=['POST'])
@@ -1355,15 +1434,20 @@ def file_download_api(public_id):
             # HACK just append the major part of the content type
             name = 'attachment.{0}'.format(ct.split('/')[0])
 
-    # TODO the part.data object should really behave like a stream we can read
-    # & write to
+    response = None
+    if f.size:
+        response = _blockstore_response(f.data_sha256,
+                                        'application/octet-stream')
     try:
-        account = g.namespace.account
-        statsd_string = 'api.direct_fetching.{}.{}'.format(account.provider,
-                                                           account.id)
+        if response is None:
+            # The data isn't in the blockstore (or is empty), so get it via
+            # the part's data, which fetches it from the provider if need be.
+            account = g.namespace.account
+            statsd_string = 'api.direct_fetching.{}.{}'.format(
+                account.provider, account.id)
 
-        response = make_response(f.data)
-        statsd_client.incr('{}.successes'.format(statsd_string))
+            response = make_response(f.data)
+            statsd_client.incr('{}.successes'.format(statsd_string))
 
     except TemporaryEmailFetchException:
         statsd_client.incr('{}.temporary_failure'.format(statsd_string))
@@ -1475,6 +1559,7 @@ def draft_query_api():
     g.parser.add_argument('unread', type=strict_bool, location='args')
     g.parser.add_argument('starred', type=strict_bool, location='args')
     g.parser.add_argument('view', type=view, location='args')
+    g.parser.add_argument('page_token', type=page_token, location='args')
 
     args = strict_parse_args(g.parser, request.args)
 
@@ -1501,9 +1586,11 @@ def draft_query_api():
         limit=args['limit'],
         offset=args['offset'],
         view=args['view'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=args['page_token'])
 
-    return g.encoder.jsonify(drafts)
+    return _paginated_response(g.encoder, drafts, filtering.MESSAGE_SORT,
+                               args['limit'])
 
 
 @app.route('/drafts/<public_id>', methods=['GET'])
@@ -1800,28 +1887,36 @@ def sync_deltas():
     g.db_session.close()  # hack to close the flask session
     poll_interval = LONG_POLL_POLL_INTERVAL
 
+    response = {
+        'cursor_start': cursor,
+        'deltas': [],
+    }
     start_time = time.time()
-    while time.time() - start_time < timeout:
-        with session_scope(g.namespace.id) as db_session:
-            deltas, _ = delta_sync.format_transactions_after_pointer(
-                g.namespace, start_pointer, db_session, args['limit'],
-                exclude_types, include_types, exclude_folders,
-                exclude_metadata, exclude_account, expand=expand)
-
-        response = {
-            'cursor_start': cursor,
-            'deltas': deltas,
-        }
-        if deltas:
-            response['cursor_end'] = deltas[-1]['cursor']
-            return g.encoder.jsonify(response)
-
-        # No changes. perhaps wait
-        elif '/delta/longpoll' in request.url_rule.rule:
-            gevent.sleep(poll_interval)
-        else:  # Return immediately
-            response['cursor_end'] = cursor
-            return g.encoder.jsonify(response)
+    with get_change_notifier().watch(g.namespace.id,
+                                     poll_interval) as watch:
+        while time.time() - start_time < timeout:
+            # Only query the transaction log if the namespace may have
+            # changed since we last did.
+            if watch.check():
+                with session_scope(g.namespace.id) as db_session:
+                    deltas, _ = delta_sync.format_transactions_after_pointer(
+                        g.namespace, start_pointer, db_session,
+                        args['limit'], exclude_types, include_types,
+                        exclude_folders, exclude_metadata, exclude_account,
+                        expand=expand)
+
+                response['deltas'] = deltas
+                if deltas:
+                    response['cursor_end'] = deltas[-1]['cursor']
+                    return g.encoder.jsonify(response)
+
+                # No changes. perhaps wait
+                elif '/delta/longpoll' not in request.url_rule.rule:
+                    # Return immediately
+                    response['cursor_end'] = cursor
+                    return g.encoder.jsonify(response)
+
+            watch.wait()
 
     # If nothing happens until timeout, just return the end of the cursor
     response['cursor_end'] = cursor
@@ -1951,6 +2046,12 @@ def groups_intrinsic():
     except NoResultFound:
         dpcache = DataProcessingCache(namespace_id=g.namespace.id)
 
+    if dpcache.contact_scores_backfilled and not args['force_recalculate']:
+        # Kept up to date by the contact rankings service.
+        result = ContactScores(dpcache.contact_scores).group_scores()
+        result = sorted(result.items(), key=lambda x: x[1], reverse=True)
+        return g.encoder.jsonify(result)
+
     last_updated = dpcache.contact_groups_last_updated
     cached_data = dpcache.contact_groups
 
@@ -1994,6 +2095,12 @@ def contact_rankings():
     except NoResultFound:
         dpcache = DataProcessingCache(namespace_id=g.namespace.id)
 
+    if dpcache.contact_scores_backfilled and not args['force_recalculate']:
+        # Kept up to date by the contact rankings service.
+        result = ContactScores(dpcache.contact_scores).rankings()
+        result = sorted(result.items(), key=lambda x: x[1], reverse=True)
+        return g.encoder.jsonify(result)
+
     last_updated = dpcache.contact_rankings_last_updated
     cached_data = dpcache.contact_rankings
 
@@ -0,0 +1,114 @@
+"""
+Keyset pagination for the list endpoints.
+
+Paging with OFFSET makes the database read and throw away every row before
+the page, so deep pages of a large mailbox get slower and slower. Instead,
+list endpoints return an X-Next-Page-Token header holding the sort key and id
+of the last object of the page, and given that token as the `page_token`
+parameter, seek straight to where the previous page left off.
+
+Tokens are opaque to clients, and are only valid for the sort order of the
+request they came from.
+
+"""
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import namedtuple
+from datetime import datetime
+
+import arrow
+from sqlalchemy import and_, or_, asc, desc
+
+from inbox.api.err import InputError
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+PageToken = namedtuple('PageToken', ['sort', 'value', 'id'])
+
+
+def encode_page_token(sort, value, id_):
+    if isinstance(value, arrow.Arrow):
+        value = value.to('utc').naive
+    if isinstance(value, datetime):
+        value = {'datetime': value.strftime(_DATETIME_FORMAT)}
+    data = json.dumps([sort, value, id_], separators=(',', ':'))
+    return urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_page_token(token):
+    """Decode a page token, raising a ValueError if it's not valid."""
+    try:
+        token = str(token)
+        data = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort, value, id_ = json.loads(data)
+        if isinstance(value, dict):
+            value = datetime.strptime(value['datetime'], _DATETIME_FORMAT)
+        if not isinstance(id_, (int, long)):
+            raise ValueError
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise ValueError('Invalid page token.')
+    return PageToken(sort, value, id_)
+
+
+class Sort(object):
+    """
+    The order of a list endpoint's results: by `column`, then by id to break
+    ties, so that every object has a distinct position to seek to.
+
+    """
+
+    def __init__(self, model, column, ascending):
+        self.model = model
+        self.column = column
+        self.ascending = ascending
+        self.nullable = column.property.columns[0].nullable
+        self.key = '{}:{}'.format(column.key, 'asc' if ascending else 'desc')
+
+    def order_by(self):
+        direction = asc if self.ascending else desc
+        return direction(self.column), direction(self.model.id)
+
+    def validate(self, page_token):
+        if page_token.sort != self.key:
+            raise InputError('page_token is for a different sort order.')
+
+    def after(self, value, id_):
+        """
+        A filter for the objects that come after the one with the given sort
+        key and id. The shape of the filter depends on whether `value` is
+        NULL, so only pass bind parameters for non-nullable columns.
+
+        """
+        column, id_column = self.column, self.model.id
+        # MySQL sorts NULLs before every other value.
+        if value is None:
+            if self.ascending:
+                return or_(column.isnot(None),
+                           and_(column.is_(None), id_column > id_))
+            return and_(column.is_(None), id_column < id_)
+        if self.ascending:
+            after = or_(column > value,
+                        and_(column == value, id_column > id_))
+        else:
+            after = or_(column < value,
+                        and_(column == value, id_column < id_))
+            if self.nullable:
+                after = or_(after, column.is_(None))
+        return after
+
+    def next_page_token(self, results, limit, db_session, namespace_id):
+        """
+        The page token for the page after `results`, or None if this was the
+        last page. `results` may be objects, or their public ids.
+
+        """
+        if not limit or not isinstance(results, list) or \
+                len(results) < limit:
+            return None
+        last = results[-1]
+        if isinstance(last, basestring):
+            last = db_session.query(self.model).filter(
+                self.model.namespace_id == namespace_id,
+                self.model.public_id == last).one()
+        return encode_page_token(self.key, getattr(last, self.column.key),
+                                 last.id)
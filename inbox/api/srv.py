@@ -2,12 +2,12 @@ from __future__ import print_function
 from flask import Flask, request, jsonify, make_response, g
 from flask.ext.restful import reqparse
 from werkzeug.exceptions import default_exceptions, HTTPException
-from sqlalchemy.orm.exc import NoResultFound
 import hashlib
 import uuid
 import os
 
 from inbox.api.kellogs import APIEncoder
+from inbox.api.namespace_cache import get_namespace_cache
 from nylas.logging import get_logger
 from inbox.models import Namespace, Account
 from inbox.models.session import global_session_scope
@@ -89,18 +89,16 @@ def auth_user(request):
     else:
         namespace_public_id = request.authorization.username
 
-    with global_session_scope() as db_session:
-        try:
-            valid_public_id(namespace_public_id)
-            namespace = db_session.query(Namespace) \
-                .filter(Namespace.public_id == namespace_public_id).one()
-            g.namespace_id = namespace.id
-            g.account_id = namespace.account.id
-        except NoResultFound:
-            return make_response((
-                "Could not verify access credential.", 401,
-                {'WWW-Authenticate': 'Basic realm="API '
-                 'Access Token Required"'}))
+    valid_public_id(namespace_public_id)
+    namespace = get_namespace_cache().resolve(namespace_public_id)
+    if namespace is None:
+        return make_response((
+            "Could not verify access credential.", 401,
+            {'WWW-Authenticate': 'Basic realm="API '
+             'Access Token Required"'}))
+    g.namespace_public_id = namespace_public_id
+    g.namespace_id = namespace.namespace_id
+    g.account_id = namespace.account_id
 
 
 def auth_admin(request):
@@ -1,4 +1,5 @@
 import datetime
+import heapq
 from collections import defaultdict
 
 '''
@@ -16,8 +17,10 @@ MIN_MESSAGE_COUNT = 2.5  # Might want to tune this param. (1.5, 2.5?)
 SELF_IDENTITY_THRESHOLD = 0.3  # Also tunable
 JACCARD_THRESHOLD = .35  # probably shouldn't tune this
 
-SOCIAL_MOLECULE_EXPANSION_LIMIT = 1000  # Don't add too many molecules!
-SOCIAL_MOLECULE_LIMIT = 5000  # Give up if there are too many messages
+# Only expand the heaviest molecules; don't add too many molecules!
+SOCIAL_MOLECULE_EXPANSION_LIMIT = 1000
+# Only consider the heaviest molecules if there are too many messages
+SOCIAL_MOLECULE_LIMIT = 5000
 
 
 ##
@@ -96,27 +99,52 @@ def calculate_group_scores(messages, user_email):
         date - datetime.datetime object
     """
     now = datetime.datetime.now()
-    message_ids_to_scores = {}
-    molecules_dict = defaultdict(set)  # (emails, ...) -> {message ids, ...}
-
-    def get_message_list_weight(message_ids):
-        return sum([message_ids_to_scores[m_id] for m_id in message_ids])
+    # (emails, ...) -> total weight of the messages sent to them
+    participant_weights = defaultdict(float)
 
     # Gather initial candidate social molecules
     for msg in messages:
         participants = _get_participants(msg, [user_email])
         if len(participants) >= MIN_GROUP_SIZE:
-            molecules_dict[tuple(participants)].add(msg.id)
-            message_ids_to_scores[msg.id] = \
+            participant_weights[tuple(participants)] += \
                 _get_message_weight(now, msg.date)
 
-    if len(molecules_dict) > SOCIAL_MOLECULE_LIMIT:
-        return {}  # Not worth the calculation
+    # Give a score to each group.
+    return {', '.join(sorted(g)): sum(participant_weights[p] for p in m)
+            for (g, m) in calculate_groups(participant_weights)}
+
+
+def calculate_groups(participant_weights):
+    """The groups found by calculate_group_scores(), given the total weight
+    of the messages sent to each list of participants.
+
+    participant_weights maps sorted tuples of email addresses to weights.
+    Returns a list of (emails, participant tuples) pairs: the email
+    addresses in each group, and the participant tuples whose messages
+    belong to it.
+    """
+    # Each message was sent to exactly one tuple of participants, so sets of
+    # those tuples stand in for sets of messages.
+    molecules_dict = defaultdict(set)  # (emails, ...) -> {participants, ...}
+
+    def get_message_list_weight(molecule):
+        return sum([participant_weights[p] for p in molecule])
+
+    if len(participant_weights) > SOCIAL_MOLECULE_LIMIT:
+        # Drop the lists of participants that were sent the least mail,
+        # rather than give up on the users who send the most.
+        heaviest = set(heapq.nlargest(SOCIAL_MOLECULE_LIMIT,
+                                      participant_weights,
+                                      key=participant_weights.get))
+    else:
+        heaviest = participant_weights
+
+    for participants in participant_weights:
+        if participants in heaviest:
+            molecules_dict[participants].add(participants)
 
     # Expand pool of social molecules by taking pairwise intersections.
-    # If there are already too many molecules, skip this step.
-    if len(molecules_dict) < SOCIAL_MOLECULE_EXPANSION_LIMIT:
-        _expand_molecule_pool(molecules_dict)
+    _expand_molecule_pool(molecules_dict, get_message_list_weight)
 
     # Filter out infrequent molecules
     molecules_list = [(set(emails), set(msgs))
@@ -127,35 +155,64 @@ def calculate_group_scores(messages, user_email):
     molecules_list = _subsume_molecules(
         molecules_list, get_message_list_weight)
 
-    molecules_list = _combine_similar_molecules(molecules_list)
-
-    # Give a score to each group.
-    return {', '.join(sorted(g)): get_message_list_weight(m)
-            for (g, m) in molecules_list}
+    return _combine_similar_molecules(molecules_list)
 
 
 # Helper functions for calculating group scores
-def _expand_molecule_pool(molecules_dict):
+def _index_molecules(molecules):
+    """Map each email address to the (ascending) indexes of the molecules
+    with that address. Molecules that share addresses are found through
+    this index rather than by comparing every pair of molecules.
+    """
+    index = defaultdict(list)
+    for i, (g, _) in enumerate(molecules):
+        for email in g:
+            index[email].append(i)
+    return index
+
+
+def _expand_molecule_pool(molecules_dict, get_message_list_weight):
     mditems = [(set(g), msgs) for (g, msgs) in molecules_dict.items()]
+    if len(mditems) >= SOCIAL_MOLECULE_EXPANSION_LIMIT:
+        heaviest = set(heapq.nlargest(
+            SOCIAL_MOLECULE_EXPANSION_LIMIT, xrange(len(mditems)),
+            key=lambda i: get_message_list_weight(mditems[i][1])))
+        mditems = [item for (i, item) in enumerate(mditems)
+                   if i in heaviest]
+    index = _index_molecules(mditems)
     for i in xrange(len(mditems)):
         g1, m1 = mditems[i]
-        for j in xrange(i, len(mditems)):
+        # Count how many addresses each later molecule shares with this
+        # one; the others' intersections with it are too small.
+        shared = defaultdict(int)
+        for email in g1:
+            for j in index[email]:
+                if j > i:
+                    shared[j] += 1
+        for j in sorted(shared):
+            if shared[j] < MIN_GROUP_SIZE:
+                continue
             g2, m2 = mditems[j]
             new_molecule = tuple(sorted(list(g1.intersection(g2))))
-            if len(new_molecule) >= MIN_GROUP_SIZE:
-                molecules_dict[new_molecule] = \
-                    molecules_dict[new_molecule].union(m1).union(m2)
+            molecules_dict[new_molecule] = \
+                molecules_dict[new_molecule].union(m1).union(m2)
 
 
 def _subsume_molecules(molecules_list, get_message_list_weight):
     molecules_list.sort(key=lambda x: len(x[0]), reverse=True)
     is_subsumed = [False] * len(molecules_list)
     mol_weights = [get_message_list_weight(m) for (_, m) in molecules_list]
+    index = _index_molecules(molecules_list)
 
     for i in xrange(1, len(molecules_list)):
         g1, m1 = molecules_list[i]  # Smaller group
         m1_size = mol_weights[i]
-        for j in xrange(i):
+        # Only molecules with all of g1's addresses can be supersets of it,
+        # so only look at the ones with its least common address.
+        candidates = min((index[email] for email in g1), key=len)
+        for j in candidates:
+            if j >= i:
+                break
             if is_subsumed[j]:
                 continue
             g2, m2 = molecules_list[j]  # Bigger group
@@ -176,8 +233,12 @@ def _combine_similar_molecules(molecules_list):
     while new_guys_start_idx < len(molecules_list):
         combined = [False] * len(molecules_list)
         new_guys = []
+        index = _index_molecules(molecules_list)
         for j in xrange(new_guys_start_idx, len(molecules_list)):
-            for i in xrange(0, j):
+            # Only molecules that share an address can be similar.
+            candidates = sorted(set(i for email in molecules_list[j][0]
+                                    for i in index[email] if i < j))
+            for i in candidates:
                 if combined[i]:
                     continue
                 (g1, m1), (g2, m2) = molecules_list[i], molecules_list[j]
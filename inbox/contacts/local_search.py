@@ -0,0 +1,312 @@
+"""
+A local contact search index, as an alternative to CloudSearch.
+
+With CONTACT_SEARCH_BACKEND set to 'local', the ContactSearchIndexService
+(see inbox.transactions.search) keeps an SQLite FTS5 index of each shard's
+contacts' names, email addresses and digits-only phone numbers up to date
+from the transaction log, instead of uploading them to CloudSearch, and
+/contacts/search answers typeahead queries from it without a round trip.
+
+Every term of a query matches as a prefix (the index keeps prefixes of up to
+three characters, so that short ones are fast too), and results are ranked by
+the namespace's contact rankings (see inbox.contacts.rankings), which the
+service copies into the index every CONTACT_SCORES_REFRESH_INTERVAL seconds.
+
+The index is stored in CONTACT_SEARCH_INDEX_DIRECTORY, as one database per
+shard, and has to be shared by the indexing service and the API.
+
+"""
+import calendar
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+
+from sqlalchemy.orm import joinedload
+
+from inbox.config import config
+from inbox.contacts.search import cloudsearch_contact_repr
+from inbox.ignition import engine_manager
+from inbox.models import Contact
+from inbox.models.session import session_scope
+from inbox.sqlalchemy_ext.util import safer_yield_per
+from nylas.logging import get_logger
+log = get_logger()
+
+# How often to copy a namespace's contact rankings into the index, at most.
+SCORES_REFRESH_INTERVAL = config.get('CONTACT_SCORES_REFRESH_INTERVAL', 3600)
+
+_COLUMNS = ['namespace', 'name', 'email_address', 'phone_numbers', 'address']
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS contacts USING fts5(
+    namespace, name, email_address, phone_numbers, address UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 1', prefix = '1 2 3');
+CREATE TABLE IF NOT EXISTS scores (
+    namespace_id INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (namespace_id, address));
+CREATE TABLE IF NOT EXISTS namespaces (
+    namespace_id INTEGER PRIMARY KEY,
+    scores_updated_at REAL NOT NULL,
+    scores_copied_at REAL NOT NULL);
+"""
+
+# Queries that only consist of these are taken to be phone numbers.
+_PHONE_NUMBER_RE = re.compile(r'^[0-9+().\s-]*[0-9][0-9+().\s-]*$')
+
+_indexes = {}
+
+
+def local_contact_index_enabled():
+    return config.get('CONTACT_SEARCH_BACKEND') == 'local'
+
+
+def get_local_contact_index(shard_id):
+    """
+    Return the LocalContactIndex for the given shard, or None if the index
+    directory isn't configured.
+
+    """
+    directory = config.get('CONTACT_SEARCH_INDEX_DIRECTORY')
+    if not directory:
+        return None
+    index = _indexes.get(shard_id)
+    if index is None:
+        path = os.path.join(directory, 'contacts_shard_{}.db'.format(shard_id))
+        index = _indexes[shard_id] = LocalContactIndex(path)
+    return index
+
+
+class LocalContactSearchClient(object):
+    """ Search client that uses the shard's LocalContactIndex. """
+
+    def __init__(self, namespace_id):
+        self.namespace_id = namespace_id
+
+    def search_contacts(self, db_session, search_query, offset=0, limit=40):
+        index = get_local_contact_index(
+            engine_manager.shard_key_for_id(self.namespace_id))
+        if index is None:
+            log.warning('local contact index not configured; '
+                        'returning no results')
+            return []
+        result_ids = index.search_contacts(self.namespace_id, search_query,
+                                           offset, limit)
+        if not result_ids:
+            return []
+        contacts = {contact.id: contact for contact in db_session.query(
+            Contact).filter(Contact.namespace_id == self.namespace_id,
+                            Contact.id.in_(result_ids)).options(
+                joinedload('phone_numbers'))}
+        return [contacts[id_] for id_ in result_ids if id_ in contacts]
+
+
+class LocalContactIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # Let the API read while the indexing service writes.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def index_contacts(self, contacts):
+        """
+        Add the given contacts to the index, or update them if they're
+        already there.
+
+        """
+        with self.conn:
+            for contact in contacts:
+                self.conn.execute('DELETE FROM contacts WHERE rowid = ?',
+                                  (contact.id,))
+                document = contact_document(contact)
+                self.conn.execute(
+                    'INSERT INTO contacts (rowid, {}) VALUES (?, {})'.format(
+                        ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+                    [contact.id] + [document[c] for c in _COLUMNS])
+
+    def delete_contacts(self, contact_ids):
+        with self.conn:
+            self.conn.executemany('DELETE FROM contacts WHERE rowid = ?',
+                                  [(id_,) for id_ in contact_ids])
+
+    def delete_namespace(self, namespace_id):
+        with self.conn:
+            self.conn.execute('DELETE FROM contacts WHERE contacts MATCH ?',
+                              (u'namespace:{}'.format(
+                                  _namespace_token(namespace_id)),))
+            self.conn.execute('DELETE FROM scores WHERE namespace_id = ?',
+                              (namespace_id,))
+            self.conn.execute('DELETE FROM namespaces WHERE namespace_id = ?',
+                              (namespace_id,))
+
+    def contact_ids(self, namespace_id):
+        with closing(self.conn.execute(
+                'SELECT rowid FROM contacts WHERE contacts MATCH ?',
+                (u'namespace:{}'.format(_namespace_token(namespace_id)),))) \
+                as cursor:
+            return {contact_id for contact_id, in cursor}
+
+    def search_contacts(self, namespace_id, search_query, offset=0,
+                        limit=40):
+        """
+        Return the ids of the namespace's contacts that match
+        `search_query`, highest ranked first.
+
+        """
+        match = _match_expression(namespace_id, search_query)
+        if match is None:
+            return []
+        with closing(self.conn.execute(
+                'SELECT contacts.rowid FROM contacts LEFT JOIN scores ON '
+                'scores.namespace_id = ? AND scores.address = contacts.address '
+                'WHERE contacts MATCH ? '
+                'ORDER BY coalesce(scores.score, 0) DESC, contacts.rank '
+                'LIMIT ? OFFSET ?',
+                (namespace_id, match, limit or -1, offset))) as cursor:
+            return [contact_id for contact_id, in cursor]
+
+    def scores_state(self):
+        """
+        Return when each namespace's scores were last updated, as returned
+        by _timestamp(), and when they were copied into the index, as
+        (updated_at, copied_at) tuples by namespace id.
+
+        """
+        with closing(self.conn.execute(
+                'SELECT namespace_id, scores_updated_at, scores_copied_at '
+                'FROM namespaces')) as cursor:
+            return {namespace_id: (updated_at, copied_at)
+                    for namespace_id, updated_at, copied_at in cursor}
+
+    def update_scores(self, namespace_id, scores, updated_at):
+        """
+        Replace the namespace's contact scores with `scores`, as returned by
+        ContactScores.rankings(), which were last updated at `updated_at`.
+
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM scores WHERE namespace_id = ?',
+                              (namespace_id,))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO scores (namespace_id, address, score) '
+                'VALUES (?, ?, ?)',
+                [(namespace_id, email.lower(), score)
+                 for email, score in scores.iteritems() if email])
+            self.conn.execute(
+                'INSERT OR REPLACE INTO namespaces '
+                '(namespace_id, scores_updated_at, scores_copied_at) '
+                'VALUES (?, ?, ?)',
+                (namespace_id, _timestamp(updated_at), time.time()))
+
+
+def scores_due(updated_at, index_state, now=None):
+    """
+    Whether scores last updated at `updated_at` should replace the ones in
+    the index, whose state is as returned by
+    LocalContactIndex.scores_state(): they have to be newer, and the last
+    copy has to be at least SCORES_REFRESH_INTERVAL seconds old.
+
+    """
+    if updated_at is None:
+        return False
+    if index_state is None:
+        return True
+    index_updated_at, copied_at = index_state
+    if _timestamp(updated_at) <= index_updated_at:
+        return False
+    if now is None:
+        now = time.time()
+    return now - copied_at >= SCORES_REFRESH_INTERVAL
+
+
+def contact_document(contact):
+    """The indexed representation of a contact."""
+    fields = cloudsearch_contact_repr(contact)
+    return {
+        'namespace': _namespace_token(contact.namespace_id),
+        'name': fields['name'],
+        'email_address': fields['email_address'],
+        'phone_numbers': u' '.join(fields['phone_numbers']),
+        'address': fields['email_address'].lower(),
+    }
+
+
+def index_namespace(namespace_id):
+    """
+    Backfill the local index with a namespace's contacts, and remove any
+    that have disappeared.
+
+    """
+    namespace_id = int(namespace_id)
+    index = get_local_contact_index(
+        engine_manager.shard_key_for_id(namespace_id))
+    if index is None:
+        raise Exception('CONTACT_SEARCH_INDEX_DIRECTORY not configured; '
+                        'cannot index')
+    previous_records = index.contact_ids(namespace_id)
+    current_records = set()
+    with session_scope(namespace_id) as db_session:
+        query = db_session.query(Contact).options(
+            joinedload('phone_numbers')).filter_by(namespace_id=namespace_id)
+        contacts = []
+        for contact in safer_yield_per(query, Contact.id, 0, 1000):
+            current_records.add(contact.id)
+            contacts.append(contact)
+            if len(contacts) >= 1000:
+                index.index_contacts(contacts)
+                contacts = []
+        index.index_contacts(contacts)
+    deleted_records = previous_records - current_records
+    index.delete_contacts(deleted_records)
+    log.info('namespace index complete', namespace_id=namespace_id,
+             total_contacts_indexed=len(current_records),
+             total_contacts_deleted=len(deleted_records))
+
+
+def delete_namespace_index(namespace_id):
+    namespace_id = int(namespace_id)
+    index = get_local_contact_index(
+        engine_manager.shard_key_for_id(namespace_id))
+    if index is None:
+        raise Exception('CONTACT_SEARCH_INDEX_DIRECTORY not configured; '
+                        'cannot update index')
+    index.delete_namespace(namespace_id)
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.timetuple())
+
+
+def _namespace_token(namespace_id):
+    return u'ns{}'.format(namespace_id)
+
+
+def _match_expression(namespace_id, search_query):
+    # Match every term of the query as a prefix of a word in the contact's
+    # name, email address or phone numbers. Terms are quoted, so that
+    # they're never interpreted as FTS5 query syntax.
+    if isinstance(search_query, str):
+        search_query = search_query.decode('utf-8', 'replace')
+    if _PHONE_NUMBER_RE.match(search_query):
+        # Phone numbers are indexed as digits only.
+        terms = [u''.join(ch for ch in search_query if ch.isdigit())]
+    else:
+        terms = search_query.split()
+    if not terms:
+        return None
+    return u'namespace:{} AND {{name email_address phone_numbers}}: ({})'. \
+        format(_namespace_token(namespace_id),
+               u' '.join(u'"{}"*'.format(t.replace(u'"', u'""'))
+                         for t in terms))
@@ -1,60 +1,255 @@
-import uuid
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from hashlib import sha256
+
+from inbox.config import config
 from inbox.util.addr import valid_email
 from inbox.util.addr import canonicalize_address as canonicalize
+from inbox.util.encoding import unicode_safe_truncate
+from inbox.util.itert import chunk
+from inbox.util.stats import statsd_client
 from inbox.models import Contact, MessageContactAssociation
+from inbox.models.constants import MAX_INDEXABLE_LENGTH
+from inbox.models.transaction import Transaction
+from inbox.sqlalchemy_ext.util import generate_public_id
+from inbox.transactions.notifier import record_transaction
 
 from inbox.contacts.crud import INBOX_PROVIDER_NAME
 
+CONTACT_FIELDS = ('from_addr', 'to_addr', 'cc_addr', 'bcc_addr', 'reply_to')
+
+# Bound on the size of each namespace's ContactCache.
+CONTACT_CACHE_SIZE = config.get('CONTACT_CACHE_SIZE', 5000)
+QUERY_CHUNK_SIZE = 1000
+
+_contact_caches = {}
+
+
+def contact_cache(namespace_id):
+    """Return the ContactCache for the given namespace."""
+    cache = _contact_caches.get(namespace_id)
+    if cache is None:
+        cache = _contact_caches[namespace_id] = ContactCache()
+    return cache
+
+
+class ContactCache(object):
+    """
+    The ids and names of a namespace's contacts by canonicalized email
+    address, for the `max_size` most recently used addresses, so that
+    syncing a mailbox doesn't mean looking up the same few hundred
+    correspondents for every message.
+
+    Only contacts that had already been committed when they were looked up
+    are cached: if the transaction that created a contact were rolled back,
+    later messages would be associated with a contact that doesn't exist.
+
+    """
+
+    def __init__(self, max_size=CONTACT_CACHE_SIZE):
+        self.max_size = max_size
+        # canonicalized address -> (contact id, name), least recently used
+        # first.
+        self._contacts = OrderedDict()
+
+    def get(self, canonicalized_address):
+        contact = self._contacts.pop(canonicalized_address, None)
+        if contact is not None:
+            self._contacts[canonicalized_address] = contact
+        return contact
+
+    def put(self, canonicalized_address, contact):
+        self._contacts.pop(canonicalized_address, None)
+        self._contacts[canonicalized_address] = contact
+        while len(self._contacts) > self.max_size:
+            self._contacts.popitem(last=False)
+
+    def invalidate(self, canonicalized_address):
+        self._contacts.pop(canonicalized_address, None)
+
 
 def update_contacts_from_message(db_session, message, namespace):
-    with db_session.no_autoflush:
-        # First create Contact objects for any email addresses that we haven't
-        # seen yet. We want to dedupe by canonicalized address, so this part is
-        # a bit finicky.
-        canonicalized_addresses = []
-        all_addresses = []
-        for field in (message.from_addr, message.to_addr, message.cc_addr,
-                      message.bcc_addr, message.reply_to):
+    update_contacts_from_messages(db_session, [message], namespace)
+
+
+def update_contacts_from_messages(db_session, messages, namespace,
+                                  cache=None):
+    """
+    Create Contacts for the addresses on `messages` that we haven't seen yet,
+    and associate each message with the contacts of its addressees.
+
+    Contacts are looked up in `cache` (a ContactCache) first, and then in
+    the database; any that don't exist yet are created with a single INSERT.
+    Use the cache for one call per transaction at most, so that contacts
+    created earlier in the transaction aren't cached.
+
+    """
+    # First find the contact for each canonicalized address, creating
+    # Contact rows for any that we haven't seen yet.
+    occurrences = []
+    # canonicalized address -> (name, email address) of its first occurrence
+    addresses = OrderedDict()
+    names = defaultdict(set)
+    for message in messages:
+        for field_name in CONTACT_FIELDS:
             # We generally require these attributes to be non-null, but only
-            # set them to the default empty list at flush time. So it's better
-            # to be safe here.
-            if field is not None:
-                all_addresses.extend(field)
-        canonicalized_addresses = [canonicalize(addr) for _, addr in
-                                   all_addresses]
-
-        existing_contacts = db_session.query(Contact).filter(
-            Contact._canonicalized_address.in_(canonicalized_addresses),
-            Contact.namespace_id == namespace.id).all()
-
-        contact_map = {c._canonicalized_address: c for c in existing_contacts}
-        for name, email_address in all_addresses:
-            canonicalized_address = canonicalize(email_address)
-            if canonicalized_address not in contact_map:
-                new_contact = Contact(name=name, email_address=email_address,
-                                      namespace=namespace,
-                                      provider_name=INBOX_PROVIDER_NAME,
-                                      uid=uuid.uuid4().hex)
-                contact_map[canonicalized_address] = new_contact
-
-        # Now associate each contact to the message.
-        for field_name in ('from_addr', 'to_addr', 'cc_addr', 'bcc_addr',
-                           'reply_to'):
+            # set them to the default empty list at flush time. So it's
+            # better to be safe here.
             field = getattr(message, field_name)
             if field is None:
                 continue
             for name, email_address in field:
-                if not valid_email(email_address):
-                    continue
+                email_address = _truncate(email_address)
                 canonicalized_address = canonicalize(email_address)
-                contact = contact_map.get(canonicalized_address)
-                # Hackily address the condition that you get mail from e.g.
-                # "Ben Gotow (via Google Drive) <drive-shares-noreply@google.com"        # noqa
-                # "Christine Spang (via Google Drive) <drive-shares-noreply@google.com"  # noqa
-                # and so on: rather than creating many contacts with
-                # varying name, null out the name for the existing contact.
-                if contact.name != name and 'noreply' in canonicalized_address:
+                occurrences.append((message, field_name, canonicalized_address,
+                                    valid_email(email_address)))
+                addresses.setdefault(canonicalized_address,
+                                     (name, email_address))
+                names[canonicalized_address].add(name)
+    if not addresses:
+        return
+
+    with db_session.no_autoflush:
+        contacts = _find_contacts(db_session, namespace.id, addresses, cache)
+
+        # Hackily address the condition that you get mail from e.g.
+        # "Ben Gotow (via Google Drive) <drive-shares-noreply@google.com"        # noqa
+        # "Christine Spang (via Google Drive) <drive-shares-noreply@google.com"  # noqa
+        # and so on: rather than creating many contacts with
+        # varying name, null out the name for the existing contact.
+        for canonicalized_address, (contact_id, name) in contacts.items():
+            if ('noreply' in canonicalized_address and name is not None and
+                    names[canonicalized_address] != {name}):
+                contact = db_session.query(Contact).get(contact_id)
+                if contact is not None:
                     contact.name = None
+                contacts[canonicalized_address] = (contact_id, None)
+                if cache is not None:
+                    cache.invalidate(canonicalized_address)
+
+        new_contacts = []
+        for canonicalized_address, (name, email_address) in \
+                addresses.iteritems():
+            if canonicalized_address in contacts:
+                continue
+            if ('noreply' in canonicalized_address and
+                    len(names[canonicalized_address]) > 1):
+                name = None
+            new_contacts.append((canonicalized_address, name, email_address))
+        if new_contacts:
+            contacts.update(_create_contacts(db_session, namespace.id,
+                                             new_contacts, cache))
+
+    # Now associate each contact to its messages.
+    for message, field_name, canonicalized_address, valid in occurrences:
+        if not valid:
+            continue
+        contact_id, _ = contacts[canonicalized_address]
+        message.contacts.append(MessageContactAssociation(
+            contact_id=contact_id, field=field_name))
+
+
+def _find_contacts(db_session, namespace_id, addresses, cache):
+    """
+    Return the ids and names of the existing contacts with the given
+    canonicalized addresses, by canonicalized address.
+
+    """
+    contacts = {}
+    missing = []
+    for canonicalized_address in addresses:
+        contact = None
+        if cache is not None:
+            contact = cache.get(canonicalized_address)
+        if contact is None:
+            missing.append(canonicalized_address)
+        else:
+            contacts[canonicalized_address] = contact
+    if cache is not None:
+        statsd_client.incr('mailsync.contact_cache.hit', len(contacts))
+        statsd_client.incr('mailsync.contact_cache.miss', len(missing))
+
+    for addresses in chunk(missing, QUERY_CHUNK_SIZE):
+        rows = db_session.query(Contact.id, Contact._canonicalized_address,
+                                Contact.name). \
+            filter(Contact.namespace_id == namespace_id,
+                   Contact._canonicalized_address.in_(addresses)). \
+            order_by(Contact.id)
+        for contact_id, canonicalized_address, name in rows:
+            if canonicalized_address in contacts:
+                continue
+            contacts[canonicalized_address] = (contact_id, name)
+            if cache is not None:
+                cache.put(canonicalized_address, (contact_id, name))
+    return contacts
+
+
+def _create_contacts(db_session, namespace_id, new_contacts, cache):
+    """
+    Create contacts for the given (canonicalized address, name, email
+    address) tuples, and return their ids and names by canonicalized address.
+
+    Contacts created from mail have a uid derived from their canonicalized
+    address, so if another transaction creates one of them first, the unique
+    constraint on (uid, namespace_id, provider_name) makes us skip it rather
+    than create a duplicate.
+
+    """
+    now = datetime.utcnow()
+    rows = []
+    by_uid = {}
+    for canonicalized_address, name, email_address in new_contacts:
+        uid = _contact_uid(canonicalized_address)
+        by_uid[uid] = canonicalized_address
+        rows.append({'public_id': generate_public_id(),
+                     'namespace_id': namespace_id,
+                     'uid': uid,
+                     'provider_name': INBOX_PROVIDER_NAME,
+                     'name': name,
+                     '_raw_address': email_address,
+                     '_canonicalized_address': canonicalized_address,
+                     'created_at': now,
+                     'updated_at': now})
+    db_session.execute(Contact.__table__.insert().prefix_with('IGNORE'), rows)
+    public_ids = {row['public_id'] for row in rows}
+
+    contacts = {}
+    for uids in chunk(by_uid, QUERY_CHUNK_SIZE):
+        # Lock the rows, so that we also see the ones that were committed
+        # after our transaction started.
+        created = db_session.query(Contact.id, Contact.public_id, Contact.uid,
+                                   Contact.name). \
+            filter(Contact.namespace_id == namespace_id,
+                   Contact.provider_name == INBOX_PROVIDER_NAME,
+                   Contact.uid.in_(uids)). \
+            with_for_update(read=True)
+        for contact_id, public_id, uid, name in created:
+            canonicalized_address = by_uid[uid]
+            contacts[canonicalized_address] = (contact_id, name)
+            if public_id in public_ids:
+                # We bypassed the ORM, so record the transaction ourselves.
+                transaction = Transaction(command='insert',
+                                          record_id=contact_id,
+                                          object_type=Contact.API_OBJECT_NAME,
+                                          object_public_id=public_id,
+                                          namespace_id=namespace_id)
+                db_session.add(transaction)
+                record_transaction(db_session, transaction)
+            elif cache is not None:
+                # Somebody else created it, and has committed.
+                cache.put(canonicalized_address, (contact_id, name))
+    return contacts
+
+
+def _contact_uid(canonicalized_address):
+    if isinstance(canonicalized_address, unicode):
+        canonicalized_address = canonicalized_address.encode('utf-8')
+    return sha256(canonicalized_address).hexdigest()
+
 
-                message.contacts.append(MessageContactAssociation(
-                    contact=contact, field=field_name))
+def _truncate(email_address):
+    # Contact.email_address silently truncates addresses that are too long
+    # to index, so compare and store them truncated too.
+    if email_address is None:
+        return None
+    return unicode_safe_truncate(email_address, MAX_INDEXABLE_LENGTH)
@@ -0,0 +1,210 @@
+"""
+Contact rankings and intrinsic groups (see inbox.contacts.algorithms),
+maintained incrementally as messages are sent.
+
+Scoring a namespace's contacts from scratch means loading every message it
+has ever sent, and working out its groups takes time quadratic in the number
+of distinct lists of recipients. Instead, the contact rankings service
+(inbox.transactions.contact_rankings) adds each sent message to the
+namespace's ContactScores as it's synced, and stores them in its
+DataProcessingCache, so that the API only has to read them.
+
+A message's weight decays linearly with its age, down to MIN_MESSAGE_WEIGHT
+once it's LOOKBACK_TIME old. The total weight of a set of messages that are
+younger than that only depends on how many there are and the sum of their
+dates, so for each recipient (and each list of recipients) we keep the count
+and sum of the dates of their messages per BUCKET_DAYS days, and apply the
+decay when the scores are read.
+
+Which lists of recipients make up which group is only recalculated every
+CONTACT_GROUPS_RECALCULATE_INTERVAL seconds, but the groups' scores are
+always up to date. Messages that are deleted aren't taken out of the scores.
+
+"""
+import calendar
+import time
+
+from inbox.config import config
+from inbox.contacts.algorithms import (calculate_groups, _get_participants,
+                                       LOOKBACK_TIME, MIN_MESSAGE_WEIGHT,
+                                       MIN_GROUP_SIZE)
+
+BUCKET_DAYS = 7
+GROUPS_RECALCULATE_INTERVAL = config.get(
+    'CONTACT_GROUPS_RECALCULATE_INTERVAL', 3600)
+# How many of the most recently counted messages' ids to remember, so that
+# they aren't counted twice.
+MAX_COUNTED_IDS = 10000
+
+_BUCKET_SECONDS = BUCKET_DAYS * 86400
+# The bucket of messages old enough to have MIN_MESSAGE_WEIGHT.
+_OLD = 'old'
+
+
+class ContactScores(object):
+    """
+    A namespace's contact rankings and groups.
+
+    Messages with ids up to `watermark`, or in `counted`, have been counted
+    already. New messages have higher ids than all but the most recent
+    MAX_COUNTED_IDS messages, so `counted` only needs to hold those.
+
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        # email address -> bucket -> [message count, sum of message dates]
+        self.recipients = state.get('recipients', {})
+        # ', '-joined list of participants -> bucket -> [count, sum of dates]
+        self.participants = state.get('participants', {})
+        # [[group's email addresses, ', '-joined lists of participants]]
+        self.groups = state.get('groups', [])
+        self.groups_calculated_at = state.get('groups_calculated_at')
+        self.watermark = state.get('watermark', 0)
+        self.counted = state.get('counted', [])
+        self._counted = set(self.counted)
+        # Messages with ids up to `backfill_until` are backfilled, in order
+        # of id; `backfill_pointer` is the id of the last one so far.
+        self.backfill_until = state.get('backfill_until', 0)
+        self.backfill_pointer = state.get('backfill_pointer', 0)
+
+    def to_state(self):
+        return {'recipients': self.recipients,
+                'participants': self.participants,
+                'groups': self.groups,
+                'groups_calculated_at': self.groups_calculated_at,
+                'watermark': self.watermark,
+                'counted': self.counted,
+                'backfill_until': self.backfill_until,
+                'backfill_pointer': self.backfill_pointer}
+
+    def start_backfill(self, max_message_id):
+        """
+        Start counting new messages, leaving the ones with ids up to
+        `max_message_id` to be backfilled.
+
+        """
+        self.watermark = self.backfill_until = max_message_id
+        self.backfill_pointer = 0
+
+    def add_messages(self, messages, user_email, now=None):
+        """
+        Count `messages`, as returned by messages_for_contact_scores(),
+        skipping the ones that have been counted already.
+
+        """
+        now = now or time.time()
+        for message in messages:
+            if message.id <= self.watermark or message.id in self._counted:
+                continue
+            self._remember(message.id)
+            self._add_message(message, user_email)
+        self._expire(now)
+
+    def backfill(self, messages, user_email, now=None):
+        """
+        Count `messages`, which were sent before we started counting new
+        ones, in order of id.
+
+        """
+        now = now or time.time()
+        for message in messages:
+            self._add_message(message, user_email)
+            self.backfill_pointer = message.id
+        self._expire(now)
+
+    def rankings(self, now=None):
+        """ Return each recipient's score, by email address. """
+        now = now or time.time()
+        return {email: _weight(buckets, now)
+                for email, buckets in self.recipients.iteritems()}
+
+    def group_scores(self, now=None):
+        """ Return each group's score, by its ', '-joined email addresses. """
+        now = now or time.time()
+        weights = {}
+
+        def weight(participants):
+            if participants not in weights:
+                buckets = self.participants.get(participants)
+                weights[participants] = \
+                    _weight(buckets, now) if buckets else 0
+            return weights[participants]
+
+        return {', '.join(sorted(emails)): sum(weight(p) for p in molecule)
+                for emails, molecule in self.groups}
+
+    def groups_due(self, now=None):
+        now = now or time.time()
+        return (self.groups_calculated_at is None or
+                now - self.groups_calculated_at >=
+                GROUPS_RECALCULATE_INTERVAL)
+
+    def recalculate_groups(self, now=None):
+        now = now or time.time()
+        participant_weights = {
+            tuple(participants.split(', ')): _weight(buckets, now)
+            for participants, buckets in self.participants.iteritems()}
+        self.groups = [
+            [sorted(emails), sorted(', '.join(p) for p in molecule)]
+            for emails, molecule in calculate_groups(participant_weights)]
+        self.groups_calculated_at = now
+
+    def _add_message(self, message, user_email):
+        date = calendar.timegm(message.date.utctimetuple())
+        for _, email in message.to_addr + message.cc_addr + message.bcc_addr:
+            _add(self.recipients.setdefault(email, {}), date)
+        participants = _get_participants(message, [user_email])
+        if len(participants) >= MIN_GROUP_SIZE:
+            _add(self.participants.setdefault(', '.join(participants), {}),
+                 date)
+
+    def _remember(self, message_id):
+        self.counted.append(message_id)
+        self._counted.add(message_id)
+        if len(self.counted) > MAX_COUNTED_IDS:
+            self.counted.sort()
+            forgotten = self.counted[:-MAX_COUNTED_IDS]
+            del self.counted[:-MAX_COUNTED_IDS]
+            self._counted.difference_update(forgotten)
+            self.watermark = max(self.watermark, forgotten[-1])
+
+    def _expire(self, now):
+        # Messages that have reached MIN_MESSAGE_WEIGHT stay there, so they
+        # only need counting.
+        for counts in (self.recipients, self.participants):
+            for buckets in counts.itervalues():
+                for bucket in buckets.keys():
+                    if bucket != _OLD and \
+                            _bucket_end(bucket) <= now - LOOKBACK_TIME:
+                        count, _ = buckets.pop(bucket)
+                        old = buckets.setdefault(_OLD, [0, 0])
+                        old[0] += count
+
+
+def _add(buckets, date):
+    bucket = buckets.setdefault(str(int(date // _BUCKET_SECONDS)), [0, 0])
+    bucket[0] += 1
+    bucket[1] += date
+
+
+def _bucket_end(bucket):
+    return (int(bucket) + 1) * _BUCKET_SECONDS
+
+
+def _weight(buckets, now):
+    """ The total weight of the messages counted in `buckets` at `now`. """
+    cutoff = now - LOOKBACK_TIME
+    total = 0
+    for bucket, (count, dates) in buckets.iteritems():
+        min_weight = count * MIN_MESSAGE_WEIGHT
+        if bucket == _OLD or _bucket_end(bucket) <= cutoff:
+            total += min_weight
+            continue
+        # The sum of 1 - (now - date) / LOOKBACK_TIME over the messages.
+        weight = count - (count * now - dates) / LOOKBACK_TIME
+        if int(bucket) * _BUCKET_SECONDS < cutoff:
+            # Some of the messages may have reached the minimum weight.
+            weight = max(weight, min_weight)
+        total += weight
+    return total
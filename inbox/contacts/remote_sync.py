@@ -9,6 +9,7 @@ from inbox.models import Contact, Account
 from inbox.sync.base_sync import BaseSyncMonitor
 from inbox.contacts.google import GoogleContactsProvider
 from inbox.contacts.icloud import ICloudContactsProvider
+from inbox.contacts.process_mail import contact_cache
 from inbox.util.debug import bind_context
 from inbox.models.session import session_scope
 
@@ -98,6 +99,10 @@ class ContactSync(BaseSyncMonitor):
 
                     # If the remote item was deleted, purge the corresponding
                     # database entries.
+                    # Messages mustn't be associated with a deleted contact,
+                    # or one that's no longer for their address.
+                    contact_cache(account.namespace.id).invalidate(
+                        existing_contact._canonicalized_address)
                     if new_contact.deleted:
                         db_session.delete(existing_contact)
                         change_counter['deleted'] += 1
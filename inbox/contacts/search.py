@@ -25,6 +25,19 @@ search_service_url = config.get('SEARCH_SERVICE_ENDPOINT')
 doc_service_url = config.get('DOCUMENT_SERVICE_ENDPOINT')
 
 
+def get_contact_search_client(namespace_id):
+    """
+    Return the search client for the configured CONTACT_SEARCH_BACKEND:
+    'cloudsearch' (the default), or 'local' (see inbox.contacts.local_search).
+
+    """
+    from inbox.contacts.local_search import (local_contact_index_enabled,
+                                             LocalContactSearchClient)
+    if local_contact_index_enabled():
+        return LocalContactSearchClient(namespace_id)
+    return ContactSearchClient(namespace_id)
+
+
 def get_domain_config(conn, domain_name):
     domains = conn.describe_domains()
 
@@ -170,7 +183,10 @@ def index_namespace(namespace_id):
     for incremental indexing.
 
     """
-    if not search_service_url or not doc_service_url:
+    from inbox.contacts import local_search
+    if local_search.local_contact_index_enabled():
+        local_search.index_namespace(namespace_id)
+    elif not search_service_url or not doc_service_url:
         raise Exception('CloudSearch not configured; cannot index')
     else:
         search_client = ContactSearchClient(namespace_id)
@@ -223,7 +239,11 @@ def index_namespace(namespace_id):
 
 
 def delete_namespace_indexes(namespace_ids):
-    if not search_service_url or not doc_service_url:
+    from inbox.contacts import local_search
+    if local_search.local_contact_index_enabled():
+        for namespace_id in namespace_ids:
+            local_search.delete_namespace_index(namespace_id)
+    elif not search_service_url or not doc_service_url:
         raise Exception('CloudSearch not configured; cannot update index')
     else:
         doc_service = get_doc_service()
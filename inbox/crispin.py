@@ -35,6 +35,7 @@ from sqlalchemy.orm import joinedload
 from inbox.util.concurrency import retry
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
+from inbox.util.uidset import UIDSet
 from inbox.basicauth import GmailSettingError
 from inbox.models.session import session_scope
 from inbox.models.backends.imap import ImapAccount
@@ -79,6 +80,11 @@ CONN_UNUSABLE_EXC_CLASSES = CONN_NETWORK_EXC_CLASSES + \
     (ssl.CertificateError, imaplib.IMAP4.abort)
 
 
+# Account ids whose IMAP servers rejected a multi-UID body FETCH. We only
+# issue single-UID fetches for these.
+_no_batch_fetch = set()
+
+
 class FolderMissingError(Exception):
     pass
 
@@ -229,9 +235,11 @@ class CrispinConnectionPool(object):
 
     def _new_connection(self):
         conn = self._new_raw_connection()
-        return self.client_cls(self.account_id, self.provider_info,
-                               self.email_address, conn,
-                               readonly=self.readonly)
+        client = self.client_cls(self.account_id, self.provider_info,
+                                 self.email_address, conn,
+                                 readonly=self.readonly)
+        client.enable_qresync()
+        return client
 
 
 def _exc_callback(exc):
@@ -244,6 +252,25 @@ retry_crispin = functools.partial(
     retry, retry_classes=CONN_RETRY_EXC_CLASSES, exc_callback=_exc_callback)
 
 
+def _changedsince(modseq, vanished):
+    modifier = 'CHANGEDSINCE {}'.format(modseq)
+    return modifier + ' VANISHED' if vanished else modifier
+
+
+def _vanished_uids(responses):
+    """
+    The UIDs in untagged VANISHED responses, as kept by imaplib, e.g.
+    '(EARLIER) 41,43:116,118'.
+
+    """
+    ranges = []
+    for response in responses:
+        for uid_range in response.split()[-1].split(','):
+            first, _, last = uid_range.partition(':')
+            ranges.append(tuple(sorted((long(first), long(last or first)))))
+    return UIDSet.from_ranges(sorted(ranges))
+
+
 class CrispinClient(object):
     """
     Generic IMAP client wrapper.
@@ -293,6 +320,7 @@ class CrispinClient(object):
         self._folder_names = None
         self.conn = conn
         self.readonly = readonly
+        self.qresync_enabled = False
 
     def _fetch_folder_list(self):
         """ NOTE: XLIST is deprecated, so we just use LIST.
@@ -605,6 +633,20 @@ class CrispinClient(object):
         capabilities = self.conn.capabilities()
         return 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities
 
+    def enable_qresync(self):
+        """
+        Enable QRESYNC (RFC 7162) on the connection if the server supports
+        it, so that condstore_changes() can tell which messages were expunged
+        without comparing all of a folder's UIDs. ENABLE is only valid before
+        a folder is selected, so this has to be called on a new connection.
+
+        """
+        if 'QRESYNC' not in self.conn.capabilities():
+            return
+        enabled = self.conn.enable('QRESYNC')
+        self.qresync_enabled = 'QRESYNC' in enabled
+        log.info('Enabled QRESYNC', enabled=self.qresync_enabled)
+
     def idle_supported(self):
         return 'IDLE' in self.conn.capabilities()
 
@@ -614,16 +656,19 @@ class CrispinClient(object):
         http://tools.ietf.org/html/rfc3501.html#section-6.4.4 for valid
         criteria.
 
+        Returns
+        -------
+        UIDSet
+
         """
-        return sorted([long(uid) for uid in self.conn.search(criteria)])
+        return UIDSet(self.conn.search(criteria))
 
     def all_uids(self):
         """ Fetch all UIDs associated with the currently selected folder.
 
         Returns
         -------
-        list
-            UIDs as integers sorted in ascending order.
+        UIDSet
         """
         # Note that this list may include items which have been marked for
         # deletion with the \Deleted flag, but not yet actually removed via
@@ -651,13 +696,31 @@ class CrispinClient(object):
         log.debug('Requested all UIDs',
                   search_time=elapsed,
                   total_uids=len(fetch_result))
-        return sorted([long(uid) for uid in fetch_result])
+        return UIDSet(fetch_result)
 
     def uids(self, uids):
         uid_set = set(uids)
-        messages = []
         raw_messages = {}
 
+        if len(uid_set) > 1 and self.account_id not in _no_batch_fetch:
+            try:
+                raw_messages = self.conn.fetch(
+                    sorted(uid_set), ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS'])
+            except imaplib.IMAP4.abort:
+                raise
+            except imapclient.IMAPClient.Error as e:
+                if ('[UNAVAILABLE] UID FETCH Server error '
+                        'while fetching messages') not in str(e):
+                    # The server doesn't like multi-UID fetches; remember that
+                    # so that we don't waste a round trip on every batch.
+                    _no_batch_fetch.add(self.account_id)
+                log.info('Batched UID FETCH failed; falling back to '
+                         'single-UID fetches', uid_count=len(uid_set),
+                         error=e, logstash_tag='imap_download_exception')
+                raw_messages = {}
+            else:
+                return self._raw_messages(raw_messages, uid_set)
+
         for uid in uid_set:
             try:
                 raw_messages.update(self.conn.fetch(
@@ -676,6 +739,10 @@ class CrispinClient(object):
                              logstash_tag='imap_download_exception')
                     raise
 
+        return self._raw_messages(raw_messages, uid_set)
+
+    def _raw_messages(self, raw_messages, uid_set):
+        messages = []
         for uid in sorted(raw_messages.iterkeys(), key=long):
             # Skip handling unsolicited FETCH responses
             if uid not in uid_set:
@@ -695,6 +762,27 @@ class CrispinClient(object):
                                        g_labels=None))
         return messages
 
+    def sizes(self, uids):
+        """
+        RFC822.SIZE for the given UIDs. Chunked because certain providers
+        fail with 'Command line too large' if you feed them too many uids at
+        once.
+
+        Returns
+        -------
+        dict
+            Mapping of `uid` (long) : `size` (int)
+
+        """
+        uid_set = set(uids)
+        sizes = {}
+        for uid_chunk in chunk(uids, 100):
+            data = self.conn.fetch(uid_chunk, ['RFC822.SIZE'])
+            sizes.update({uid: ret['RFC822.SIZE']
+                          for uid, ret in data.items()
+                          if uid in uid_set and 'RFC822.SIZE' in ret})
+        return sizes
+
     def flags(self, uids):
         if len(uids) > 100:
             # Some backends abort the connection if you give them a really
@@ -857,9 +945,38 @@ class CrispinClient(object):
         self.conn.idle_done()
         return r
 
-    def condstore_changed_flags(self, modseq):
+    def condstore_changes(self, modseq):
+        """
+        Flags changed since `modseq` and, if QRESYNC is enabled, the UIDs
+        expunged since then, which the server reports in a VANISHED (EARLIER)
+        response to the flags fetch (RFC 7162, section 3.2.6).
+
+        Returns
+        -------
+        tuple
+            The changed flags, as returned by condstore_changed_flags(), and
+            a UIDSet of the expunged UIDs, or None if QRESYNC isn't enabled.
+            Servers may report UIDs that were expunged before `modseq`, or
+            that were never assigned.
+
+        """
+        if not self.qresync_enabled:
+            return self.condstore_changed_flags(modseq), None
+        # Discard any unsolicited VANISHED responses left over from earlier
+        # commands, which may have been for another folder.
+        self._pop_vanished_uids()
+        changed_flags = self.condstore_changed_flags(modseq, vanished=True)
+        return changed_flags, self._pop_vanished_uids()
+
+    def _pop_vanished_uids(self):
+        # imaplib keeps the untagged responses that IMAPClient doesn't ask
+        # for, by type, until they're popped.
+        return _vanished_uids(
+            self.conn._imap.untagged_responses.pop('VANISHED', []))
+
+    def condstore_changed_flags(self, modseq, vanished=False):
         data = self.conn.fetch('1:*', ['FLAGS'],
-                               modifiers=['CHANGEDSINCE {}'.format(modseq)])
+                               modifiers=[_changedsince(modseq, vanished)])
         return {uid: Flags(ret['FLAGS'], ret['MODSEQ'][0]
                            if 'MODSEQ' in ret else None)
                 for uid, ret in data.items()}
@@ -916,9 +1033,9 @@ class GmailCrispinClient(CrispinClient):
                                 ret['MODSEQ'][0] if 'MODSEQ' in ret else None)
                 for uid, ret in data.items() if uid in uid_set}
 
-    def condstore_changed_flags(self, modseq):
+    def condstore_changed_flags(self, modseq, vanished=False):
         data = self.conn.fetch('1:*', ['FLAGS', 'X-GM-LABELS'],
-                               modifiers=['CHANGEDSINCE {}'.format(modseq)])
+                               modifiers=[_changedsince(modseq, vanished)])
         results = {}
         for uid, ret in data.items():
             if 'FLAGS' not in ret or 'X-GM-LABELS' not in ret:
@@ -951,6 +1068,21 @@ class GmailCrispinClient(CrispinClient):
         return {uid: ret['X-GM-MSGID']
                 for uid, ret in data.items() if uid in uid_set}
 
+    def g_thrids(self, uids):
+        """
+        X-GM-THRIDs for the given UIDs.
+
+        Returns
+        -------
+        dict
+            Mapping of `uid` (long) : `g_thrid` (long)
+
+        """
+        data = self.conn.fetch(uids, ['X-GM-THRID'])
+        uid_set = set(uids)
+        return {uid: ret['X-GM-THRID']
+                for uid, ret in data.items() if uid in uid_set}
+
     def g_msgid_to_uids(self, g_msgid):
         """
         Find all message UIDs in the selected folder with X-GM-MSGID equal to
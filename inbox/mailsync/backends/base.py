@@ -5,6 +5,7 @@ log = get_logger()
 from inbox.util.debug import bind_context
 from inbox.util.concurrency import retry_with_logging
 from inbox.models.session import session_scope
+from inbox.util.threading import drop_threading_index
 
 THROTTLE_COUNT = 200
 THROTTLE_WAIT = 60
@@ -83,3 +84,5 @@ class BaseMailSyncMonitor(Greenlet):
             map(lambda x: x.set_stopped(mailsync_db_session),
                 self.folder_monitors)
         self.folder_monitors.kill()
+        # The account may be synced by another process from now on.
+        drop_threading_index(self.namespace_id)
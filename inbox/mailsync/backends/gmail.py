@@ -21,15 +21,20 @@ user always gets the full thread when they look at mail.
 """
 from __future__ import division
 from collections import OrderedDict
+from itertools import chain
 from datetime import datetime, timedelta
 import gevent
 from sqlalchemy.orm import joinedload, load_only
 
+from inbox.config import config
 from inbox.util.itert import chunk
 from inbox.util.debug import bind_context
 
 from nylas.logging import get_logger
 from gevent.lock import Semaphore
+from inbox.contacts.process_mail import (contact_cache,
+                                         update_contacts_from_messages)
+from inbox.crispin import RawMessage
 from inbox.models import Message, Folder, Namespace, Account, Label, Category
 from inbox.models.category import EPOCH
 from inbox.models.backends.imap import ImapFolderInfo, ImapUid, ImapThread
@@ -48,6 +53,11 @@ SYNC_MONITOR_CLS = 'GmailSyncMonitor'
 MAX_DOWNLOAD_BYTES = 2 ** 20
 # USE MAX_DOWNLOAD_COUNT = 1 instead of 30 until N1 launch herding dies.
 MAX_DOWNLOAD_COUNT = 1
+# Folders with more UIDs to download than this expand threads with a SEARCH
+# per thread, rather than holding a map of all of their threads' UIDs.
+THREAD_MAP_MAX_UIDS = config.get('GMAIL_THREAD_MAP_MAX_UIDS', 500000)
+# How many threads to expand at a time, ahead of the downloads.
+THREAD_EXPANSION_LOOKAHEAD = 50
 
 
 class GmailSyncMonitor(ImapSyncMonitor):
@@ -208,6 +218,12 @@ class GmailFolderSyncEngine(FolderSyncEngine):
     def __init__(self, *args, **kwargs):
         FolderSyncEngine.__init__(self, *args, **kwargs)
         self.saved_uids = set()
+        # UIDs whose bodies we didn't download, because we'd already saved
+        # their messages, but whose messages were deleted before we could
+        # save the UIDs. See download_deleted_known_uids().
+        self.redownload_uids = set()
+        # X-GM-THRID -> UIDs to download, if there weren't too many.
+        self.thread_map = None
 
     def is_all_mail(self, crispin_client):
         if not hasattr(self, '_is_all_mail'):
@@ -223,19 +239,20 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         # change_poller need to be killed when this greenlet is interrupted
         change_poller = None
         try:
-            remote_uids = sorted(crispin_client.all_uids(), key=int)
+            remote_uids = crispin_client.all_uids()
             with self.syncmanager_lock:
                 with session_scope(self.namespace_id) as db_session:
                     local_uids = common.local_uids(self.account_id, db_session,
                                                    self.folder_id)
                 common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids) - set(remote_uids))
-                unknown_uids = set(remote_uids) - local_uids
+                    self.account_id, self.folder_id, local_uids - remote_uids)
+                unknown_uids = remote_uids - local_uids
                 with session_scope(self.namespace_id) as db_session:
                     self.update_uid_counts(
                         db_session, remote_uid_count=len(remote_uids),
                         download_uid_count=len(unknown_uids))
+            self.thread_map = self.build_thread_map(crispin_client,
+                                                    unknown_uids)
 
             change_poller = gevent.spawn(self.poll_for_changes)
             bind_context(change_poller, 'changepoller', self.account_id,
@@ -244,23 +261,25 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             if self.is_all_mail(crispin_client):
                 # Prioritize UIDs for messages in the inbox folder.
                 if len(remote_uids) < 1e6:
-                    inbox_uids = set(
-                        crispin_client.search_uids(['X-GM-LABELS', 'inbox']))
+                    inbox_uids = crispin_client.search_uids(
+                        ['X-GM-LABELS', 'inbox'])
                 else:
                     # The search above is really slow (times out) on really
                     # large mailboxes, so bound the search to messages within
                     # the past month in order to get anywhere.
                     since = datetime.utcnow() - timedelta(days=30)
-                    inbox_uids = set(crispin_client.search_uids([
+                    inbox_uids = crispin_client.search_uids([
                         'X-GM-LABELS', 'inbox',
-                        'SINCE', since]))
+                        'SINCE', since])
 
-                uids_to_download = (sorted(unknown_uids - inbox_uids) +
-                                    sorted(unknown_uids & inbox_uids))
+                # Newest first, inbox first.
+                uids_to_download = chain(
+                    reversed(unknown_uids & inbox_uids),
+                    reversed(unknown_uids - inbox_uids))
             else:
-                uids_to_download = sorted(unknown_uids)
+                uids_to_download = reversed(unknown_uids)
 
-            for uids in chunk(reversed(uids_to_download), 1024):
+            for uids in chunk(uids_to_download, 1024):
                 g_metadata = crispin_client.g_metadata(uids)
                 # UIDs might have been expunged since sync started, in which
                 # case the g_metadata call above will return nothing.
@@ -268,11 +287,22 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # expansion. We can omit such UIDs.
                 uids = [u for u in uids if u in g_metadata and u not in
                         self.saved_uids]
+                # Messages we've already saved under another label just need
+                # new ImapUids, so only download the others.
+                known_uids, uids = self.split_known_uids(uids, g_metadata)
+                if known_uids:
+                    self.commit_uids(
+                        self.fetch_known_uids(crispin_client, known_uids,
+                                              g_metadata),
+                        datetime.utcnow())
+                    self.download_deleted_known_uids(crispin_client)
                 self.batch_download_uids(crispin_client, uids, g_metadata)
         finally:
             if change_poller is not None:
                 # schedule change_poller to die
                 gevent.kill(change_poller)
+            # It's only needed for the initial sync, and can be big.
+            self.thread_map = None
 
     def resync_uids_impl(self):
         with session_scope(self.namespace_id) as db_session:
@@ -323,19 +353,24 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         We deduplicate messages based on g_msgid: if we've previously saved a
         Message object for this raw message, we don't create a new one. But we
         do create a new ImapUid, associate it to the message, and update flags
-        and categories accordingly.
-        Note: we could do this prior to downloading the actual message
-        body, but that's really more complicated than it's worth. This
-        operation is not super common unless you're regularly moving lots
-        of messages to trash or spam, and even then the overhead of just
-        downloading the body is generally not that high.
+        and categories accordingly. The new ImapUids are committed together.
+        Note: the bodies of such messages usually aren't downloaded at all
+        (see fetch_uids()), in which case the raw message's body is None. If
+        the message has since been deleted, its UID is left for
+        download_deleted_known_uids().
 
         """
         new_g_msgids = {msg.g_msgid for msg in raw_messages}
-        existing_g_msgids = g_msgids(self.namespace_id, db_session,
-                                     in_=new_g_msgids)
-        brand_new_messages = [m for m in raw_messages if m.g_msgid not in
-                              existing_g_msgids]
+        existing_g_msgids = set(g_msgids(self.namespace_id, db_session,
+                                         in_=new_g_msgids))
+        brand_new_messages = []
+        for m in raw_messages:
+            if m.g_msgid in existing_g_msgids:
+                continue
+            if m.body is None:
+                self.redownload_uids.add(m.uid)
+            else:
+                brand_new_messages.append(m)
         previously_synced_messages = [m for m in raw_messages if m.g_msgid in
                                       existing_g_msgids]
         if previously_synced_messages:
@@ -343,16 +378,26 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                      count=len(previously_synced_messages))
             account = Account.get(self.account_id, db_session)
             folder = Folder.get(self.folder_id, db_session)
+            message_objs = {}
+            saved_uids = []
+            for g_msgid_chunk in chunk(
+                    {m.g_msgid for m in previously_synced_messages}, 1000):
+                for message_obj in db_session.query(Message).filter(
+                        Message.namespace_id == self.namespace_id,
+                        Message.g_msgid.in_(g_msgid_chunk)).options(
+                            joinedload(Message.imapuids)):
+                    message_objs.setdefault(message_obj.g_msgid, message_obj)
             for raw_message in previously_synced_messages:
-                message_obj = db_session.query(Message).filter(
-                    Message.namespace_id == self.namespace_id,
-                    Message.g_msgid == raw_message.g_msgid).first()
+                message_obj = message_objs.get(raw_message.g_msgid)
                 if message_obj is None:
                     log.warning(
                         'Message disappeared while saving new uid',
                         g_msgid=raw_message.g_msgid,
                         uid=raw_message.uid)
-                    brand_new_messages.append(raw_message)
+                    if raw_message.body is None:
+                        self.redownload_uids.add(raw_message.uid)
+                    else:
+                        brand_new_messages.append(raw_message)
                     continue
                 already_have_uid = (
                     (raw_message.uid, self.folder_id) in
@@ -361,6 +406,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 if already_have_uid:
                     log.warning('Skipping existing UID for message',
                                 uid=raw_message.uid, message_id=message_obj.id)
+                    saved_uids.append(raw_message.uid)
                     continue
                 uid = ImapUid(account=account,
                               folder=folder,
@@ -370,7 +416,10 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 uid.update_labels(raw_message.g_labels)
                 common.update_message_metadata(
                     db_session, account, message_obj, uid.is_draft)
-                db_session.commit()
+                saved_uids.append(raw_message.uid)
+            db_session.commit()
+            # So that thread expansion doesn't fetch them again.
+            self.saved_uids.update(saved_uids)
 
         return brand_new_messages
 
@@ -388,10 +437,101 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 db_session, self.namespace_id, message_obj)
 
     def download_and_commit_uids(self, crispin_client, uids):
-        start = datetime.utcnow()
+        count = FolderSyncEngine.download_and_commit_uids(
+            self, crispin_client, uids)
+        return count + self.download_deleted_known_uids(crispin_client)
+
+    def download_deleted_known_uids(self, crispin_client):
+        """
+        Download and commit the messages that were deleted while we were
+        saving new UIDs for them, so that they're saved again, rather than
+        their UIDs never being saved.
+
+        """
+        if not self.redownload_uids:
+            return 0
+        uids = sorted(self.redownload_uids)
+        self.redownload_uids.clear()
+        log.info('Downloading messages deleted while saving new uids',
+                 count=len(uids))
         raw_messages = crispin_client.uids(uids)
         if not raw_messages:
-            return
+            return 0
+        return self.commit_uids(raw_messages, datetime.utcnow())
+
+    def fetch_uids(self, crispin_client, uids, metadata=None):
+        """
+        Download the raw messages with the given UIDs, except for the bodies
+        of messages that we've already saved under another label: for those,
+        only their flags and labels are fetched, and their raw messages have
+        a body of None.
+
+        `metadata` maps (some of) the UIDs to their GMetadata; it's fetched
+        for the others.
+
+        """
+        if metadata is None:
+            metadata = {}
+        missing_uids = [uid for uid in uids if uid not in metadata]
+        if missing_uids:
+            metadata.update(crispin_client.g_metadata(missing_uids))
+        known_uids, unknown_uids = self.split_known_uids(
+            [uid for uid in uids if uid in metadata], metadata)
+        raw_messages = self.fetch_known_uids(crispin_client, known_uids,
+                                             metadata)
+        if unknown_uids:
+            raw_messages.extend(crispin_client.uids(unknown_uids))
+        return sorted(raw_messages, key=lambda msg: msg.uid)
+
+    def split_known_uids(self, uids, metadata):
+        """
+        Split `uids` into the ones whose messages we've already saved (under
+        another label) and the others, by their X-GM-MSGIDs in `metadata`.
+
+        """
+        with session_scope(self.namespace_id) as db_session:
+            known_g_msgids = set(g_msgids(
+                self.namespace_id, db_session,
+                in_={metadata[uid].g_msgid for uid in uids}))
+        known_uids = []
+        unknown_uids = []
+        for uid in uids:
+            if metadata[uid].g_msgid in known_g_msgids:
+                known_uids.append(uid)
+            else:
+                unknown_uids.append(uid)
+        return known_uids, unknown_uids
+
+    def fetch_known_uids(self, crispin_client, uids, metadata):
+        """
+        Return raw messages without bodies for the given UIDs of messages
+        that we've already saved, with just their flags and labels.
+
+        """
+        if not uids:
+            return []
+        flags = crispin_client.flags(uids)
+        return [RawMessage(uid=long(uid), internaldate=None,
+                           flags=flags[uid].flags, body=None,
+                           g_thrid=long(metadata[uid].g_thrid),
+                           g_msgid=long(metadata[uid].g_msgid),
+                           g_labels=flags[uid].labels)
+                for uid in uids if uid in flags]
+
+    def parse_messages(self, raw_messages):
+        # Don't bother parsing messages we've already saved under another
+        # label; __deduplicate_message_object_creation() will just attach a
+        # new ImapUid to them at commit time.
+        with session_scope(self.namespace_id) as db_session:
+            existing_g_msgids = g_msgids(
+                self.namespace_id, db_session,
+                in_={msg.g_msgid for msg in raw_messages})
+        return FolderSyncEngine.parse_messages(
+            self, [msg for msg in raw_messages
+                   if msg.g_msgid not in existing_g_msgids])
+
+    def commit_uids(self, raw_messages, start, parsed_messages=None):
+        parsed_messages = parsed_messages or {}
         new_uids = set()
         with self.syncmanager_lock:
             with session_scope(self.namespace_id) as db_session:
@@ -404,9 +544,13 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
                 for msg in raw_messages:
                     uid = self.create_message(db_session, account, folder,
-                                              msg)
+                                              msg,
+                                              parsed_messages.get(msg.uid))
                     if uid is not None:
                         db_session.add(uid)
+                        update_contacts_from_messages(
+                            db_session, [uid.message], account.namespace,
+                            contact_cache(self.namespace_id))
                         db_session.commit()
                         new_uids.add(uid)
 
@@ -421,7 +565,31 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             self._report_first_message()
             self.is_first_message = False
 
-        self.saved_uids.update(new_uids)
+        self.saved_uids.update(uid.msg_uid for uid in new_uids)
+        return len(new_uids)
+
+    def build_thread_map(self, crispin_client, uids):
+        """
+        Map the X-GM-THRIDs of the given UIDs to the UIDs, so that threads
+        can be expanded without searching the folder. Returns None if there
+        are more than THREAD_MAP_MAX_UIDS of them.
+
+        """
+        if len(uids) > THREAD_MAP_MAX_UIDS:
+            return None
+        thread_map = {}
+        for uid_chunk in chunk(uids, 10000):
+            for uid, g_thrid in crispin_client.g_thrids(
+                    list(uid_chunk)).iteritems():
+                thread_map.setdefault(g_thrid, []).append(uid)
+        log.info('built thread map', uid_count=len(uids),
+                 thread_count=len(thread_map))
+        return thread_map
+
+    def thread_uids(self, crispin_client, g_thrid):
+        if self.thread_map is not None and g_thrid in self.thread_map:
+            return self.thread_map[g_thrid]
+        return crispin_client.expand_thread(g_thrid)
 
     def expand_uids_to_download(self, crispin_client, uids, metadata):
         # During Gmail initial sync, we expand threads: given a UID to
@@ -429,6 +597,8 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         # that you don't see incomplete thread views for the duration of the
         # sync. Given a 'seed set' of UIDs, this function returns a generator
         # which yields the 'expanded' set of UIDs to download.
+        # Threads are expanded THREAD_EXPANSION_LOOKAHEAD at a time, so that
+        # the metadata of their other UIDs is fetched together.
         thrids = OrderedDict()
         for uid in sorted(uids, reverse=True):
             g_thrid = metadata[uid].g_thrid
@@ -437,39 +607,60 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             else:
                 thrids[g_thrid] = [uid]
 
-        for g_thrid, uids in thrids.items():
-            g_msgid = metadata[uids[0]].g_msgid
-            # Because `uids` is ordered newest-to-oldest here, uids[0] is the
-            # last UID on the thread. If g_thrid is equal to its g_msgid, that
-            # means it's also the first UID on the thread. In that case, we can
-            # skip thread expansion for greater sync throughput.
-            if g_thrid != g_msgid:
-                uids = set(uids).union(crispin_client.expand_thread(g_thrid))
-                metadata.update(crispin_client.g_metadata(uids))
-            for uid in sorted(uids, reverse=True):
-                yield uid
+        for threads in chunk(thrids.items(), THREAD_EXPANSION_LOOKAHEAD):
+            expanded = []
+            missing_uids = set()
+            for g_thrid, uids in threads:
+                g_msgid = metadata[uids[0]].g_msgid
+                # Because `uids` is ordered newest-to-oldest here, uids[0] is
+                # the last UID on the thread. If g_thrid is equal to its
+                # g_msgid, that means it's also the first UID on the thread.
+                # In that case, we can skip thread expansion for greater sync
+                # throughput.
+                if g_thrid != g_msgid:
+                    uids = set(uids).union(
+                        self.thread_uids(crispin_client, g_thrid))
+                    missing_uids.update(uid for uid in uids
+                                        if uid not in metadata)
+                expanded.append(uids)
+            if missing_uids:
+                metadata.update(
+                    crispin_client.g_metadata(sorted(missing_uids)))
+            for uids in expanded:
+                for uid in sorted(uids, reverse=True):
+                    yield uid
 
     def batch_download_uids(self, crispin_client, uids, metadata,
                             max_download_bytes=MAX_DOWNLOAD_BYTES,
                             max_download_count=MAX_DOWNLOAD_COUNT):
-        expanded_pending_uids = self.expand_uids_to_download(
-            crispin_client, uids, metadata)
+        def batches():
+            # Consumed by the pipeline's fetch stage, so thread expansion
+            # (which also talks to the server) stays ahead of commits too.
+            expanded_pending_uids = self.expand_uids_to_download(
+                crispin_client, uids, metadata)
+            while True:
+                dl_size = 0
+                batch = []
+                while (dl_size < max_download_bytes and
+                       len(batch) < max_download_count):
+                    try:
+                        uid = expanded_pending_uids.next()
+                    except StopIteration:
+                        break
+                    batch.append(uid)
+                    if uid in metadata:
+                        dl_size += metadata[uid].size
+                if not batch:
+                    return
+                yield batch
+
         count = 0
-        while True:
-            dl_size = 0
-            batch = []
-            while (dl_size < max_download_bytes and
-                   len(batch) < max_download_count):
-                try:
-                    uid = expanded_pending_uids.next()
-                except StopIteration:
-                    break
-                batch.append(uid)
-                if uid in metadata:
-                    dl_size += metadata[uid].size
-            if not batch:
-                return
-            self.download_and_commit_uids(crispin_client, batch)
+
+        def fetch_uids(crispin_client, uids):
+            return self.fetch_uids(crispin_client, uids, metadata)
+
+        for batch in self.download_pipelined(crispin_client, batches(),
+                                             fetch_uids):
             self.heartbeat_status.publish()
             count += len(batch)
             if self.throttled and count >= THROTTLE_COUNT:
@@ -479,14 +670,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # Note this is an approx. limit since we use the #(uids),
                 # not the #(messages).
                 gevent.sleep(THROTTLE_WAIT)
-
-    @property
-    def throttled(self):
-        with session_scope(self.namespace_id) as db_session:
-            account = db_session.query(Account).get(self.account_id)
-            throttled = account.throttled
-
-        return throttled
+        self.download_deleted_known_uids(crispin_client)
 
 
 def g_msgids(namespace_id, session, in_):
@@ -11,22 +11,33 @@ Eventually we're going to want a better way of ACLing functions that operate on
 accounts.
 
 """
+import time
 from datetime import datetime
 
 from sqlalchemy import bindparam, desc
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import func
 
-from inbox.contacts.process_mail import update_contacts_from_message
-from inbox.models import Account, Message, Folder, ActionLog
-from inbox.models.backends.imap import ImapUid, ImapFolderInfo
+from inbox.config import config
+from inbox.models import (Account, Message, Folder, ActionLog, Label,
+                          MessageCategory)
+from inbox.models.backends.imap import ImapUid, ImapFolderInfo, LabelItem
 from inbox.models.session import session_scope
 from inbox.models.util import reconcile_message
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.util.itert import chunk
+from inbox.util.uidset import UIDSet
+from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 
 log = get_logger()
 
+# The number of expunged uids to remove per database transaction.
+DELETE_CHUNK_SIZE = config.get('IMAP_DELETE_CHUNK_SIZE', 100)
+# The number of saved uids to fetch from the database at a time.
+LOCAL_UIDS_BATCH_SIZE = 10000
+
 
 def local_uids(account_id, session, folder_id, limit=None):
     q = bakery(lambda session: session.query(ImapUid.msg_uid))
@@ -36,10 +47,16 @@ def local_uids(account_id, session, folder_id, limit=None):
     if limit:
         q += lambda q: q.order_by(desc(ImapUid.msg_uid))
         q += lambda q: q.limit(bindparam('limit'))
-    results = q(session).params(account_id=account_id,
-                                folder_id=folder_id,
-                                limit=limit).all()
-    return {u for u, in results}
+        results = q(session).params(account_id=account_id,
+                                    folder_id=folder_id,
+                                    limit=limit).all()
+        return UIDSet([u for u, in reversed(results)])
+    # Stream the UIDs in order, so that they go straight into the UIDSet's
+    # ranges rather than into a list first.
+    q += lambda q: q.order_by(ImapUid.msg_uid)
+    q += lambda q: q.yield_per(LOCAL_UIDS_BATCH_SIZE)
+    results = q(session).params(account_id=account_id, folder_id=folder_id)
+    return UIDSet.from_sorted(u for u, in results)
 
 
 def lastseenuid(account_id, session, folder_id):
@@ -52,6 +69,15 @@ def lastseenuid(account_id, session, folder_id):
     return res or 0
 
 
+def local_uid_count(account_id, session, folder_id):
+    q = bakery(lambda session: session.query(func.count(ImapUid.id)))
+    q += lambda q: q.filter(
+        ImapUid.account_id == bindparam('account_id'),
+        ImapUid.folder_id == bindparam('folder_id'))
+    return q(session).params(account_id=account_id,
+                             folder_id=folder_id).one()[0]
+
+
 def update_message_metadata(session, account, message, is_draft):
     # Update the message's metadata.
     uids = message.imapuids
@@ -80,6 +106,9 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
     """
     Update flags and labels (the only metadata that can change).
 
+    All of the given uids are updated in a single database transaction, so
+    callers should pass them in reasonably-sized batches.
+
     Make sure you're holding a db write lock on the account. (We don't try
     to grab the lock in here in case the caller needs to put higher-level
     functionality in the lock.)
@@ -88,12 +117,17 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
     if not new_flags:
         return
 
+    start = time.time()
     account = Account.get(account_id, session)
-    change_count = 0
-    for item in session.query(ImapUid).filter(
-            ImapUid.account_id == account_id,
-            ImapUid.msg_uid.in_(new_flags.keys()),
-            ImapUid.folder_id == folder_id):
+    imapuids = session.query(ImapUid).filter(
+        ImapUid.account_id == account_id,
+        ImapUid.msg_uid.in_(new_flags.keys()),
+        ImapUid.folder_id == folder_id).options(
+            subqueryload(ImapUid.labelitems).joinedload(LabelItem.label).
+            joinedload(Label.category)).all()
+
+    changed_items = []
+    for item in imapuids:
         flags = new_flags[item.msg_uid].flags
         labels = getattr(new_flags[item.msg_uid], 'labels', None)
 
@@ -104,11 +138,25 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
             changed = True
 
         if changed:
-            change_count += 1
+            changed_items.append(item)
+
+    change_count = len(changed_items)
+    if changed_items:
+        # Load the changed messages and the rest of their metadata up front,
+        # rather than lazily one message at a time below.
+        _load_message_metadata(session,
+                               {item.message_id for item in changed_items})
+        for item in changed_items:
             is_draft = item.is_draft and (folder_role == 'drafts' or
                                           folder_role == 'all')
             update_message_metadata(session, account, item.message, is_draft)
-            session.commit()
+        session.commit()
+
+    if imapuids:
+        # Throughput is the rows counter's rate over the summed latencies.
+        statsd_client.timing('mailsync.update_metadata.latency',
+                             (time.time() - start) * 1000)
+        statsd_client.incr('mailsync.update_metadata.rows', len(imapuids))
     log.info('Updated UID metadata', changed=change_count,
              out_of=len(new_flags))
 
@@ -123,27 +171,35 @@ def remove_deleted_uids(account_id, folder_id, uids):
     if not uids:
         return
     deleted_uid_count = 0
-    for uid in uids:
-        # We do this one-uid-at-a-time because issuing many deletes within a
+    for uid_chunk in chunk(UIDSet(uids), DELETE_CHUNK_SIZE):
+        # We commit once per chunk of uids. Issuing many deletes within a
         # single database transaction is problematic. But loading many
         # objects into a session and then frequently calling commit() is also
         # bad, because expiring objects and checking for revisions is O(number
         # of objects in session), resulting in quadratic runtimes.
-        # Performance could perhaps be additionally improved by choosing a
-        # sane balance, e.g., operating on 10 or 100 uids or something at once.
         with session_scope(account_id) as db_session:
-            imapuid = db_session.query(ImapUid).filter(
+            imapuids = db_session.query(ImapUid).filter(
                 ImapUid.account_id == account_id,
                 ImapUid.folder_id == folder_id,
-                ImapUid.msg_uid == uid).first()
-            if imapuid is None:
+                ImapUid.msg_uid.in_(uid_chunk)).options(
+                    joinedload(ImapUid.message),
+                    subqueryload(ImapUid.labelitems)).all()
+            if not imapuids:
                 continue
-            deleted_uid_count += 1
-            message = imapuid.message
-
-            db_session.delete(imapuid)
-
-            if message is not None:
+            deleted_uid_count += len(imapuids)
+            messages = {imapuid.message_id: imapuid.message
+                        for imapuid in imapuids
+                        if imapuid.message is not None}
+
+            for imapuid in imapuids:
+                db_session.delete(imapuid)
+            # Flush the deletes, so that loading the messages' remaining uids
+            # below doesn't return them.
+            db_session.flush()
+            _load_message_metadata(db_session, messages.keys())
+
+            account = Account.get(account_id, db_session)
+            for message in messages.itervalues():
                 if not message.imapuids and message.is_draft:
                     # Synchronously delete drafts.
                     thread = message.thread
@@ -153,7 +209,6 @@ def remove_deleted_uids(account_id, folder_id, uids):
                     if thread is not None and not thread.messages:
                         db_session.delete(thread)
                 else:
-                    account = Account.get(account_id, db_session)
                     update_message_metadata(db_session, account, message,
                                             message.is_draft)
                     if not message.imapuids:
@@ -165,6 +220,26 @@ def remove_deleted_uids(account_id, folder_id, uids):
     log.info('Deleted expunged UIDs', count=deleted_uid_count)
 
 
+def _load_message_metadata(session, message_ids):
+    """
+    Load the given messages along with everything update_message_metadata()
+    needs (their uids, the uids' categories and the messages' current
+    categories), in a fixed number of queries rather than several per
+    message.
+
+    """
+    if not message_ids:
+        return []
+    return session.query(Message).filter(
+        Message.id.in_(message_ids)).options(
+            subqueryload(Message.imapuids).subqueryload(ImapUid.labelitems).
+            joinedload(LabelItem.label).joinedload(Label.category),
+            subqueryload(Message.imapuids).joinedload(ImapUid.folder).
+            joinedload(Folder.category),
+            subqueryload(Message.messagecategories).
+            joinedload(MessageCategory.category)).all()
+
+
 def get_folder_info(account_id, session, folder_name):
     try:
         # using .one() here may catch duplication bugs
@@ -175,10 +250,16 @@ def get_folder_info(account_id, session, folder_name):
         return None
 
 
-def create_imap_message(db_session, account, folder, msg):
+def create_imap_message(db_session, account, folder, msg, new_message=None):
     """
     IMAP-specific message creation logic.
 
+    If `new_message` is given, it must be the (uncommitted) result of parsing
+    `msg` with Message.create_from_synced(); otherwise `msg` is parsed here.
+
+    The message's contacts aren't updated, so that callers can update those
+    of a whole batch of messages at once with update_contacts_from_messages().
+
     Returns
     -------
     imapuid : inbox.models.backends.imap.ImapUid
@@ -186,10 +267,10 @@ def create_imap_message(db_session, account, folder, msg):
         relationships. All new objects are uncommitted.
 
     """
-    new_message = Message.create_from_synced(account=account, mid=msg.uid,
-                                             folder_name=folder.name,
-                                             received_date=msg.internaldate,
-                                             body_string=msg.body)
+    if new_message is None:
+        new_message = Message.create_from_synced(
+            account=account, mid=msg.uid, folder_name=folder.name,
+            received_date=msg.internaldate, body_string=msg.body)
 
     # Check to see if this is a copy of a message that was first created
     # by the Nylas API. If so, don't create a new object; just use the old one.
@@ -209,8 +290,6 @@ def create_imap_message(db_session, account, folder, msg):
                                          folder.canonical_name == 'all')
         update_message_metadata(db_session, account, new_message, is_draft)
 
-    update_contacts_from_message(db_session, new_message, account.namespace)
-
     return imapuid
 
 
@@ -64,6 +64,7 @@ from __future__ import division
 
 from datetime import datetime, timedelta
 from gevent import Greenlet
+from gevent.queue import Queue
 import gevent
 import imaplib
 from sqlalchemy import func
@@ -72,11 +73,14 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.basicauth import ValidationError
+from inbox.contacts.process_mail import (contact_cache,
+                                         update_contacts_from_messages)
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.debug import bind_context
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
-from inbox.util.threading import fetch_corresponding_thread, MAX_THREAD_LENGTH
+from inbox.util.uidset import UIDSet
+from inbox.util.threading import threading_index, MAX_THREAD_LENGTH
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
@@ -86,6 +90,7 @@ from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapThread,
                                         ImapUid, ImapFolderInfo)
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.imap import common
+from inbox.mailsync.parser import get_parser_pool
 from inbox.mailsync.backends.base import (MailsyncDone, MailsyncError,
                                           THROTTLE_COUNT, THROTTLE_WAIT)
 from inbox.heartbeat.store import HeartbeatStatusProxy
@@ -109,6 +114,22 @@ MAX_UIDINVALID_RESYNCS = 5
 
 CONDSTORE_FLAGS_REFRESH_BATCH_SIZE = 200
 
+# Without QRESYNC, the only way to find out which messages were expunged is to
+# compare all of a folder's UIDs with the ones we've saved, which is expensive
+# on big folders. So unless the folder's message count shows that messages
+# were expunged, CONDSTORE servers only get that comparison this often.
+EXPUNGE_CHECK_INTERVAL = timedelta(seconds=600)
+
+# Bounds on a single batched body FETCH during initial sync. Message sizes are
+# pre-scanned via RFC822.SIZE so that a batch stays roughly under
+# MAX_DOWNLOAD_BYTES (a single oversized message still gets its own batch).
+MAX_DOWNLOAD_BYTES = 2 ** 20
+MAX_DOWNLOAD_COUNT = 50
+
+# Maximum number of batches buffered between consecutive stages of the download
+# pipeline (fetch -> parse -> commit).
+DOWNLOAD_PIPELINE_DEPTH = 2
+
 
 class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
@@ -146,6 +167,7 @@ class FolderSyncEngine(Greenlet):
         self.state = None
         self.provider_name = provider_name
         self.last_fast_refresh = None
+        self.last_expunge_check = None
         self.flags_fetch_results = {}
         self.conn_pool = connection_pool(self.account_id)
 
@@ -343,13 +365,10 @@ class FolderSyncEngine(Greenlet):
                     local_uids = common.local_uids(self.account_id, db_session,
                                                    self.folder_id)
                 common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids).difference(remote_uids))
+                    self.account_id, self.folder_id, local_uids - remote_uids)
 
-            new_uids = set(remote_uids).difference(local_uids)
+            new_uids = remote_uids - local_uids
             with session_scope(self.namespace_id) as db_session:
-                account = db_session.query(Account).get(self.account_id)
-                throttled = account.throttled
                 self.update_uid_counts(
                     db_session,
                     remote_uid_count=len(remote_uids),
@@ -359,21 +378,14 @@ class FolderSyncEngine(Greenlet):
             change_poller = gevent.spawn(self.poll_for_changes)
             bind_context(change_poller, 'changepoller', self.account_id,
                          self.folder_id)
-            uids = sorted(new_uids, reverse=True)
-            count = 0
-            for uid in uids:
-                # The speedup from batching appears to be less clear for
-                # non-Gmail accounts, so for now just download one-at-a-time.
-                self.download_and_commit_uids(crispin_client, [uid])
-                self.heartbeat_status.publish()
-                count += 1
-                if throttled and count >= THROTTLE_COUNT:
-                    # Throttled accounts' folders sync at a rate of
-                    # 1 message/ minute, after the first approx. THROTTLE_COUNT
-                    # messages per folder are synced.
-                    # Note this is an approx. limit since we use the #(uids),
-                    # not the #(messages).
-                    gevent.sleep(THROTTLE_WAIT)
+            for uids in chunk(reversed(new_uids), 1024):
+                # Pre-scan message sizes so that we can download in batches
+                # of bounded size. UIDs might have been expunged since sync
+                # started, in which case we won't get a size back for them;
+                # we can omit such UIDs.
+                sizes = crispin_client.sizes(uids)
+                uids = [u for u in uids if u in sizes]
+                self.batch_download_uids(crispin_client, uids, sizes)
         finally:
             if change_poller is not None:
                 # schedule change_poller to die
@@ -452,7 +464,8 @@ class FolderSyncEngine(Greenlet):
             log.debug('polling for changes')
             self.poll_impl()
 
-    def create_message(self, db_session, acct, folder, msg):
+    def create_message(self, db_session, acct, folder, msg,
+                       new_message=None):
         assert acct is not None and acct.namespace is not None
 
         # Check if we somehow already saved the imapuid (shouldn't happen, but
@@ -472,10 +485,12 @@ class FolderSyncEngine(Greenlet):
             log.warning('Server returned a message with an empty body.')
             return None
 
-        new_uid = common.create_imap_message(db_session, acct, folder, msg)
+        new_uid = common.create_imap_message(db_session, acct, folder, msg,
+                                             new_message)
         self.add_message_to_thread(db_session, new_uid.message, msg)
 
         db_session.flush()
+        threading_index(self.namespace_id).add(new_uid.message)
 
         # We're calling import_attached_events here instead of some more
         # obvious place (like Message.create_from_synced) because the function
@@ -511,8 +526,9 @@ class FolderSyncEngine(Greenlet):
         with db_session.no_autoflush:
             # Disable autoflush so we don't try to flush a message with null
             # thread_id.
-            parent_thread = fetch_corresponding_thread(
-                db_session, self.namespace_id, message_obj)
+            parent_thread = threading_index(
+                self.namespace_id).fetch_corresponding_thread(db_session,
+                                                              message_obj)
             construct_new_thread = True
 
             if parent_thread:
@@ -531,22 +547,37 @@ class FolderSyncEngine(Greenlet):
 
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        raw_messages = self.fetch_uids(crispin_client, uids)
         if not raw_messages:
             return 0
+        return self.commit_uids(raw_messages, start)
+
+    def fetch_uids(self, crispin_client, uids):
+        """Download the raw messages with the given UIDs."""
+        return crispin_client.uids(uids)
 
+    def commit_uids(self, raw_messages, start, parsed_messages=None):
+        parsed_messages = parsed_messages or {}
         new_uids = set()
         with self.syncmanager_lock:
             with session_scope(self.namespace_id) as db_session:
                 account = Account.get(self.account_id, db_session)
                 folder = Folder.get(self.folder_id, db_session)
+                new_messages = []
                 for msg in raw_messages:
                     uid = self.create_message(db_session, account,
-                                              folder, msg)
+                                              folder, msg,
+                                              parsed_messages.get(msg.uid))
                     if uid is not None:
                         db_session.add(uid)
                         db_session.flush()
                         new_uids.add(uid)
+                        new_messages.append(uid.message)
+                # Create the batch's contacts together, rather than looking
+                # them up for each message.
+                update_contacts_from_messages(
+                    db_session, new_messages, account.namespace,
+                    contact_cache(self.namespace_id))
                 db_session.commit()
 
         log.debug('Committed new UIDs', new_committed_message_count=len(new_uids))
@@ -560,6 +591,142 @@ class FolderSyncEngine(Greenlet):
 
         return len(new_uids)
 
+    def batch_download_uids(self, crispin_client, uids, sizes,
+                            max_download_bytes=MAX_DOWNLOAD_BYTES,
+                            max_download_count=MAX_DOWNLOAD_COUNT):
+        throttled = self.throttled
+        # Shared with the batches() generator, which is consumed by the
+        # pipeline's fetch stage.
+        count = [0]
+
+        def batches():
+            pending_uids = iter(uids)
+            while True:
+                limit = max_download_count
+                if throttled and count[0] >= THROTTLE_COUNT:
+                    # Don't let batching defeat the throttling rate below.
+                    limit = 1
+                dl_size = 0
+                batch = []
+                while dl_size < max_download_bytes and len(batch) < limit:
+                    try:
+                        uid = pending_uids.next()
+                    except StopIteration:
+                        break
+                    batch.append(uid)
+                    dl_size += sizes.get(uid, 0)
+                if not batch:
+                    return
+                yield batch
+
+        for batch in self.download_pipelined(crispin_client, batches()):
+            self.heartbeat_status.publish()
+            count[0] += len(batch)
+            if throttled and count[0] >= THROTTLE_COUNT:
+                # Throttled accounts' folders sync at a rate of
+                # 1 message/ minute, after the first approx. THROTTLE_COUNT
+                # messages per folder are synced.
+                # Note this is an approx. limit since we use the #(uids),
+                # not the #(messages).
+                gevent.sleep(THROTTLE_WAIT)
+
+    def download_pipelined(self, crispin_client, batches, fetch_uids=None):
+        """
+        Download and commit `batches` (an iterable of lists of UIDs) in a
+        three-stage pipeline: a fetch greenlet keeps the next FETCH in flight
+        and a parse greenlet turns raw messages into uncommitted Message
+        objects, while the calling greenlet commits the previous batch.
+
+        The stages are connected by queues of size DOWNLOAD_PIPELINE_DEPTH, so
+        the fetch and parse stages can never get more than a couple of batches
+        ahead of the commit stage. Batches are committed one transaction at a
+        time in the order they were fetched -- exactly as if
+        download_and_commit_uids() were called for each batch in turn -- so
+        restarting sync at any point is just as safe as it is without the
+        pipeline.
+
+        Each batch's raw messages are downloaded with
+        `fetch_uids(crispin_client, batch)`, or self.fetch_uids() by default.
+
+        Yields each batch after it has been committed.
+
+        """
+        fetched = Queue(DOWNLOAD_PIPELINE_DEPTH)
+        parsed = Queue(DOWNLOAD_PIPELINE_DEPTH)
+        fetcher = gevent.spawn(_run_pipeline_stage, self._fetch_stage,
+                               fetched, crispin_client, batches,
+                               fetch_uids or self.fetch_uids)
+        bind_context(fetcher, 'downloadfetcher', self.account_id,
+                     self.folder_id)
+        parser = gevent.spawn(_run_pipeline_stage, self._parse_stage,
+                              parsed, fetched)
+        bind_context(parser, 'downloadparser', self.account_id,
+                     self.folder_id)
+        try:
+            for batch, start, raw_messages, parsed_messages in parsed:
+                if raw_messages:
+                    self.commit_uids(raw_messages, start, parsed_messages)
+                yield batch
+            # The parse stage finished, but possibly only because a stage
+            # failed: if so, re-raise its error here.
+            for stage in (parser, fetcher):
+                stage.get()
+        finally:
+            gevent.killall([fetcher, parser])
+
+    def _fetch_stage(self, out, crispin_client, batches, fetch_uids):
+        for batch in batches:
+            start = datetime.utcnow()
+            raw_messages = fetch_uids(crispin_client, batch)
+            out.put((batch, start, raw_messages))
+
+    def _parse_stage(self, out, fetched):
+        for batch, start, raw_messages in fetched:
+            parsed_messages = {}
+            if raw_messages:
+                parsed_messages = self.parse_messages(raw_messages)
+            out.put((batch, start, raw_messages, parsed_messages))
+
+    def parse_messages(self, raw_messages):
+        """
+        Parse raw messages ahead of committing them. Returns a dict mapping
+        UIDs to new, uncommitted Message objects; create_message() parses any
+        raw message that doesn't have an entry in it.
+
+        If a MessageParserPool is configured, the MIME parsing happens in its
+        worker processes, and only turning the results into Message objects
+        happens here.
+
+        """
+        raw_messages = [msg for msg in raw_messages if msg.body is not None]
+        parser_pool = get_parser_pool()
+        if parser_pool is not None:
+            results = parser_pool.parse_all(
+                [(self.account_id, msg.uid, self.folder_name, msg.internaldate,
+                  msg.body) for msg in raw_messages])
+
+        parsed_messages = {}
+        with session_scope(self.namespace_id) as db_session:
+            account = Account.get(self.account_id, db_session)
+            for i, msg in enumerate(raw_messages):
+                if parser_pool is not None:
+                    parsed_messages[msg.uid] = Message.create_from_parsed(
+                        account, results[i])
+                else:
+                    parsed_messages[msg.uid] = Message.create_from_synced(
+                        account=account, mid=msg.uid,
+                        folder_name=self.folder_name,
+                        received_date=msg.internaldate, body_string=msg.body)
+        return parsed_messages
+
+    @property
+    def throttled(self):
+        with session_scope(self.namespace_id) as db_session:
+            account = db_session.query(Account).get(self.account_id)
+            throttled = account.throttled
+
+        return throttled
+
     def _report_first_message(self):
         # Only record the "time to first message" in the inbox. Because users
         # can add more folders at any time, "initial sync"-style metrics for
@@ -660,10 +827,10 @@ class FolderSyncEngine(Greenlet):
         log.debug('HIGHESTMODSEQ has changed, getting changed UIDs',
                   new_highestmodseq=new_highestmodseq,
                   saved_highestmodseq=self.highestmodseq)
-        crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        changed_flags = crispin_client.condstore_changed_flags(
+        select_info = crispin_client.select_folder(self.folder_name,
+                                                   self.uidvalidity_cb)
+        changed_flags, vanished_uids = crispin_client.condstore_changes(
             self.highestmodseq)
-        remote_uids = crispin_client.all_uids()
 
         # In order to be able to sync changes to tens of thousands of flags at
         # once, we commit updates in batches. We do this in ascending order by
@@ -685,10 +852,21 @@ class FolderSyncEngine(Greenlet):
                 interim_highestmodseq = max(v.modseq for k, v in flag_batch)
                 self.highestmodseq = interim_highestmodseq
 
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(self.account_id, db_session,
-                                           self.folder_id)
-            expunged_uids = set(local_uids).difference(remote_uids)
+        if vanished_uids is not None:
+            expunged_uids = UIDSet()
+            if vanished_uids:
+                with session_scope(self.namespace_id) as db_session:
+                    expunged_uids = vanished_uids & common.local_uids(
+                        self.account_id, db_session, self.folder_id)
+        elif self.expunge_check_due(select_info):
+            remote_uids = crispin_client.all_uids()
+            with session_scope(self.namespace_id) as db_session:
+                local_uids = common.local_uids(self.account_id, db_session,
+                                               self.folder_id)
+            expunged_uids = local_uids - remote_uids
+            self.last_expunge_check = datetime.utcnow()
+        else:
+            expunged_uids = UIDSet()
 
         if expunged_uids:
             # If new UIDs have appeared since we last checked in
@@ -698,13 +876,33 @@ class FolderSyncEngine(Greenlet):
             with session_scope(self.namespace_id) as db_session:
                 lastseenuid = common.lastseenuid(self.account_id, db_session,
                                                  self.folder_id)
-            if remote_uids and lastseenuid < max(remote_uids):
+            uidnext = select_info.get('UIDNEXT')
+            if uidnext is None or lastseenuid + 1 < uidnext:
                 log.info('Downloading new UIDs before expunging')
                 self.get_new_uids(crispin_client)
             common.remove_deleted_uids(self.account_id, self.folder_id,
                                        expunged_uids)
         self.highestmodseq = new_highestmodseq
 
+    def expunge_check_due(self, select_info):
+        """
+        Whether to compare all of the folder's UIDs with the ones we've saved,
+        to find the expunged ones, on a server without QRESYNC.
+
+        """
+        if (self.last_expunge_check is None or
+                datetime.utcnow() > self.last_expunge_check +
+                EXPUNGE_CHECK_INTERVAL):
+            return True
+        # If the server has fewer messages than we've saved (having just
+        # fetched new ones), some of them must have been expunged.
+        exists = select_info.get('EXISTS')
+        if exists is None:
+            return False
+        with session_scope(self.namespace_id) as db_session:
+            return exists < common.local_uid_count(self.account_id, db_session,
+                                                   self.folder_id)
+
     def generic_refresh_flags(self, crispin_client):
         now = datetime.utcnow()
         slow_refresh_due = (
@@ -740,7 +938,7 @@ class FolderSyncEngine(Greenlet):
             return
         log.debug('Changed flags refresh response, persisting changes',
                   max_uids=max_uids)
-        expunged_uids = set(local_uids).difference(flags.keys())
+        expunged_uids = local_uids - UIDSet(flags)
         common.remove_deleted_uids(self.account_id, self.folder_id,
                                    expunged_uids)
         with session_scope(self.namespace_id) as db_session:
@@ -836,6 +1034,24 @@ class FolderSyncEngine(Greenlet):
         return select_info
 
 
+def _run_pipeline_stage(stage, out, *args):
+    """
+    Run a download pipeline stage, then tell the next stage that there's no
+    more input. If the stage fails, the next stage still gets told, so that
+    the error can be re-raised from the consumer via Greenlet.get().
+
+    """
+    try:
+        stage(out, *args)
+    except gevent.GreenletExit:
+        # The consumer killed us; nobody is listening anymore.
+        raise
+    except Exception:
+        out.put(StopIteration)
+        raise
+    out.put(StopIteration)
+
+
 class UidInvalid(Exception):
     """Raised when a folder's UIDVALIDITY changes, requiring a resync."""
     pass
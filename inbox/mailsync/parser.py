@@ -0,0 +1,285 @@
+"""
+Out-of-process MIME parsing.
+
+Parsing MIME is CPU-bound, and since every sync greenlet in a process shares a
+single core, one huge or pathological message stalls all the other accounts
+syncing in that process while it is parsed. The MessageParserPool instead runs
+parse_message() in a pool of worker processes, which the calling greenlet
+waits on cooperatively.
+
+Each message is parsed under a CPU time limit (enforced by the worker itself)
+and a wall-clock time limit (enforced by killing the worker). Messages that
+exceed either, or that crash their worker, are returned as unparseable, so
+that the sync marks them with a decode error instead of hanging.
+
+The pool is configured with:
+
+MESSAGE_PARSER_PROCESSES: the number of worker processes. If 0 (the
+    default), messages are parsed in-process.
+MESSAGE_PARSER_CPU_LIMIT: the CPU seconds a worker may spend on one message.
+MESSAGE_PARSER_TIMEOUT: the wall-clock seconds a worker may spend on one
+    message.
+
+"""
+import os
+import sys
+import signal
+import struct
+import traceback
+import cPickle as pickle
+from hashlib import sha256
+
+import gevent
+from gevent import subprocess
+from gevent.queue import Queue
+
+from inbox.config import config
+from inbox.models.message import ParsedMessage
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+DEFAULT_CPU_LIMIT = 10
+DEFAULT_TIMEOUT = 30
+
+_HEADER = struct.Struct('!I')
+_READY = 'ready'
+
+_pool = None
+
+
+class ParserError(Exception):
+    """
+    Raised when a worker process can't be started, or when parsing a message
+    fails in a way that would also have raised if it were parsed in-process.
+
+    """
+    pass
+
+
+class _CPULimitExceeded(BaseException):
+    # A BaseException, so that the message parser's own error handling
+    # doesn't swallow it.
+    pass
+
+
+def get_parser_pool():
+    """
+    Return this process's MessageParserPool, or None if messages should be
+    parsed in-process.
+
+    """
+    global _pool
+    processes = config.get('MESSAGE_PARSER_PROCESSES', 0)
+    if not processes:
+        return None
+    if _pool is None:
+        _pool = MessageParserPool(
+            processes,
+            cpu_limit=config.get('MESSAGE_PARSER_CPU_LIMIT',
+                                 DEFAULT_CPU_LIMIT),
+            timeout=config.get('MESSAGE_PARSER_TIMEOUT', DEFAULT_TIMEOUT))
+    return _pool
+
+
+def unparseable_message(received_date, body_string):
+    """
+    The ParsedMessage for a message that couldn't be parsed at all:
+    Message.create_from_parsed() marks it with a decode error.
+
+    """
+    fields = {}
+    if received_date:
+        fields['received_date'] = received_date.replace(microsecond=0)
+    return ParsedMessage(data_sha256=sha256(body_string).hexdigest(),
+                         fields=fields, parts=[], decode_error=True)
+
+
+class MessageParserPool(object):
+    """
+    A pool of `size` parser worker processes. Workers are started lazily, and
+    restarted after they're killed or crash.
+
+    """
+
+    def __init__(self, size, cpu_limit=DEFAULT_CPU_LIMIT,
+                 timeout=DEFAULT_TIMEOUT):
+        self.size = size
+        self.cpu_limit = cpu_limit
+        self.timeout = timeout
+        # Idle workers; None stands for a worker that hasn't been started.
+        self._workers = Queue()
+        for _ in range(size):
+            self._workers.put(None)
+
+    def parse(self, account_id, mid, folder_name, received_date, body_string):
+        """
+        Like inbox.models.message.parse_message(), but parses the message in
+        a worker process. Blocks (cooperatively) until a worker is free.
+
+        """
+        worker = self._workers.get()
+        try:
+            if worker is None:
+                worker = _Worker(self.cpu_limit)
+            timeout = gevent.Timeout(self.timeout)
+            timeout.start()
+            try:
+                status, result = worker.request(
+                    (account_id, mid, folder_name, received_date, body_string))
+            except gevent.Timeout as e:
+                if e is not timeout:
+                    raise
+                status, result = 'timeout', None
+            finally:
+                timeout.cancel()
+        except (IOError, OSError, EOFError) as e:
+            # The worker died -- possibly killed by the OS for using too much
+            # memory on this message.
+            status, result = 'crashed', e
+        except BaseException:
+            # We may have left the worker half-way through a request.
+            if worker is not None:
+                worker.kill()
+            self._workers.put(None)
+            raise
+
+        if status == 'ok':
+            self._workers.put(worker)
+            return result
+
+        if status == 'error':
+            self._workers.put(worker)
+            raise ParserError(result)
+
+        if status != 'cpu_limit':
+            # The worker is wedged or gone; replace it.
+            worker.kill()
+            worker = None
+        self._workers.put(worker)
+        log.error('Message parsing failed', reason=status, error=result,
+                  account_id=account_id, folder_name=folder_name, mid=mid,
+                  size=len(body_string))
+        statsd_client.incr('mailsync.message_parser.{}'.format(status))
+        return unparseable_message(received_date, body_string)
+
+    def parse_all(self, requests):
+        """
+        Parse a list of (account_id, mid, folder_name, received_date,
+        body_string) tuples on as many workers as are free. Returns the
+        ParsedMessages in the same order.
+
+        """
+        greenlets = [gevent.spawn(self.parse, *args) for args in requests]
+        try:
+            gevent.joinall(greenlets, raise_error=True)
+        finally:
+            gevent.killall(greenlets)
+        return [g.value for g in greenlets]
+
+    def close(self):
+        """
+        Wait for in-flight requests to finish, then stop all the worker
+        processes. The pool can still be used afterwards; workers are started
+        again as needed.
+
+        """
+        workers = [self._workers.get() for _ in range(self.size)]
+        try:
+            for worker in workers:
+                if worker is not None:
+                    worker.kill()
+        finally:
+            for _ in workers:
+                self._workers.put(None)
+
+
+class _Worker(object):
+
+    def __init__(self, cpu_limit):
+        # Make sure the worker can import us however we were imported.
+        package_root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [package_root, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'inbox.mailsync.parser', str(cpu_limit)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+            env=env)
+        try:
+            ready = _read_frame(self.process.stdout)
+        except (IOError, OSError):
+            ready = None
+        if ready != _READY:
+            self.kill()
+            raise ParserError('Message parser worker failed to start')
+
+    def request(self, args):
+        _write_frame(self.process.stdin, pickle.dumps(args,
+                                                      pickle.HIGHEST_PROTOCOL))
+        response = _read_frame(self.process.stdout)
+        if response is None:
+            raise EOFError('Message parser worker exited')
+        return pickle.loads(response)
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+def _read_frame(f):
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    length, = _HEADER.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        return None
+    return data
+
+
+def _write_frame(f, data):
+    f.write(_HEADER.pack(len(data)))
+    f.write(data)
+    f.flush()
+
+
+def _cpu_limit_exceeded(signum, frame):
+    raise _CPULimitExceeded()
+
+
+def _worker_main(cpu_limit):
+    # The parent reads responses from our stdout, so make sure nothing else
+    # (like logging) writes there.
+    requests, responses = sys.stdin, sys.stdout
+    sys.stdout = sys.stderr
+
+    from inbox.models.message import parse_message
+
+    signal.signal(signal.SIGPROF, _cpu_limit_exceeded)
+    _write_frame(responses, _READY)
+    while True:
+        request = _read_frame(requests)
+        if request is None:
+            # The parent went away.
+            return
+        args = pickle.loads(request)
+        signal.setitimer(signal.ITIMER_PROF, cpu_limit)
+        try:
+            response = ('ok', parse_message(*args))
+        except _CPULimitExceeded:
+            response = ('cpu_limit', None)
+        except Exception:
+            response = ('error', traceback.format_exc())
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        _write_frame(responses, pickle.dumps(response,
+                                             pickle.HIGHEST_PROTOCOL))
+
+
+if __name__ == '__main__':
+    _worker_main(float(sys.argv[1]))
@@ -1,4 +1,4 @@
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 from datetime import datetime, timedelta
 from random import shuffle
 
@@ -15,6 +15,7 @@ from inbox.models.backends.oauth import OAuthAccount
 from inbox.models.base import MailSyncBase
 from inbox.models.secret import Secret
 from inbox.models.mixins import UpdatedAtMixin, DeletedAtMixin
+from inbox.util.token_cache import get_token_cache
 
 from nylas.logging import get_logger
 log = get_logger()
@@ -24,6 +25,8 @@ PROVIDER = 'gmail'
 GOOGLE_CALENDAR_SCOPE = 'https://www.googleapis.com/auth/calendar'
 GOOGLE_EMAIL_SCOPE = 'https://mail.google.com/'
 GOOGLE_CONTACTS_SCOPE = 'https://www.google.com/m8/feeds'
+GOOGLE_SCOPES = [GOOGLE_EMAIL_SCOPE, GOOGLE_CALENDAR_SCOPE,
+                 GOOGLE_CONTACTS_SCOPE]
 
 
 # Google token named tuple - only used in this file.
@@ -43,24 +46,26 @@ class GTokenManager(object):
 
     """
 
-    def __init__(self):
-        self._tokens = defaultdict(dict)
-
     def _get_token(self, account, scope, force_refresh=False):
-        if not force_refresh:
-            try:
-                gtoken = self._tokens[account.id][scope]
-                if datetime.utcnow() < gtoken.expiration:
-                    return gtoken
-            except KeyError:
-                pass
-
+        def new_token():
+            gtoken = self._new_token(account, scope)
+            # The token is good for its credentials' other scopes too.
+            for other_scope in GOOGLE_SCOPES:
+                if other_scope != scope and other_scope in gtoken.scopes:
+                    self.cache_token_for_scope(account, other_scope, gtoken)
+            return _gtoken_value(gtoken), gtoken.expiration
+
+        token = get_token_cache().get(self._cache_key(account, scope),
+                                      new_token, force_refresh=force_refresh)
+        return _gtoken(token)
+
+    def _new_token(self, account, scope, client_ids=None):
         # If we find invalid GmailAuthCredentials while trying to
         # get a new token, we mark them as invalid. We want to make
         # sure we commit those changes to the database before we
         # actually throw an error.
         try:
-            gtoken = account.new_token(scope)
+            return account.new_token(scope, client_ids=client_ids)
         except (ConnectionError, OAuthError):
             if object_session(account):
                 object_session(account).commit()
@@ -70,9 +75,6 @@ class GTokenManager(object):
                     db_session.commit()
             raise
 
-        self.cache_token(account, gtoken)
-        return gtoken
-
     def get_token(self, account, scope, force_refresh=False):
         gtoken = self._get_token(account, scope, force_refresh=force_refresh)
         return gtoken.value
@@ -97,11 +99,17 @@ class GTokenManager(object):
             account, GOOGLE_CONTACTS_SCOPE, force_refresh)
 
     def cache_token(self, account, gtoken):
-        for scope in gtoken.scopes:
-            self._tokens[account.id][scope] = gtoken
+        for scope in GOOGLE_SCOPES:
+            if scope in gtoken.scopes:
+                self.cache_token_for_scope(account, scope, gtoken)
+
+    def cache_token_for_scope(self, account, scope, gtoken):
+        get_token_cache().put(self._cache_key(account, scope),
+                              _gtoken_value(gtoken), gtoken.expiration)
 
     def clear_cache(self, account):
-        self._tokens[account.id] = {}
+        for scope in GOOGLE_SCOPES:
+            get_token_cache().delete(self._cache_key(account, scope))
 
     def get_token_for_calendars_restrict_ids(self, account, client_ids,
                                              force_refresh=False):
@@ -112,23 +120,30 @@ class GTokenManager(object):
         """
         scope = GOOGLE_CALENDAR_SCOPE
         if not force_refresh:
-            try:
-                gtoken = self._tokens[account.id][scope]
+            token = get_token_cache().peek(self._cache_key(account, scope))
+            if token is not None:
+                gtoken = _gtoken(token)
                 if gtoken.client_id in client_ids:
                     return gtoken.value
-            except KeyError:
-                pass
 
         # Need to get access token for specific client_id/client_secret pair
-        try:
-            gtoken = account.new_token(scope, client_ids=client_ids)
-        except (ConnectionError, OAuthError):
-            object_session(account).commit()
-            raise
-
+        gtoken = self._new_token(account, scope, client_ids=client_ids)
         self.cache_token(account, gtoken)
         return gtoken.value
 
+    def _cache_key(self, account, scope):
+        return 'google:{}:{}'.format(account.id, scope)
+
+
+def _gtoken_value(gtoken):
+    return [gtoken.value, gtoken.scopes, gtoken.client_id,
+            gtoken.auth_creds_id]
+
+
+def _gtoken(token):
+    value, scopes, client_id, auth_creds_id = token.value
+    return GToken(value, token.expiration, scopes, client_id, auth_creds_id)
+
 
 g_token_manager = GTokenManager()
 
@@ -9,29 +9,36 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declared_attr
 
 from inbox.models.secret import Secret
+from inbox.util.token_cache import get_token_cache
 from nylas.logging import get_logger
 log = get_logger()
 
 
 class TokenManager(object):
+    """
+    Manages accounts' access tokens, which are cached in the token cache
+    shared by all processes (see inbox.util.token_cache).
 
-    def __init__(self):
-        self._tokens = {}
+    """
 
     def get_token(self, account, force_refresh=False):
-        if account.id in self._tokens:
-            token, expiration = self._tokens[account.id]
-            if not force_refresh and expiration > datetime.utcnow():
-                return token
+        def new_token():
+            token, expires_in = account.new_token()
+            return token, self._expiration(expires_in)
 
-        new_token, expires_in = account.new_token()
-        self.cache_token(account, new_token, expires_in)
-        return new_token
+        return get_token_cache().get(self._cache_key(account), new_token,
+                                     force_refresh=force_refresh).value
 
     def cache_token(self, account, token, expires_in):
+        get_token_cache().put(self._cache_key(account), token,
+                              self._expiration(expires_in))
+
+    def _cache_key(self, account):
+        return 'oauth:{}'.format(account.id)
+
+    def _expiration(self, expires_in):
         expires_in -= 10
-        expiration = datetime.utcnow() + timedelta(seconds=expires_in)
-        self._tokens[account.id] = token, expiration
+        return datetime.utcnow() + timedelta(seconds=expires_in)
 
 
 token_manager = TokenManager()
@@ -1,7 +1,7 @@
 from sqlalchemy import (Column, Integer, String, Boolean, Enum, ForeignKey,
                         event)
 from sqlalchemy.orm import reconstructor, relationship, backref
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import UniqueConstraint, Index
 from sqlalchemy.sql.expression import false
 
 from inbox.models.roles import Blob
@@ -68,6 +68,10 @@ class Block(Blob, MailSyncBase, HasRevisions, HasPublicID,
             self.content_type = self._content_type_other
 
 
+# For finding out which blockstore data is still referenced.
+Index('ix_block_data_sha256', Block.data_sha256, mysql_length=191)
+
+
 @event.listens_for(Block, 'before_insert', propagate=True)
 def serialize_before_insert(mapper, connection, target):
     if target.content_type in COMMON_CONTENT_TYPES:
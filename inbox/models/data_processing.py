@@ -1,11 +1,13 @@
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.dialects.mysql import MEDIUMBLOB
-from sqlalchemy import DateTime
+from sqlalchemy import DateTime, Boolean
+from sqlalchemy.sql.expression import false
 
 from inbox.models.base import MailSyncBase
 from inbox.models.namespace import Namespace
 from inbox.models.mixins import UpdatedAtMixin, DeletedAtMixin
+from inbox.models.transaction import Transaction
 
 import datetime
 import json
@@ -21,6 +23,14 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     _contact_groups = Column('contact_groups', MEDIUMBLOB)
     contact_rankings_last_updated = Column(DateTime)
     contact_groups_last_updated = Column(DateTime)
+    # The state of inbox.contacts.rankings.ContactScores, which is kept up to
+    # date by the contact rankings service.
+    _contact_scores = Column('contact_scores', MEDIUMBLOB)
+    contact_scores_last_updated = Column(DateTime)
+    # Whether the contact scores include all the messages sent before the
+    # service started keeping them up to date.
+    contact_scores_backfilled = Column(Boolean, server_default=false(),
+                                       nullable=False, default=False)
 
     @property
     def contact_rankings(self):
@@ -47,4 +57,26 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
         self._contact_groups = zlib.compress(json.dumps(value).encode('utf-8'))
         self.contact_groups_last_updated = datetime.datetime.now()
 
+    @property
+    def contact_scores(self):
+        if self._contact_scores is None:
+            return None
+        else:
+            return json.loads(zlib.decompress(self._contact_scores))
+
+    @contact_scores.setter
+    def contact_scores(self, value):
+        self._contact_scores = zlib.compress(json.dumps(value).encode('utf-8'))
+        self.contact_scores_last_updated = datetime.datetime.now()
+
     __table_args__ = (UniqueConstraint('namespace_id'),)
+
+
+class DataProcessingCursor(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
+    """
+    Store the id of the last Transaction processed by the contact rankings
+    service. Is namespace-agnostic.
+
+    """
+    transaction_id = Column(ForeignKey(Transaction.id), nullable=True,
+                            index=True)
@@ -3,7 +3,7 @@ import binascii
 import datetime
 import itertools
 from hashlib import sha256
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 from inbox.api.err import log_exception
 from inbox.config import config
@@ -65,6 +65,236 @@ def _trim_filename(s, namespace_id, max_len=255):
     return s
 
 
+# The result of parsing a raw message, as plain data: unlike a Message, it can
+# be pickled and passed between processes. `fields` maps Message attribute
+# names to their parsed values (attributes that couldn't be parsed are left
+# out), and `parts` is a list of ParsedParts to save as attachments.
+ParsedMessage = namedtuple('ParsedMessage', ['data_sha256', 'fields', 'parts',
+                                             'decode_error'])
+
+ParsedPart = namedtuple('ParsedPart', ['data', 'content_disposition',
+                                       'content_type', 'filename',
+                                       'content_id'])
+
+
+def parse_message(account_id, mid, folder_name, received_date, body_string):
+    """
+    Parse a raw message into a ParsedMessage. This is the CPU-intensive half
+    of Message.create_from_synced(); it doesn't touch the database or the
+    blockstore, so it can be run in a separate process. Turn the result into
+    a Message with Message.create_from_parsed().
+
+    """
+    return _parse_message(account_id, mid, folder_name, received_date,
+                          body_string)[0]
+
+
+def _parse_message(account_id, mid, folder_name, received_date, body_string):
+    # Returns the ParsedMessage and the flanker message it was parsed from
+    # (or None if the message couldn't be parsed at all).
+    fields = {}
+    parts = []
+    decode_error = False
+
+    try:
+        parsed = mime.from_string(body_string)
+        _parse_metadata(fields, parsed, body_string, received_date, account_id,
+                        folder_name, mid)
+    except (mime.DecodingError, AttributeError, RuntimeError,
+            TypeError) as e:
+        parsed = None
+        log.error('Error parsing message metadata',
+                  folder_name=folder_name, account_id=account_id, error=e)
+        decode_error = True
+
+    if parsed is not None:
+        plain_parts = []
+        html_parts = []
+        for mimepart in parsed.walk(
+                with_self=parsed.content_type.is_singlepart()):
+            try:
+                if mimepart.content_type.is_multipart():
+                    continue  # TODO should we store relations?
+                if not _parse_mimepart(mid, mimepart, parts, html_parts,
+                                       plain_parts):
+                    decode_error = True
+            except (mime.DecodingError, AttributeError, RuntimeError,
+                    TypeError, binascii.Error, UnicodeDecodeError) as e:
+                log.error('Error parsing message MIME parts',
+                          folder_name=folder_name, account_id=account_id,
+                          error=e)
+                decode_error = True
+        fields['body'], fields['snippet'] = _calculate_body(html_parts,
+                                                            plain_parts)
+
+        # Occasionally people try to send messages to way too many
+        # recipients. In such cases, empty the field and treat as a parsing
+        # error so that we don't break the entire sync.
+        for field in ('to_addr', 'cc_addr', 'bcc_addr', 'references',
+                      'reply_to'):
+            value = fields.get(field)
+            if json_field_too_long(value):
+                log.error('Recipient field too long', field=field,
+                          account_id=account_id, folder_name=folder_name,
+                          mid=mid)
+                fields[field] = []
+                decode_error = True
+
+    parsed_message = ParsedMessage(data_sha256=sha256(body_string).hexdigest(),
+                                   fields=fields, parts=parts,
+                                   decode_error=decode_error)
+    return parsed_message, parsed
+
+
+def _parse_metadata(fields, parsed, body_string, received_date, account_id,
+                    folder_name, mid):
+    mime_version = parsed.headers.get('Mime-Version')
+    # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
+    if mime_version is not None and not mime_version.startswith('1.0'):
+        log.warning('Unexpected MIME-Version',
+                    account_id=account_id, folder_name=folder_name,
+                    mid=mid, mime_version=mime_version)
+
+    fields['subject'] = _sanitize_subject(parsed.subject)
+    fields['from_addr'] = parse_mimepart_address_header(parsed, 'From')
+    fields['sender_addr'] = parse_mimepart_address_header(parsed, 'Sender')
+    fields['reply_to'] = parse_mimepart_address_header(parsed, 'Reply-To')
+    fields['to_addr'] = parse_mimepart_address_header(parsed, 'To')
+    fields['cc_addr'] = parse_mimepart_address_header(parsed, 'Cc')
+    fields['bcc_addr'] = parse_mimepart_address_header(parsed, 'Bcc')
+
+    fields['in_reply_to'] = parsed.headers.get('In-Reply-To')
+
+    # The RFC mandates that the Message-Id header must be at most 998
+    # characters. Sadly, not everybody follows specs.
+    message_id_header = parsed.headers.get('Message-Id')
+    if message_id_header and len(message_id_header) > 998:
+        message_id_header = message_id_header[:998]
+        log.warning('Message-Id header too long. Truncating',
+                    parsed.headers.get('Message-Id'),
+                    logstash_tag='truncated_message_id')
+    fields['message_id_header'] = message_id_header
+
+    received_date = received_date if received_date else \
+        get_internaldate(parsed.headers.get('Date'),
+                         parsed.headers.get('Received'))
+
+    # It seems MySQL rounds up fractional seconds in a weird way,
+    # preventing us from reconciling messages correctly. See:
+    # https://github.com/nylas/sync-engine/commit/ed16b406e0a for
+    # more details.
+    fields['received_date'] = received_date.replace(microsecond=0)
+
+    # Custom Nylas header
+    fields['nylas_uid'] = parsed.headers.get('X-INBOX-ID')
+
+    # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
+    fields['references'] = parse_references(
+        parsed.headers.get('References', ''),
+        parsed.headers.get('In-Reply-To', ''))
+
+    fields['size'] = len(body_string)  # includes headers text
+
+
+def _parse_mimepart(mid, mimepart, parts, html_parts, plain_parts):
+    # Returns False if the part couldn't be handled.
+    disposition, _ = mimepart.content_disposition
+    content_id = mimepart.headers.get('Content-Id')
+    content_type, params = mimepart.content_type
+
+    filename = mimepart.detected_file_name
+    if filename == '':
+        filename = None
+
+    data = mimepart.body
+
+    is_text = content_type.startswith('text')
+    if disposition not in (None, 'inline', 'attachment'):
+        log.error('Unknown Content-Disposition', mid=mid,
+                  bad_content_disposition=mimepart.content_disposition)
+        return False
+
+    if disposition == 'attachment':
+        _add_attachment(parts, data, disposition, content_type, filename,
+                        content_id)
+        return True
+
+    if (disposition == 'inline' and
+            not (is_text and filename is None and content_id is None)):
+        # Some clients set Content-Disposition: inline on text MIME parts
+        # that we really want to treat as part of the text body. Don't
+        # treat those as attachments.
+        _add_attachment(parts, data, disposition, content_type, filename,
+                        content_id)
+        return True
+
+    if is_text:
+        if data is None:
+            return True
+        normalized_data = data.encode('utf-8', 'strict')
+        normalized_data = normalized_data.replace('\r\n', '\n'). \
+            replace('\r', '\n')
+        if content_type == 'text/html':
+            html_parts.append(normalized_data)
+        elif content_type == 'text/plain':
+            plain_parts.append(normalized_data)
+        else:
+            log.info('Saving other text MIME part as attachment',
+                     content_type=content_type, mid=mid)
+            _add_attachment(parts, data, 'attachment', content_type,
+                            filename, content_id)
+        return True
+
+    # Finally, if we get a non-text MIME part without Content-Disposition,
+    # treat it as an attachment.
+    _add_attachment(parts, data, 'attachment', content_type, filename,
+                    content_id)
+    return True
+
+
+def _add_attachment(parts, data, content_disposition, content_type, filename,
+                    content_id):
+    data = data or ''
+    if isinstance(data, unicode):
+        data = data.encode('utf-8', 'strict')
+    parts.append(ParsedPart(data=data,
+                            content_disposition=content_disposition,
+                            content_type=content_type, filename=filename,
+                            content_id=content_id))
+
+
+def _sanitize_subject(value):
+    # Trim overlong subjects, and remove null bytes. The latter can result
+    # when, for example, UTF-8 text decoded from an RFC2047-encoded header
+    # contains null bytes.
+    if value is None:
+        return
+    value = unicode_safe_truncate(value, 255)
+    value = value.replace('\0', '')
+    return value
+
+
+def _calculate_body(html_parts, plain_parts):
+    # Returns the (body, snippet) for the given text parts.
+    html_body = ''.join(html_parts).decode('utf-8').strip()
+    plain_body = '\n'.join(plain_parts).decode('utf-8').strip()
+    if html_body:
+        return html_body, _calculate_html_snippet(html_body)
+    elif plain_body:
+        return (plaintext2html(plain_body, False),
+                _calculate_plaintext_snippet(plain_body))
+    return u'', u''
+
+
+def _calculate_html_snippet(text):
+    text = strip_tags(text)
+    return _calculate_plaintext_snippet(text)
+
+
+def _calculate_plaintext_snippet(text):
+    return unicode_safe_truncate(' '.join(text.split()), SNIPPET_LENGTH)
+
+
 class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
               DeletedAtMixin):
 
@@ -221,14 +451,7 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
     # Calling sanitize explicitly on subject parsing
     # @validates('subject')
     def sanitize_subject(self, key, value):
-        # Trim overlong subjects, and remove null bytes. The latter can result
-        # when, for example, UTF-8 text decoded from an RFC2047-encoded header
-        # contains null bytes.
-        if value is None:
-            return
-        value = unicode_safe_truncate(value, 255)
-        value = value.replace('\0', '')
-        return value
+        return _sanitize_subject(value)
 
     @classmethod
     def create_from_synced(cls, account, mid, folder_name, received_date,
@@ -251,8 +474,6 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
             The full message including headers (encoded).
 
         """
-        global vault_config
-
         _rqd = [account, mid, folder_name, body_string]
         if not all([v is not None for v in _rqd]):
             raise ValueError(
@@ -262,58 +483,47 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         assert account.namespace is not None
         assert not isinstance(body_string, unicode)
 
+        parsed_message, parsed = _parse_message(account.id, mid, folder_name,
+                                                received_date, body_string)
+        return cls.create_from_parsed(account, parsed_message,
+                                      parsed_body=parsed or '')
+
+    @classmethod
+    def create_from_parsed(cls, account, parsed_message, parsed_body=''):
+        """
+        Writes out db metadata and MIME blocks for a ParsedMessage, as
+        returned by parse_message(). Like create_from_synced(), returns the
+        new, uncommitted Message.
+
+        `parsed_body` is only available when the message was parsed in this
+        process, so messages parsed by a worker process (see
+        inbox.mailsync.parser) don't have it.
+
+        """
+        global vault_config
+
+        assert account.namespace is not None
+
         msg = Message()
 
-        msg.data_sha256 = sha256(body_string).hexdigest()
+        msg.data_sha256 = parsed_message.data_sha256
 
         # Persist the processed message to the database
         msg.namespace_id = account.namespace.id
 
-        try:
-            parsed = mime.from_string(body_string)
-            # Non-persisted instance attribute used by EAS.
-            msg.parsed_body = parsed
-            msg._parse_metadata(parsed, body_string, received_date, account.id,
-                                folder_name, mid)
-        except (mime.DecodingError, AttributeError, RuntimeError,
-                TypeError) as e:
-            parsed = None
-            # Non-persisted instance attribute used by EAS.
-            msg.parsed_body = ''
-            log.error('Error parsing message metadata',
-                      folder_name=folder_name, account_id=account.id, error=e)
-            msg._mark_error()
+        # Non-persisted instance attribute used by EAS.
+        msg.parsed_body = parsed_body
+
+        for name, value in parsed_message.fields.iteritems():
+            setattr(msg, name, value)
 
-        if parsed is not None:
-            plain_parts = []
-            html_parts = []
-            for mimepart in parsed.walk(
-                    with_self=parsed.content_type.is_singlepart()):
-                try:
-                    if mimepart.content_type.is_multipart():
-                        continue  # TODO should we store relations?
-                    msg._parse_mimepart(mid, mimepart, account.namespace.id,
-                                        html_parts, plain_parts)
-                except (mime.DecodingError, AttributeError, RuntimeError,
-                        TypeError, binascii.Error, UnicodeDecodeError) as e:
-                    log.error('Error parsing message MIME parts',
-                              folder_name=folder_name, account_id=account.id,
-                              error=e)
-                    msg._mark_error()
-            msg.calculate_body(html_parts, plain_parts)
-
-            # Occasionally people try to send messages to way too many
-            # recipients. In such cases, empty the field and treat as a parsing
-            # error so that we don't break the entire sync.
-            for field in ('to_addr', 'cc_addr', 'bcc_addr', 'references',
-                          'reply_to'):
-                value = getattr(msg, field)
-                if json_field_too_long(value):
-                    log.error('Recipient field too long', field=field,
-                              account_id=account.id, folder_name=folder_name,
-                              mid=mid)
-                    setattr(msg, field, [])
-                    msg._mark_error()
+        for part in parsed_message.parts:
+            msg._save_attachment(part.data, part.content_disposition,
+                                 part.content_type, part.filename,
+                                 part.content_id, account.namespace.id)
+
+        if parsed_message.decode_error:
+            msg._mark_error()
 
         content_data = msg._get_content()
 
@@ -351,112 +561,8 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
 
         return msg
 
-    def _parse_metadata(self, parsed, body_string, received_date,
-                        account_id, folder_name, mid):
-        mime_version = parsed.headers.get('Mime-Version')
-        # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
-        if mime_version is not None and not mime_version.startswith('1.0'):
-            log.warning('Unexpected MIME-Version',
-                        account_id=account_id, folder_name=folder_name,
-                        mid=mid, mime_version=mime_version)
-
-        self.subject = self.sanitize_subject('subject', parsed.subject)
-        self.from_addr = parse_mimepart_address_header(parsed, 'From')
-        self.sender_addr = parse_mimepart_address_header(parsed, 'Sender')
-        self.reply_to = parse_mimepart_address_header(parsed, 'Reply-To')
-        self.to_addr = parse_mimepart_address_header(parsed, 'To')
-        self.cc_addr = parse_mimepart_address_header(parsed, 'Cc')
-        self.bcc_addr = parse_mimepart_address_header(parsed, 'Bcc')
-
-        self.in_reply_to = parsed.headers.get('In-Reply-To')
-
-        # The RFC mandates that the Message-Id header must be at most 998
-        # characters. Sadly, not everybody follows specs.
-        self.message_id_header = parsed.headers.get('Message-Id')
-        if self.message_id_header and len(self.message_id_header) > 998:
-            self.message_id_header = self.message_id_header[:998]
-            log.warning('Message-Id header too long. Truncating',
-                        parsed.headers.get('Message-Id'),
-                        logstash_tag='truncated_message_id')
-
-        self.received_date = received_date if received_date else \
-            get_internaldate(parsed.headers.get('Date'),
-                             parsed.headers.get('Received'))
-
-        # It seems MySQL rounds up fractional seconds in a weird way,
-        # preventing us from reconciling messages correctly. See:
-        # https://github.com/nylas/sync-engine/commit/ed16b406e0a for
-        # more details.
-        self.received_date = self.received_date.replace(microsecond=0)
-
-        # Custom Nylas header
-        self.nylas_uid = parsed.headers.get('X-INBOX-ID')
-
-        # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
-        self.references = parse_references(
-            parsed.headers.get('References', ''),
-            parsed.headers.get('In-Reply-To', ''))
-
-        self.size = len(body_string)  # includes headers text
-
-    def _parse_mimepart(self, mid, mimepart, namespace_id, html_parts,
-                        plain_parts):
-        disposition, _ = mimepart.content_disposition
-        content_id = mimepart.headers.get('Content-Id')
-        content_type, params = mimepart.content_type
-
-        filename = mimepart.detected_file_name
-        if filename == '':
-            filename = None
-
-        data = mimepart.body
-
-        is_text = content_type.startswith('text')
-        if disposition not in (None, 'inline', 'attachment'):
-            log.error('Unknown Content-Disposition',
-                      message_public_id=self.public_id,
-                      bad_content_disposition=mimepart.content_disposition)
-            self._mark_error()
-            return
-
-        if disposition == 'attachment':
-            self._save_attachment(data, disposition, content_type,
-                                  filename, content_id, namespace_id, mid)
-            return
-
-        if (disposition == 'inline' and
-                not (is_text and filename is None and content_id is None)):
-            # Some clients set Content-Disposition: inline on text MIME parts
-            # that we really want to treat as part of the text body. Don't
-            # treat those as attachments.
-            self._save_attachment(data, disposition, content_type,
-                                  filename, content_id, namespace_id, mid)
-            return
-
-        if is_text:
-            if data is None:
-                return
-            normalized_data = data.encode('utf-8', 'strict')
-            normalized_data = normalized_data.replace('\r\n', '\n'). \
-                replace('\r', '\n')
-            if content_type == 'text/html':
-                html_parts.append(normalized_data)
-            elif content_type == 'text/plain':
-                plain_parts.append(normalized_data)
-            else:
-                log.info('Saving other text MIME part as attachment',
-                         content_type=content_type, namespace_id=namespace_id)
-                self._save_attachment(data, 'attachment', content_type,
-                                      filename, content_id, namespace_id, mid)
-            return
-
-        # Finally, if we get a non-text MIME part without Content-Disposition,
-        # treat it as an attachment.
-        self._save_attachment(data, 'attachment', content_type,
-                              filename, content_id, namespace_id, mid)
-
     def _save_attachment(self, data, content_disposition, content_type,
-                         filename, content_id, namespace_id, mid):
+                         filename, content_id, namespace_id):
         from inbox.models import Part, Block
         block = Block()
         block.namespace_id = namespace_id
@@ -467,9 +573,6 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
             content_id = content_id[:255]
         part.content_id = content_id
         part.content_disposition = content_disposition
-        data = data or ''
-        if isinstance(data, unicode):
-            data = data.encode('utf-8', 'strict')
         block.data = data
 
     def _mark_error(self):
@@ -502,24 +605,13 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         }
 
     def calculate_body(self, html_parts, plain_parts):
-        html_body = ''.join(html_parts).decode('utf-8').strip()
-        plain_body = '\n'.join(plain_parts).decode('utf-8').strip()
-        if html_body:
-            self.snippet = self.calculate_html_snippet(html_body)
-            self.body = html_body
-        elif plain_body:
-            self.snippet = self.calculate_plaintext_snippet(plain_body)
-            self.body = plaintext2html(plain_body, False)
-        else:
-            self.body = u''
-            self.snippet = u''
+        self.body, self.snippet = _calculate_body(html_parts, plain_parts)
 
     def calculate_html_snippet(self, text):
-        text = strip_tags(text)
-        return self.calculate_plaintext_snippet(text)
+        return _calculate_html_snippet(text)
 
     def calculate_plaintext_snippet(self, text):
-        return unicode_safe_truncate(' '.join(text.split()), SNIPPET_LENGTH)
+        return _calculate_plaintext_snippet(text)
 
     @property
     def body(self):
@@ -10,7 +10,8 @@ def load_models():
     from inbox.models.contact import (MessageContactAssociation, Contact,
                                       PhoneNumber)
     from inbox.models.calendar import Calendar
-    from inbox.models.data_processing import DataProcessingCache
+    from inbox.models.data_processing import (DataProcessingCache,
+                                              DataProcessingCursor)
     from inbox.models.event import Event
     from inbox.models.folder import Folder
     from inbox.models.message import Message, MessageCategory
@@ -25,7 +26,7 @@ def load_models():
     from inbox.models.metadata import Metadata
     exports = [Account, MailSyncBase, ActionLog, Block, Part,
                MessageContactAssociation, Contact, PhoneNumber, Calendar,
-               DataProcessingCache, Event, Folder,
+               DataProcessingCache, DataProcessingCursor, Event, Folder,
                Message, Namespace, ContactSearchIndexCursor, Secret,
                Thread, Transaction, When, Time, TimeSpan, Date, DateSpan,
                Label, Category, MessageCategory, Metadata, AccountTransaction]
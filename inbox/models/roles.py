@@ -106,8 +106,7 @@ class Blob(object):
             log.error('No data returned!')
             return value
 
-        assert self.data_sha256 == sha256(value).hexdigest(), \
-            "Returned data doesn't match stored hash!"
+        # get_from_blockstore() has already checked the data against its hash.
         return value
 
     @data.setter
@@ -126,4 +125,7 @@ class Blob(object):
             log.warning('Not saving 0-length data blob')
             return
 
-        blockstore.save_to_blockstore(self.data_sha256, value)
+        # Save the data in the background. Sessions wait for it to be saved
+        # before committing the blob (see configure_blockstore_writes()).
+        self._blockstore_write = blockstore.save_to_blockstore_async(
+            self.data_sha256, value)
@@ -1,5 +1,6 @@
 import sys
 import time
+import itertools
 from contextlib import contextmanager
 
 from sqlalchemy import event
@@ -30,6 +31,7 @@ def two_phase_session(engine_map, versioned=True):
     """
     session = Session(binds=engine_map, twophase=True, autoflush=True,
                       autocommit=False)
+    configure_blockstore_writes(session)
     if versioned:
         session = configure_versioning(session)
         # TODO[k]: Metrics for transaction latencies!
@@ -39,6 +41,7 @@ def two_phase_session(engine_map, versioned=True):
 def new_session(engine, versioned=True):
     """Returns a session bound to the given engine."""
     session = Session(bind=engine, autoflush=True, autocommit=False)
+    configure_blockstore_writes(session)
 
     if versioned:
         configure_versioning(session)
@@ -85,6 +88,8 @@ def new_session(engine, versioned=True):
 def configure_versioning(session):
     from inbox.models.transaction import (create_revisions, propagate_changes,
                                           increment_versions)
+    from inbox.transactions.notifier import (publish_committed_transactions,
+                                             discard_transactions)
 
     @event.listens_for(session, 'before_flush')
     def before_flush(session, flush_context, instances):
@@ -100,9 +105,51 @@ def configure_versioning(session):
         """
         create_revisions(session)
 
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        publish_committed_transactions(session)
+
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        discard_transactions(session)
+
+    return session
+
+
+def configure_blockstore_writes(session):
+    """
+    Make commits wait for the data of the blobs they save to be saved to the
+    blockstore, which Blob does in the background.
+
+    """
+    from inbox.util.blockstore import wait_for_writes
+
+    @event.listens_for(session, 'before_flush')
+    def before_flush(session, flush_context, instances):
+        _collect_blockstore_writes(session)
+
+    @event.listens_for(session, 'before_commit')
+    def before_commit(session):
+        # Blobs added since the last flush haven't been collected yet.
+        _collect_blockstore_writes(session)
+        writes = session.info.pop('blockstore_writes', None)
+        if writes:
+            wait_for_writes(writes)
+
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop('blockstore_writes', None)
+
     return session
 
 
+def _collect_blockstore_writes(session):
+    for obj in itertools.chain(session.new, session.dirty):
+        write = obj.__dict__.pop('_blockstore_write', None)
+        if write is not None:
+            session.info.setdefault('blockstore_writes', []).append(write)
+
+
 @contextmanager
 def session_scope(id_, versioned=True):
     """
@@ -5,6 +5,7 @@ from sqlalchemy.orm import relationship
 from inbox.models.base import MailSyncBase
 from inbox.models.mixins import HasPublicID, HasRevisions
 from inbox.models.namespace import Namespace
+from inbox.transactions.notifier import record_transaction
 
 
 class Transaction(MailSyncBase, HasPublicID):
@@ -82,6 +83,8 @@ def create_revision(obj, session, revision_type):
                            object_public_id=obj.public_id,
                            namespace_id=obj.namespace.id)
     session.add(revision)
+    # Notify clients waiting on the namespace's deltas once it's committed.
+    record_transaction(session, revision)
 
     # Additionally, record account-level events in the AccountTransaction --
     # this is an optimization needed so these sparse events can be still be
@@ -1,63 +1,61 @@
+import gevent
+from gevent.queue import Queue, Empty
 from nylas.logging import get_logger
-from inbox.crispin import CrispinClient, FolderMissingError
-from inbox.providers import provider_info
-from inbox.basicauth import NotSupportedError
-from inbox.models import Message, Folder, Account, Thread
+from inbox.config import config
+from inbox.crispin import connection_pool, FolderMissingError
+from inbox.models import Message, Folder, Thread
 from inbox.models.session import session_scope
 from inbox.models.backends.imap import ImapUid
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
 from inbox.basicauth import ValidationError
 from inbox.search.base import SearchBackendException
+from inbox.search.local import local_index_for_namespace
 from inbox.mailsync.backends.imap.generic import UidInvalid
 from inbox.api.kellogs import APIEncoder
+from inbox.util.stats import statsd_client
 
 from sqlalchemy import desc
 from imaplib import IMAP4
 import socket
+import time
 from imapclient import IMAPClient
 
 PROVIDER = 'imap'
 
+# How many folders to search at once. Connections come from the account's
+# connection pool, so this is also bounded by the size of the pool.
+SEARCH_CONNECTIONS = config.get('IMAP_SEARCH_CONNECTIONS', 3)
+# How long to wait for the server to search one folder.
+SEARCH_FOLDER_TIMEOUT = config.get('IMAP_SEARCH_FOLDER_TIMEOUT', 30)
+# How long to wait for a whole search before returning partial results.
+SEARCH_TIMEOUT = config.get('IMAP_SEARCH_TIMEOUT', 60)
+
+
+class _FolderSearchTimeout(IMAP4.abort):
+    # An IMAP4.abort, so that the connection pool discards the connection
+    # instead of reusing it half-way through a command.
+    pass
+
 
 class IMAPSearchClient(object):
 
     def __init__(self, account):
         self.account = account
         self.account_id = account.id
+        self.namespace_id = account.namespace.id
         self.log = get_logger().new(account_id=account.id,
                                     component='search')
-
-    def _open_crispin_connection(self, db_session):
-        account = db_session.query(Account).get(self.account_id)
-        try:
-            conn = account.auth_handler.connect_account(account)
-        except (IMAPClient.Error, socket.error, IMAP4.error):
-            raise SearchBackendException(('Unable to connect to the IMAP '
-                                          'server. Please retry in a '
-                                          'couple minutes.'), 503)
-        except ValidationError:
-            raise SearchBackendException(("This search can't be performed "
-                                          "because the account's credentials "
-                                          "are out of date. Please "
-                                          "reauthenticate and try again."), 403)
-
-        try:
-            acct_provider_info = provider_info(account.provider)
-        except NotSupportedError:
-            self.log.warn('Account provider not supported',
-                          provider=account.provider)
-            raise
-
-        self.crispin_client = CrispinClient(self.account_id,
-                                            acct_provider_info,
-                                            account.email_address,
-                                            conn,
-                                            readonly=True)
-
-    def _close_crispin_connection(self):
-        self.crispin_client.logout()
+        # Set when the last search didn't hear back from every folder in time,
+        # so that its results are incomplete.
+        self.partial = False
 
     def search_messages(self, db_session, search_query, offset=0, limit=40):
+        index = local_index_for_namespace(self.namespace_id)
+        if index is not None:
+            message_ids = index.search_messages(self.namespace_id,
+                                                search_query, offset, limit)
+            return self._messages_by_id(db_session, message_ids)
+
         imap_uids = []
         for uids in self._search(db_session, search_query):
             imap_uids.extend(uids)
@@ -81,6 +79,16 @@ class IMAPSearchClient(object):
             encoder = APIEncoder()
 
             with session_scope(self.account_id) as db_session:
+                index = local_index_for_namespace(self.namespace_id)
+                if index is not None:
+                    # The index answers at once, so there's nothing to
+                    # stream.
+                    message_ids = index.search_messages(
+                        self.namespace_id, search_query, limit=None)
+                    yield encoder.cereal(self._messages_by_id(
+                        db_session, message_ids)) + '\n'
+                    return
+
                 for imap_uids in self._search(db_session, search_query):
                     query = db_session.query(Message) \
                         .join(ImapUid) \
@@ -90,9 +98,18 @@ class IMAPSearchClient(object):
 
                     yield encoder.cereal(query.all()) + '\n'
 
+                if self.partial:
+                    yield encoder.cereal({'partial': True}) + '\n'
+
         return g
 
     def search_threads(self, db_session, search_query, offset=0, limit=40):
+        index = local_index_for_namespace(self.namespace_id)
+        if index is not None:
+            thread_ids = index.search_threads(self.namespace_id, search_query,
+                                              offset, limit)
+            return self._threads_by_id(db_session, thread_ids)
+
         imap_uids = []
         for uids in self._search(db_session, search_query):
             imap_uids.extend(uids)
@@ -102,7 +119,7 @@ class IMAPSearchClient(object):
             .join(ImapUid) \
             .filter(ImapUid.account_id == self.account_id,
                     ImapUid.msg_uid.in_(imap_uids),
-                    Thread.deleted_at == None,
+                    Thread.deleted_at.is_(None),
                     Thread.id == Message.thread_id)\
             .order_by(desc(Message.received_date))
 
@@ -118,6 +135,14 @@ class IMAPSearchClient(object):
             encoder = APIEncoder()
 
             with session_scope(self.account_id) as db_session:
+                index = local_index_for_namespace(self.namespace_id)
+                if index is not None:
+                    thread_ids = index.search_threads(
+                        self.namespace_id, search_query, limit=None)
+                    yield encoder.cereal(self._threads_by_id(
+                        db_session, thread_ids)) + '\n'
+                    return
+
                 for imap_uids in self._search(db_session, search_query):
                     query = db_session.query(Thread) \
                         .join(Message, Message.thread_id == Thread.id) \
@@ -129,11 +154,41 @@ class IMAPSearchClient(object):
 
                     yield encoder.cereal(query.all()) + '\n'
 
+                if self.partial:
+                    yield encoder.cereal({'partial': True}) + '\n'
+
         return g
 
+    def _messages_by_id(self, db_session, message_ids):
+        # Load messages found in the local index, keeping the index's
+        # ranking.
+        if not message_ids:
+            return []
+        messages = {m.id: m for m in db_session.query(Message).filter(
+            Message.namespace_id == self.namespace_id,
+            Message.id.in_(message_ids))}
+        return [messages[id_] for id_ in message_ids if id_ in messages]
+
+    def _threads_by_id(self, db_session, thread_ids):
+        if not thread_ids:
+            return []
+        threads = {t.id: t for t in db_session.query(Thread).filter(
+            Thread.namespace_id == self.namespace_id,
+            Thread.deleted_at.is_(None),
+            Thread.id.in_(thread_ids))}
+        return [threads[id_] for id_ in thread_ids if id_ in threads]
+
     def _search(self, db_session, search_query):
-        self._open_crispin_connection(db_session)
+        """
+        Search the account's folders on the IMAP server, several at a time.
+        Yields the UIDs matching `search_query` in each folder as soon as
+        that folder has been searched.
+
+        Folders that take longer than SEARCH_FOLDER_TIMEOUT are skipped, and
+        the search stops after SEARCH_TIMEOUT. In either case, self.partial
+        is set once the results have been consumed.
 
+        """
         try:
             criteria = ['TEXT', search_query.encode('ascii')]
             charset = None
@@ -141,6 +196,42 @@ class IMAPSearchClient(object):
             criteria = [u'TEXT', search_query]
             charset = 'UTF-8'
 
+        self.partial = False
+        folders = Queue()
+        for folder in self._folders(db_session):
+            folders.put((folder.id, folder.name))
+        pending = folders.qsize()
+        results = Queue()
+        for _ in range(min(SEARCH_CONNECTIONS, pending)):
+            gevent.spawn(self._search_folders, folders, criteria, charset,
+                         results)
+
+        deadline = time.time() + SEARCH_TIMEOUT
+        try:
+            while pending:
+                try:
+                    uids = results.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    self.log.warn('Search timed out', folders_left=pending)
+                    statsd_client.incr('search.imap.timeout')
+                    self.partial = True
+                    return
+                pending -= 1
+                if isinstance(uids, Exception):
+                    raise uids
+                if uids is None:
+                    self.partial = True
+                    continue
+                yield uids
+        finally:
+            # Don't start searching any more folders. Searches that are
+            # already running end by themselves within SEARCH_FOLDER_TIMEOUT,
+            # so that their connections go back to the pool in a usable
+            # state.
+            while not folders.empty():
+                folders.get_nowait()
+
+    def _folders(self, db_session):
         folders = []
 
         account_folders = db_session.query(Folder).filter(
@@ -160,16 +251,48 @@ class IMAPSearchClient(object):
                 account_folders = account_folders.filter(
                     Folder.id != special_folder.id)
 
-        folders = folders + account_folders.all()
-
-        for folder in folders:
-            yield self._search_folder(folder, criteria, charset)
-
-        self._close_crispin_connection()
-
-    def _search_folder(self, folder, criteria, charset):
+        return folders + account_folders.all()
+
+    def _search_folders(self, folders, criteria, charset, results):
+        # Search folders from the `folders` queue until it's empty, putting
+        # the UIDs found in each on the `results` queue -- or None if the
+        # folder timed out, or the exception to raise if the search failed.
+        pool = connection_pool(self.account_id)
+        while True:
+            try:
+                folder_id, folder_name = folders.get_nowait()
+            except Empty:
+                return
+            try:
+                with pool.get() as crispin_client:
+                    with gevent.Timeout(SEARCH_FOLDER_TIMEOUT,
+                                        _FolderSearchTimeout):
+                        uids = self._search_folder(crispin_client, folder_id,
+                                                   folder_name, criteria,
+                                                   charset)
+            except _FolderSearchTimeout:
+                self.log.warn('Search timed out for folder',
+                              folder_name=folder_id)
+                statsd_client.incr('search.imap.folder_timeout')
+                uids = None
+            except (IMAPClient.Error, socket.error, IMAP4.error):
+                self.log.warn('Search connection error', exc_info=True)
+                uids = SearchBackendException(('Unable to connect to the IMAP '
+                                               'server. Please retry in a '
+                                               'couple minutes.'), 503)
+            except ValidationError:
+                uids = SearchBackendException((
+                    "This search can't be performed because the account's "
+                    "credentials are out of date. Please reauthenticate and "
+                    "try again."), 403)
+            except Exception as e:
+                uids = e
+            results.put(uids)
+
+    def _search_folder(self, crispin_client, folder_id, folder_name, criteria,
+                       charset):
         try:
-            self.crispin_client.select_folder(folder.name, uidvalidity_cb)
+            crispin_client.select_folder(folder_name, uidvalidity_cb)
         except FolderMissingError:
             self.log.warn("Won't search missing IMAP folder", exc_info=True)
             return []
@@ -179,12 +302,12 @@ class IMAPSearchClient(object):
             return []
 
         try:
-            uids = self.crispin_client.conn.search(criteria, charset=charset)
+            uids = crispin_client.conn.search(criteria, charset=charset)
         except IMAP4.error:
             self.log.warn('Search error', exc_info=True)
             raise SearchBackendException(('Unknown IMAP error when '
                                           'performing search.'), 503)
 
         self.log.debug('Search found messages for folder',
-                       folder_name=folder.id, uids=len(uids))
+                       folder_name=folder_id, uids=len(uids))
         return uids
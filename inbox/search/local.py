@@ -0,0 +1,253 @@
+"""
+A local full-text index of messages, for IMAP accounts.
+
+Searching an IMAP account otherwise means running SEARCH TEXT on every one of
+its folders, which takes a long time on large accounts and loads the
+provider's servers. Instead, the LocalSearchIndexService (see
+inbox.transactions.search) keeps an SQLite FTS5 index of the subjects,
+participants, snippets and bodies of each shard's messages up to date from
+the transaction log, and the IMAPSearchClient answers searches from it for
+namespaces whose messages have all been indexed.
+
+The index is enabled by setting LOCAL_SEARCH_INDEX_DIRECTORY. It holds one
+database per shard, and has to be shared by the indexing service and the API.
+
+Encrypted messages only have their participants indexed, since we can't
+index their subjects or bodies without storing them in the clear.
+
+"""
+import os
+import sqlite3
+from contextlib import closing
+
+from inbox.config import config
+from inbox.ignition import engine_manager
+from inbox.util.html import strip_tags
+from nylas.logging import get_logger
+log = get_logger()
+
+# Relative weights of the indexed columns when ranking results.
+_COLUMN_WEIGHTS = {'namespace': 0.0, 'subject': 10.0, 'participants': 5.0,
+                   'snippet': 1.0, 'body': 1.0}
+_COLUMNS = ['namespace', 'subject', 'participants', 'snippet', 'body',
+            'thread_id', 'received_date']
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    namespace, subject, participants, snippet, body,
+    thread_id UNINDEXED, received_date UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 1');
+CREATE TABLE IF NOT EXISTS namespaces (
+    namespace_id INTEGER PRIMARY KEY,
+    backfill_pointer INTEGER NOT NULL DEFAULT 0,
+    complete INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS transaction_pointer (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    transaction_id INTEGER NOT NULL);
+"""
+
+_indexes = {}
+
+
+def local_index_enabled():
+    return bool(config.get('LOCAL_SEARCH_INDEX_DIRECTORY'))
+
+
+def uses_local_index(account):
+    """Whether searches for the given account use the local index."""
+    from inbox.search.backends import module_registry
+    search_mod = module_registry.get(account.provider)
+    return (search_mod is not None and
+            search_mod.SEARCH_CLS == 'IMAPSearchClient')
+
+
+def get_local_index(shard_id):
+    """
+    Return the LocalSearchIndex for the given shard, or None if the local
+    index isn't enabled.
+
+    """
+    if not local_index_enabled():
+        return None
+    index = _indexes.get(shard_id)
+    if index is None:
+        path = os.path.join(config['LOCAL_SEARCH_INDEX_DIRECTORY'],
+                            'shard_{}.db'.format(shard_id))
+        index = _indexes[shard_id] = LocalSearchIndex(path)
+    return index
+
+
+def local_index_for_namespace(namespace_id):
+    """
+    Return the LocalSearchIndex to search the given namespace with, or None
+    if its messages haven't all been indexed yet.
+
+    """
+    index = get_local_index(engine_manager.shard_key_for_id(namespace_id))
+    if index is None or not index.is_complete(namespace_id):
+        return None
+    return index
+
+
+class LocalSearchIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # Let the API read while the indexing service writes.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def index_messages(self, messages):
+        """
+        Add the given messages to the index, or update them if they're
+        already there. Messages that are marked for deletion are removed.
+
+        """
+        with self.conn:
+            for message in messages:
+                self.conn.execute('DELETE FROM messages WHERE rowid = ?',
+                                  (message.id,))
+                if message.deleted_at is not None:
+                    continue
+                document = message_document(message)
+                self.conn.execute(
+                    'INSERT INTO messages (rowid, {}) VALUES (?, {})'.format(
+                        ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+                    [message.id] + [document[c] for c in _COLUMNS])
+
+    def delete_messages(self, message_ids):
+        with self.conn:
+            self.conn.executemany('DELETE FROM messages WHERE rowid = ?',
+                                  [(id_,) for id_ in message_ids])
+
+    def search_messages(self, namespace_id, search_query, offset=0,
+                        limit=40):
+        """
+        Return the ids of the namespace's messages that match
+        `search_query`, best matches first.
+
+        """
+        match = _match_expression(namespace_id, search_query)
+        if match is None:
+            return []
+        with closing(self.conn.execute(
+                'SELECT rowid FROM messages WHERE messages MATCH ? '
+                'ORDER BY {}, received_date DESC '
+                'LIMIT ? OFFSET ?'.format(_RANK),
+                (match, limit or -1, offset))) as cursor:
+            return [message_id for message_id, in cursor]
+
+    def search_threads(self, namespace_id, search_query, offset=0, limit=40):
+        """
+        Return the ids of the namespace's threads with messages that match
+        `search_query`, ranked by their best matching message.
+
+        """
+        match = _match_expression(namespace_id, search_query)
+        if match is None:
+            return []
+        threads = []
+        seen = set()
+        # Messages come out best first, so each thread's first message is
+        # its best match.
+        with closing(self.conn.execute(
+                'SELECT thread_id FROM messages WHERE messages MATCH ? '
+                'ORDER BY {}, received_date DESC'.format(_RANK),
+                (match,))) as cursor:
+            for thread_id, in cursor:
+                if thread_id in seen:
+                    continue
+                seen.add(thread_id)
+                threads.append(thread_id)
+                if limit and len(threads) >= offset + limit:
+                    break
+        return threads[offset:]
+
+    def is_complete(self, namespace_id):
+        row = self.conn.execute(
+            'SELECT complete FROM namespaces WHERE namespace_id = ?',
+            (namespace_id,)).fetchone()
+        return bool(row and row[0])
+
+    def backfill_pointer(self, namespace_id):
+        row = self.conn.execute(
+            'SELECT backfill_pointer FROM namespaces WHERE namespace_id = ?',
+            (namespace_id,)).fetchone()
+        return row[0] if row else 0
+
+    def update_backfill(self, namespace_id, pointer, complete=False):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO namespaces '
+                '(namespace_id, backfill_pointer, complete) VALUES (?, ?, ?)',
+                (namespace_id, pointer, int(complete)))
+
+    def transaction_pointer(self):
+        row = self.conn.execute(
+            'SELECT transaction_id FROM transaction_pointer').fetchone()
+        return row[0] if row else None
+
+    def update_transaction_pointer(self, transaction_id):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO transaction_pointer '
+                '(id, transaction_id) VALUES (0, ?)', (transaction_id,))
+
+
+_RANK = 'bm25(messages, {})'.format(', '.join(
+    str(_COLUMN_WEIGHTS.get(c, 0.0)) for c in _COLUMNS))
+
+
+def message_document(message):
+    """The indexed representation of a message."""
+    participants = []
+    for field in (message.from_addr, message.to_addr, message.cc_addr,
+                  message.bcc_addr):
+        for address in field or []:
+            if isinstance(address, dict):
+                participants.extend([address.get('name'),
+                                     address.get('email')])
+            else:
+                participants.extend(address)
+    document = {
+        'namespace': _namespace_token(message.namespace_id),
+        'subject': u'',
+        'participants': u' '.join(p for p in participants if p),
+        'snippet': u'',
+        'body': u'',
+        'thread_id': message.thread_id,
+        'received_date': (message.received_date.isoformat()
+                          if message.received_date else None),
+    }
+    if not message.encrypted:
+        document['subject'] = message.subject or u''
+        document['snippet'] = message.snippet or u''
+        document['body'] = strip_tags(message.body or u'')
+    return document
+
+
+def _namespace_token(namespace_id):
+    return u'ns{}'.format(namespace_id)
+
+
+def _match_expression(namespace_id, search_query):
+    # Match every term of the query (as a prefix, so that partial words
+    # match too) in the namespace's messages. Terms are quoted, so that
+    # they're never interpreted as FTS5 query syntax.
+    if isinstance(search_query, str):
+        search_query = search_query.decode('utf-8', 'replace')
+    terms = search_query.split()
+    if not terms:
+        return None
+    return u'namespace:{} AND {{subject participants snippet body}}: ({})'. \
+        format(_namespace_token(namespace_id),
+               u' '.join(u'"{}"*'.format(t.replace(u'"', u'""'))
+                         for t in terms))
@@ -58,3 +58,36 @@ def test_invalid_bearer_token_auth(db, generic_account):  # noqa
 
     response = api_client.get_raw('/account')
     assert response.status_code == 401
+
+
+def test_namespace_cache(db, generic_account, monkeypatch):  # noqa
+    from inbox.api import namespace_cache
+    lookups = []
+    lookup = namespace_cache._lookup
+
+    def counting_lookup(public_id, shard_id=None):
+        lookups.append((public_id, shard_id))
+        return lookup(public_id, shard_id)
+    monkeypatch.setattr(namespace_cache, '_lookup', counting_lookup)
+
+    public_id = generic_account.namespace.public_id
+    cache = namespace_cache.NamespaceCache(max_size=10, ttl=60,
+                                           negative_ttl=60)
+    namespace = cache.resolve(public_id)
+    assert namespace.namespace_id == generic_account.namespace.id
+    assert namespace.account_id == generic_account.id
+    assert cache.resolve(public_id) == namespace
+    assert cache.resolve(BAD_TOKEN) is None
+    assert cache.resolve(BAD_TOKEN) is None
+    assert lookups == [(public_id, None), (BAD_TOKEN, None)]
+
+    cache.invalidate(public_id)
+    assert cache.resolve(public_id) == namespace
+    assert lookups[-1] == (public_id, None)
+
+    # Expired entries are looked up on the shard we found them on.
+    cache = namespace_cache.NamespaceCache(max_size=10, ttl=0,
+                                           negative_ttl=0)
+    cache.resolve(public_id)
+    assert cache.resolve(public_id) == namespace
+    assert lookups[-1] == (public_id, namespace.shard_id)
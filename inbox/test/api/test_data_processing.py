@@ -146,3 +146,80 @@ def test_contact_groups(db, api_client, default_namespace):
         assert cached_data.contact_groups_last_updated is not None
     except (NoResultFound, AssertionError):
         assert False, "Contact groups not cached"
+
+
+def test_precomputed_contact_rankings(db, api_client, default_namespace):
+    from inbox.transactions.contact_rankings import ContactRankingsService
+    namespace_id = default_namespace.id
+    db.session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == namespace_id).delete()
+    db.session.commit()
+
+    me = ('me', default_namespace.email_address)
+
+    def send(recipients_list):
+        fake_thread = add_fake_thread(db.session, namespace_id)
+        add_fake_message(db.session, namespace_id, fake_thread,
+                         subject='Froop',
+                         from_addr=[me],
+                         to_addr=recipients_list,
+                         add_sent_category=True)
+
+    team = [('x', 'x@precomputed.com'), ('y', 'y@precomputed.com')]
+    for _ in range(3):
+        send(team)
+    send([('z', 'z@precomputed.com')])
+
+    # The first pass backfills the namespace's sent messages.
+    service = ContactRankingsService()
+    service._process_shard(0)
+    dpcache = db.session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == namespace_id).one()
+    assert dpcache.contact_scores_backfilled
+
+    def scores(path):
+        resp = api_client.get_raw(path)
+        assert resp.status_code == 200
+        return {k: s for (k, s) in json.loads(resp.data)}
+
+    rankings = scores('/contacts/rankings')
+    assert rankings['x@precomputed.com'] > rankings['z@precomputed.com']
+    groups = scores('/groups/intrinsic')
+    assert 'x@precomputed.com, y@precomputed.com' in groups
+
+    # New messages are picked up from the transaction log, once.
+    for _ in range(4):
+        send([('z', 'z@precomputed.com')])
+    service._process_shard(0)
+    service._process_shard(0)
+    rankings = scores('/contacts/rankings')
+    assert rankings['z@precomputed.com'] > rankings['x@precomputed.com']
+    assert rankings['z@precomputed.com'] < 5.01
+
+
+def test_contact_rankings_backfill_survives_concurrent_insert(
+        db, default_namespace, monkeypatch):
+    from inbox.transactions.contact_rankings import ContactRankingsService
+    namespace_id = default_namespace.id
+    db.session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == namespace_id).delete()
+    db.session.commit()
+
+    service = ContactRankingsService()
+    backfill_namespace = service._backfill_namespace
+    calls = []
+
+    def concurrent_insert(db_session, backfill_namespace_id):
+        if backfill_namespace_id == namespace_id and not calls:
+            # The API creates the row after the service looked for it.
+            db.session.add(DataProcessingCache(namespace_id=namespace_id))
+            db.session.commit()
+            calls.append(namespace_id)
+        return backfill_namespace(db_session, backfill_namespace_id)
+    monkeypatch.setattr(service, '_backfill_namespace', concurrent_insert)
+
+    service._process_shard(0)
+    db.session.expire_all()
+    dpcache = db.session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == namespace_id).one()
+    assert dpcache.contact_scores_backfilled
@@ -5,6 +5,7 @@ import json
 import mock
 
 from datetime import datetime
+from hashlib import sha256
 
 import pytest
 from inbox.models import Block, Part
@@ -151,6 +152,64 @@ def test_download(api_client, uploaded_file_ids, filename):
     assert local_md5 == dl_md5
 
 
+def test_download_range_and_etag(api_client, uploaded_file_ids):
+    in_file = api_client.get_data(
+        '/files?filename=LetMeSendYouEmail.wav')[0]
+    path = '/files/{}/download'.format(in_file['id'])
+    data = api_client.get_raw(path).data
+
+    resp = api_client.get_raw(path)
+    etag = resp.headers['ETag']
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+    assert resp.headers['Content-Length'] == str(len(data))
+
+    resp = api_client.get_raw(path, headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == ''
+
+    resp = api_client.get_raw(path, headers={'Range': 'bytes=10-19'})
+    assert resp.status_code == 206
+    assert resp.data == data[10:20]
+    assert resp.headers['Content-Range'] == 'bytes 10-19/{}'.format(
+        len(data))
+
+    resp = api_client.get_raw(path, headers={'Range': 'bytes=-5'})
+    assert resp.status_code == 206
+    assert resp.data == data[-5:]
+
+    # The client's copy is of a different version, so send all of it.
+    resp = api_client.get_raw(path, headers={'Range': 'bytes=10-19',
+                                             'If-Range': '"stale"'})
+    assert resp.status_code == 200
+    assert resp.data == data
+
+    resp = api_client.get_raw(path, headers={
+        'Range': 'bytes={}-'.format(len(data) + 1)})
+    assert resp.status_code == 416
+
+
+def test_stream_checks_hash(tmpdir):
+    from inbox.util.blockstore import _DiskBlob, STREAM_CHUNK_SIZE
+    data = 'x' * (3 * STREAM_CHUNK_SIZE + 1)
+    path = tmpdir.join('blob')
+    path.write(data)
+
+    blob = _DiskBlob(sha256(data).hexdigest(), len(data), str(path))
+    assert ''.join(blob.stream()) == data
+    assert ''.join(blob.stream(5, STREAM_CHUNK_SIZE + 10)) == \
+        data[5:STREAM_CHUNK_SIZE + 10]
+
+    # The last chunk of corrupt data is held back.
+    blob = _DiskBlob(sha256('y').hexdigest(), len(data), str(path))
+    chunks = []
+    with pytest.raises(AssertionError):
+        for chunk in blob.stream():
+            chunks.append(chunk)
+    assert len(chunks) == 3
+    # Parts of the data can't be checked, so aren't.
+    assert ''.join(blob.stream(0, 10)) == data[:10]
+
+
 @pytest.fixture(scope='function')
 def fake_attachment(db, default_account, message):
     block = Block()
@@ -174,6 +233,8 @@ def test_direct_fetching(api_client, db, message,
     get_mock = mock.Mock(return_value=None)
     monkeypatch.setattr('inbox.util.blockstore.get_from_blockstore',
                         get_mock)
+    monkeypatch.setattr('inbox.util.blockstore.open_from_blockstore',
+                        mock.Mock(return_value=None))
 
     save_mock = mock.Mock()
     monkeypatch.setattr('inbox.util.blockstore.save_to_blockstore',
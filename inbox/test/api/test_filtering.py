@@ -245,6 +245,55 @@ def test_ordering(api_client, db, default_namespace):
     assert expected_public_ids == [r['id'] for r in ordered_results]
 
 
+def _page_through(api_client, path, limit):
+    results = []
+    page_token = None
+    while True:
+        url = '{}{}limit={}'.format(path, '&' if '?' in path else '?', limit)
+        if page_token is not None:
+            url += '&page_token={}'.format(page_token)
+        response = api_client.get_raw(url)
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        assert len(page) <= limit
+        results.extend(page)
+        page_token = response.headers.get('X-Next-Page-Token')
+        if page_token is None:
+            return results
+
+
+def test_page_token(api_client, db, default_namespace):
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    for i in range(7):
+        thr = add_fake_thread(db.session, default_namespace.id)
+        # Several messages share each date, so pages must break ties.
+        received_date = now - datetime.timedelta(seconds=i // 3)
+        add_fake_message(db.session, default_namespace.id, thr,
+                         received_date=received_date)
+        thr.subject = None if i % 2 else 'subject {}'.format(i % 3)
+        thr.recentdate = received_date
+    db.session.commit()
+
+    for path in ['/messages', '/threads', '/threads?sort_field=subject',
+                 '/threads?sort_field=subject&sort_order=asc',
+                 '/messages?view=ids']:
+        expected = api_client.get_data(path)
+        assert _page_through(api_client, path, 2) == expected
+        assert _page_through(api_client, path, 3) == expected
+
+    # Tokens are only valid for the sort order they came from.
+    response = api_client.get_raw('/threads?limit=1')
+    page_token = response.headers['X-Next-Page-Token']
+    response = api_client.get_raw(
+        '/threads?sort_field=subject&page_token={}'.format(page_token))
+    assert response.status_code == 400
+    response = api_client.get_raw('/messages?page_token={}'.format(page_token))
+    assert response.status_code == 400
+
+    response = api_client.get_raw('/messages?page_token=garbage')
+    assert response.status_code == 400
+
+
 def test_strict_argument_parsing(api_client):
     r = api_client.get_raw('/threads?foo=bar')
     assert r.status_code == 400
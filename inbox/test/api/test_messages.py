@@ -82,7 +82,7 @@ def test_direct_fetching(stub_message_from_raw, api_client, mime_message,
     # Mark a message as missing and check that we try to
     # fetch it from the remote provider.
     get_mock = mock.Mock(return_value=None)
-    monkeypatch.setattr('inbox.util.blockstore.get_from_blockstore',
+    monkeypatch.setattr('inbox.util.blockstore.open_from_blockstore',
                         get_mock)
 
     save_mock = mock.Mock()
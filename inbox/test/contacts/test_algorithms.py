@@ -0,0 +1,178 @@
+"""Check that the contact group algorithm finds the same groups as it did
+before it used an index to find similar molecules, and that it copes with
+heavy senders."""
+import datetime
+import random
+from collections import defaultdict, namedtuple
+
+import pytest
+
+from inbox.contacts import algorithms
+from inbox.contacts.algorithms import (calculate_group_scores,
+                                       _get_message_weight, _get_participants,
+                                       _jaccard_similarity, MIN_GROUP_SIZE,
+                                       MIN_MESSAGE_COUNT,
+                                       SELF_IDENTITY_THRESHOLD,
+                                       JACCARD_THRESHOLD,
+                                       SOCIAL_MOLECULE_EXPANSION_LIMIT,
+                                       SOCIAL_MOLECULE_LIMIT)
+
+FakeMessage = namedtuple('FakeMessage',
+                         ['id', 'to_addr', 'cc_addr', 'bcc_addr', 'date'])
+
+ME = 'me@nylas.com'
+
+
+def sample_messages(seed, count, people, teams):
+    """Messages to members of a few teams, plus the odd outsider."""
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    people = ['person{}@nylas.com'.format(i) for i in xrange(people)]
+    teams = [rng.sample(people, rng.randint(2, 6)) for _ in xrange(teams)]
+    messages = []
+    for i in xrange(count):
+        team = rng.choice(teams)
+        recipients = rng.sample(team, rng.randint(1, len(team)))
+        if rng.random() < 0.3:
+            recipients.append(rng.choice(people))
+        if rng.random() < 0.2:
+            recipients.append(ME)
+        recipients = [('', email) for email in recipients]
+        messages.append(FakeMessage(
+            i, recipients[:2], recipients[2:4], recipients[4:],
+            now - datetime.timedelta(days=rng.uniform(0, 3 * 365))))
+    return messages
+
+
+@pytest.mark.parametrize('seed,count,people,teams', [
+    (1, 50, 10, 3),
+    (2, 300, 20, 6),
+    (3, 1000, 40, 12),
+    (4, 2000, 80, 30),
+    (5, 3000, 30, 10),
+])
+def test_group_scores_match_reference(seed, count, people, teams):
+    messages = sample_messages(seed, count, people, teams)
+    # Past the expansion limit, the old algorithm didn't expand molecules
+    # at all, where the new one expands the heaviest.
+    assert len({tuple(_get_participants(message, [ME]))
+                for message in messages}) < SOCIAL_MOLECULE_EXPANSION_LIMIT
+    expected = reference_group_scores(messages, ME)
+    scores = calculate_group_scores(messages, ME)
+    assert set(scores) == set(expected)
+    for group, score in expected.iteritems():
+        assert abs(scores[group] - score) < 1e-6 * max(score, 1)
+
+
+def test_heavy_senders_get_groups(monkeypatch):
+    messages = sample_messages(6, 2000, 200, 60)
+    assert calculate_group_scores(messages, ME)
+    # Too many distinct lists of recipients used to mean no groups at all.
+    monkeypatch.setattr(algorithms, 'SOCIAL_MOLECULE_LIMIT', 100)
+    monkeypatch.setattr(algorithms, 'SOCIAL_MOLECULE_EXPANSION_LIMIT', 50)
+    assert calculate_group_scores(messages, ME)
+
+
+##
+# The algorithm as it was, comparing every pair of molecules.
+##
+
+def reference_group_scores(messages, user_email):
+    now = datetime.datetime.now()
+    message_ids_to_scores = {}
+    molecules_dict = defaultdict(set)  # (emails, ...) -> {message ids, ...}
+
+    def get_message_list_weight(message_ids):
+        return sum([message_ids_to_scores[m_id] for m_id in message_ids])
+
+    # Gather initial candidate social molecules
+    for msg in messages:
+        participants = _get_participants(msg, [user_email])
+        if len(participants) >= MIN_GROUP_SIZE:
+            molecules_dict[tuple(participants)].add(msg.id)
+            message_ids_to_scores[msg.id] = \
+                _get_message_weight(now, msg.date)
+
+    if len(molecules_dict) > SOCIAL_MOLECULE_LIMIT:
+        return {}  # Not worth the calculation
+
+    # Expand pool of social molecules by taking pairwise intersections.
+    # If there are already too many molecules, skip this step.
+    if len(molecules_dict) < SOCIAL_MOLECULE_EXPANSION_LIMIT:
+        _reference_expand_molecule_pool(molecules_dict)
+
+    # Filter out infrequent molecules
+    molecules_list = [(set(emails), set(msgs))
+                      for (emails, msgs) in molecules_dict.iteritems()
+                      if get_message_list_weight(msgs) >= MIN_MESSAGE_COUNT]
+
+    # Subsets get absorbed by supersets (if minimal info lost)
+    molecules_list = _reference_subsume_molecules(
+        molecules_list, get_message_list_weight)
+
+    molecules_list = _reference_combine_similar_molecules(molecules_list)
+
+    # Give a score to each group.
+    return {', '.join(sorted(g)): get_message_list_weight(m)
+            for (g, m) in molecules_list}
+
+
+def _reference_expand_molecule_pool(molecules_dict):
+    mditems = [(set(g), msgs) for (g, msgs) in molecules_dict.items()]
+    for i in xrange(len(mditems)):
+        g1, m1 = mditems[i]
+        for j in xrange(i, len(mditems)):
+            g2, m2 = mditems[j]
+            new_molecule = tuple(sorted(list(g1.intersection(g2))))
+            if len(new_molecule) >= MIN_GROUP_SIZE:
+                molecules_dict[new_molecule] = \
+                    molecules_dict[new_molecule].union(m1).union(m2)
+
+
+def _reference_subsume_molecules(molecules_list, get_message_list_weight):
+    molecules_list.sort(key=lambda x: len(x[0]), reverse=True)
+    is_subsumed = [False] * len(molecules_list)
+    mol_weights = [get_message_list_weight(m) for (_, m) in molecules_list]
+
+    for i in xrange(1, len(molecules_list)):
+        g1, m1 = molecules_list[i]  # Smaller group
+        m1_size = mol_weights[i]
+        for j in xrange(i):
+            if is_subsumed[j]:
+                continue
+            g2, m2 = molecules_list[j]  # Bigger group
+            m2_size = mol_weights[j]
+            if g1.issubset(g2):
+                sharing_error = ((len(g2) - len(g1)) * (m1_size - m2_size) /
+                                 (1.0 * (len(g2) * m1_size)))
+                if sharing_error < SELF_IDENTITY_THRESHOLD:
+                    is_subsumed[i] = True
+                    break
+
+    return [ml for (ml, dead) in zip(molecules_list, is_subsumed) if not dead]
+
+
+def _reference_combine_similar_molecules(molecules_list):
+    """Using a greedy approach here for speed"""
+    new_guys_start_idx = 0
+    while new_guys_start_idx < len(molecules_list):
+        combined = [False] * len(molecules_list)
+        new_guys = []
+        for j in xrange(new_guys_start_idx, len(molecules_list)):
+            for i in xrange(0, j):
+                if combined[i]:
+                    continue
+                (g1, m1), (g2, m2) = molecules_list[i], molecules_list[j]
+                js = _jaccard_similarity(g1, g2)
+                if js > JACCARD_THRESHOLD:
+                    new_guys.append((g1.union(g2), m1.union(m2)))
+                    combined[i], combined[j] = True, True
+                    break
+
+        molecules_list = [molecule for molecule, was_combined
+                          in zip(molecules_list, combined)
+                          if not was_combined]
+        new_guys_start_idx = len(molecules_list)
+        molecules_list.extend(new_guys)
+
+    return molecules_list
@@ -0,0 +1,100 @@
+# flake8: noqa: F401, F811
+import calendar
+from datetime import datetime
+
+import pytest
+
+from inbox.config import config, ConfigError
+from inbox.contacts.local_search import (get_local_contact_index,
+                                         scores_due, SCORES_REFRESH_INTERVAL)
+from inbox.contacts.search import get_contact_search_client
+from inbox.models import PhoneNumber
+from inbox.transactions.search import ContactSearchIndexService
+from inbox.test.util.base import add_fake_contact, default_namespace
+
+
+@pytest.fixture
+def local_contact_index(monkeypatch, tmpdir):
+    monkeypatch.setitem(config, 'CONTACT_SEARCH_BACKEND', 'local')
+    monkeypatch.setitem(config, 'CONTACT_SEARCH_INDEX_DIRECTORY', str(tmpdir))
+    monkeypatch.setattr('inbox.contacts.local_search._indexes', {})
+    return get_local_contact_index(0)
+
+
+def test_local_contact_index_search(db, default_namespace,
+                                    local_contact_index):
+    namespace_id = default_namespace.id
+    ben = add_fake_contact(db.session, namespace_id, name='Ben Bitdiddle',
+                           email_address='ben@bitdiddle.com', uid='ben')
+    alyssa = add_fake_contact(db.session, namespace_id,
+                              name='Alyssa P. Hacker',
+                              email_address='alyssa@hacker.com',
+                              uid='alyssa')
+    alyssa.phone_numbers.append(PhoneNumber(type='mobile',
+                                            number='+1 (555) 123-4567'))
+    db.session.commit()
+    index = local_contact_index
+    index.index_contacts([ben, alyssa])
+
+    assert index.search_contacts(namespace_id, 'bit') == [ben.id]
+    assert index.search_contacts(namespace_id, 'ben@bitd') == [ben.id]
+    assert index.search_contacts(namespace_id, 'alyssa hack') == [alyssa.id]
+    assert index.search_contacts(namespace_id, '+1 555-12') == [alyssa.id]
+    assert index.search_contacts(namespace_id + 1, 'ben') == []
+    # Query syntax is treated as text.
+    assert index.search_contacts(namespace_id, 'ben" OR "alyssa') == []
+
+    # Results are ranked by contact rankings.
+    index.update_scores(namespace_id, {'BEN@bitdiddle.com': 5.0,
+                                       'alyssa@hacker.com': 1.0},
+                        datetime.now())
+    assert index.search_contacts(namespace_id, 'com') == [ben.id, alyssa.id]
+    index.update_scores(namespace_id, {'alyssa@hacker.com': 10.0},
+                        datetime.now())
+    assert index.search_contacts(namespace_id, 'com') == [alyssa.id, ben.id]
+    assert index.search_contacts(namespace_id, 'com', offset=1,
+                                 limit=1) == [ben.id]
+
+    index.delete_contacts([ben.id])
+    assert index.search_contacts(namespace_id, 'com') == [alyssa.id]
+
+
+def test_scores_due():
+    updated_at = datetime(2016, 5, 1, 12, 0, 30)
+    copied = calendar.timegm(datetime(2016, 5, 1, 12, 0, 0).timetuple())
+    now = copied + SCORES_REFRESH_INTERVAL
+
+    assert not scores_due(None, None)
+    assert scores_due(updated_at, None)
+    # Newer scores are copied once the last copy is old enough, even if
+    # they're only a little newer than the copied ones.
+    assert scores_due(updated_at, (copied, copied), now=now)
+    assert not scores_due(updated_at, (copied, copied), now=now - 1)
+    assert not scores_due(updated_at, (copied + 30, copied), now=now)
+
+
+def test_contact_search_service_updates_local_index(db, default_namespace,
+                                                    local_contact_index):
+    service = ContactSearchIndexService()
+    service._set_transaction_pointers()
+    contact = add_fake_contact(db.session, default_namespace.id,
+                               name='Louis Reasoner',
+                               email_address='louis@reasoner.com',
+                               uid='louis')
+    service._index_transactions()
+
+    search_client = get_contact_search_client(default_namespace.id)
+    assert search_client.search_contacts(db.session, 'louis') == [contact]
+
+    db.session.delete(contact)
+    db.session.commit()
+    service._index_transactions()
+    assert search_client.search_contacts(db.session, 'louis') == []
+
+
+def test_contact_search_service_requires_index_directory(monkeypatch):
+    monkeypatch.setitem(config, 'CONTACT_SEARCH_BACKEND', 'local')
+    monkeypatch.delitem(config, 'CONTACT_SEARCH_INDEX_DIRECTORY',
+                        raising=False)
+    with pytest.raises(ConfigError):
+        ContactSearchIndexService()
@@ -69,3 +69,47 @@ def test_handle_noreply_addresses(db, default_namespace, thread):
         Contact.namespace == default_namespace,
         Contact.email_address == 'alice@example.com').first()
     assert contact.name is not None
+
+
+def test_update_contacts_from_messages_in_batch(db, default_namespace, thread):
+    from inbox.contacts.process_mail import (ContactCache,
+                                             update_contacts_from_messages)
+    from inbox.models import Transaction
+    add_fake_message(db.session, default_namespace.id, thread,
+                     from_addr=[('Alpha', 'alpha@example.com')])
+    cache = ContactCache(max_size=10)
+
+    def add_messages(*addresses):
+        messages = []
+        for address in addresses:
+            message = add_fake_message(db.session, default_namespace.id,
+                                       from_addr=[('', 'alpha@example.com')],
+                                       to_addr=[('', address)])
+            thread.messages.append(message)
+            messages.append(message)
+        update_contacts_from_messages(db.session, messages, default_namespace,
+                                      cache)
+        db.session.add_all(messages)
+        db.session.commit()
+        return messages
+
+    messages = add_messages('beta@example.com', 'Beta@Example.com')
+    assert cache.get('alpha@example.com') is not None
+    # Contacts created in the transaction aren't cached.
+    assert cache.get('beta@example.com') is None
+    beta = db.session.query(Contact).filter(
+        Contact.namespace_id == default_namespace.id,
+        Contact.email_address == 'beta@example.com').one()
+    assert db.session.query(Transaction).filter(
+        Transaction.object_type == 'contact',
+        Transaction.record_id == beta.id).count() == 1
+    for message in messages:
+        assert {association.contact.email_address
+                for association in message.contacts} == \
+            {'alpha@example.com', 'beta@example.com'}
+
+    add_messages('beta@example.com')
+    assert cache.get('beta@example.com') == (beta.id, '')
+    assert db.session.query(Contact).filter(
+        Contact.namespace_id == default_namespace.id,
+        Contact.email_address == 'beta@example.com').count() == 1
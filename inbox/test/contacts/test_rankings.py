@@ -0,0 +1,73 @@
+"""Check that incrementally maintained contact scores match the ones
+calculated from scratch."""
+import calendar
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from inbox.contacts.algorithms import (calculate_contact_scores,
+                                       calculate_group_scores)
+from inbox.contacts.rankings import ContactScores
+
+FakeMessage = namedtuple('FakeMessage',
+                         ['id', 'to_addr', 'cc_addr', 'bcc_addr', 'date'])
+
+ME = 'me@nylas.com'
+
+
+def fake_messages(count):
+    rng = random.Random(42)
+    people = ['{}@nylas.com'.format(name) for name in 'abcdefgh']
+    now = datetime.now()
+    messages = []
+    for i in xrange(count):
+        recipients = [('', email) for email in rng.sample(people, 3)]
+        if rng.random() < 0.5:
+            recipients.append(('', ME))
+        messages.append(FakeMessage(
+            i + 1, recipients[:2], recipients[2:], [],
+            # Up to three years old, so that some have the minimum weight.
+            now - timedelta(days=rng.uniform(0, 3 * 365))))
+    return messages
+
+
+def assert_scores_match(scores, expected):
+    assert set(scores) == set(expected)
+    for key, score in expected.iteritems():
+        assert abs(scores[key] - score) < 0.01 * max(score, 1)
+
+
+def test_incremental_scores_match():
+    messages = fake_messages(300)
+    # calculate_*_scores() compare dates with the local time.
+    now = calendar.timegm(datetime.now().timetuple())
+    scores = ContactScores()
+    scores.start_backfill(100)
+    scores.backfill(messages[:100], ME, now)
+    scores.add_messages(messages[100:200], ME, now)
+    # Messages are only counted once.
+    scores.add_messages(messages[150:], ME, now)
+    scores.recalculate_groups(now)
+
+    assert_scores_match(scores.rankings(now),
+                        calculate_contact_scores(messages))
+    assert_scores_match(scores.group_scores(now),
+                        calculate_group_scores(messages, ME))
+
+    # The scores survive being stored.
+    scores = ContactScores(scores.to_state())
+    assert_scores_match(scores.rankings(now),
+                        calculate_contact_scores(messages))
+
+
+def test_counted_ids_are_bounded(monkeypatch):
+    monkeypatch.setattr('inbox.contacts.rankings.MAX_COUNTED_IDS', 10)
+    messages = fake_messages(30)
+    scores = ContactScores()
+    scores.add_messages(messages, ME)
+    assert len(scores.counted) == 10
+    assert scores.watermark == 20
+    scores.add_messages(messages, ME)
+    assert sum(count for buckets in scores.recipients.itervalues()
+               for count, _ in buckets.itervalues()) == \
+        sum(len(message.to_addr + message.cc_addr) for message in messages)
@@ -0,0 +1,221 @@
+from hashlib import sha256
+
+import pytest
+
+from inbox.models import Block
+from inbox.util import blockstore
+from inbox.test.util.base import default_namespace
+
+__all__ = ['default_namespace']
+
+
+@pytest.fixture
+def saves(monkeypatch):
+    saves = []
+
+    def save(data_sha256, data, bucket=None):
+        saves.append(data_sha256)
+        if data == 'fail':
+            raise IOError('Disk full')
+
+    monkeypatch.setattr('inbox.util.blockstore._save', save)
+    monkeypatch.setattr('inbox.util.blockstore._writer',
+                        blockstore.BlockstoreWriter(2, 10, 10))
+    return saves
+
+
+def test_writer_saves_data_once(saves):
+    data_sha256 = sha256('data').hexdigest()
+    write = blockstore.save_to_blockstore_async(data_sha256, 'data')
+    assert blockstore.save_to_blockstore_async(data_sha256, 'data') is write
+    blockstore.wait_for_writes([write])
+    assert blockstore.save_to_blockstore_async(data_sha256, 'data') is None
+    assert saves == [data_sha256]
+
+
+def test_writer_retries_failed_saves(saves):
+    data_sha256 = sha256('fail').hexdigest()
+    write = blockstore.save_to_blockstore_async(data_sha256, 'fail')
+    with pytest.raises(IOError):
+        blockstore.wait_for_writes([write])
+    write = blockstore.save_to_blockstore_async(data_sha256, 'fail')
+    assert write is not None
+    with pytest.raises(IOError):
+        blockstore.wait_for_writes([write])
+    assert saves == [data_sha256, data_sha256]
+
+
+def test_commit_waits_for_blob_to_be_saved(db, default_namespace, saves):
+    block = Block(namespace_id=default_namespace.id, filename='a.txt')
+    block.data = 'data'
+    db.session.add(block)
+    db.session.commit()
+    assert saves == [block.data_sha256]
+
+    block = Block(namespace_id=default_namespace.id, filename='b.txt')
+    block.data = 'fail'
+    db.session.add(block)
+    with pytest.raises(IOError):
+        db.session.commit()
+    db.session.rollback()
+    assert db.session.query(Block).filter(
+        Block.data_sha256 == sha256('fail').hexdigest()).count() == 0
+
+
+def test_memory_cache_evicts_least_recently_used():
+    from inbox.util.blobcache import MemoryTier
+    memory = MemoryTier(max_size=10, max_blob_size=5)
+    memory.put('a', 'aaaa')
+    memory.put('b', 'bbbb')
+    memory.put('big', 'x' * 6)
+    assert memory.get('big') is None
+    assert memory.get('a') == 'aaaa'
+    memory.put('c', 'cccc')
+    assert memory.get('b') is None
+    assert memory.get('a') == 'aaaa'
+    assert memory.size == 8
+
+
+def test_disk_cache_evicts_least_recently_used(tmpdir):
+    from inbox.util.blobcache import DiskTier
+    disk = DiskTier(str(tmpdir), max_size=10)
+    disk.put('aa', 'aaaa')
+    disk.put('bb', 'bbbb')
+    assert disk.get('aa') == 'aaaa'
+    disk.put('cc', 'cccc')
+    assert disk.get('bb') is None
+    assert not tmpdir.join('bb', 'bb').check()
+    assert disk.get('aa') == 'aaaa'
+
+    # Cached files are found again by new processes.
+    disk = DiskTier(str(tmpdir), max_size=10)
+    assert disk.get('cc') == 'cccc'
+    assert disk.size == 8
+
+
+def test_streaming_fills_cache(tmpdir, monkeypatch):
+    from inbox.util.blobcache import BlobCache, DiskTier, MemoryTier
+    cache = BlobCache(MemoryTier(100, 10),
+                      DiskTier(str(tmpdir.mkdir('cache')), 100))
+    monkeypatch.setattr('inbox.util.blockstore.get_blob_cache',
+                        lambda: cache)
+    monkeypatch.setattr('inbox.util.blockstore._data_file_path',
+                        lambda data_sha256: str(tmpdir.join(data_sha256)))
+
+    for data in ('small', 'larger than ten bytes'):
+        data_sha256 = sha256(data).hexdigest()
+        tmpdir.join(data_sha256).write(data)
+        blob = blockstore.open_from_blockstore(data_sha256)
+        assert ''.join(blob.stream(0, 3)) == data[:3]
+        assert cache.get(data_sha256) is None
+        assert ''.join(blob.stream()) == data
+
+        tmpdir.join(data_sha256).remove()
+        blob = blockstore.open_from_blockstore(data_sha256)
+        assert blob.verified
+        assert ''.join(blob.stream()) == data
+        assert blockstore.get_from_blockstore(data_sha256) == data
+
+
+def test_packed_store(tmpdir, monkeypatch):
+    import os
+    from inbox.util import packstore
+    store = packstore.PackedStore(str(tmpdir), segment_size=1000)
+    blobs = {sha256(data).hexdigest(): data
+             for data in ('a' * 500, os.urandom(500), os.urandom(600))}
+    for data_sha256, data in blobs.iteritems():
+        store.put(data_sha256, data)
+        assert store.get(data_sha256) == data
+    assert store.locate(sha256('a' * 500).hexdigest()).codec == \
+        packstore.CODEC_BLOB
+    assert len(tmpdir.listdir('*.seg')) == 2
+
+    # Other processes find blobs as they're stored.
+    other_store = packstore.PackedStore(str(tmpdir), segment_size=1000)
+    for data_sha256, data in blobs.iteritems():
+        assert other_store.get(data_sha256) == data
+    data = os.urandom(100)
+    store.put(sha256(data).hexdigest(), data)
+    assert other_store.get(sha256(data).hexdigest()) == data
+    assert other_store.get(sha256('missing').hexdigest()) is None
+
+
+def test_packed_store_compaction(tmpdir, monkeypatch):
+    import os
+    from inbox.util import packstore
+    # Seal segments as soon as they're done with.
+    monkeypatch.setattr(packstore, 'IDLE_SEGMENT_AGE', -1)
+    monkeypatch.setattr(packstore, 'GRACE_PERIOD', -1)
+    store = packstore.PackedStore(str(tmpdir), segment_size=1 << 20)
+    live = os.urandom(100)
+    dead = os.urandom(100)
+    store.put(sha256(live).hexdigest(), live)
+    store.put(sha256(dead).hexdigest(), dead)
+    other_store = packstore.PackedStore(str(tmpdir), segment_size=1 << 20)
+    assert other_store.get(sha256(live).hexdigest()) == live
+
+    def referenced(hashes):
+        return set(hashes) & {sha256(live).hexdigest()}
+    assert store.compact(referenced) > 0
+    assert store.get(sha256(live).hexdigest()) == live
+    assert store.get(sha256(dead).hexdigest()) is None
+    # New processes find the blobs in sealed segments in the merged index,
+    # rather than reading every segment's index.
+    assert len(tmpdir.listdir('*.midx')) == 1
+    new_store = packstore.PackedStore(str(tmpdir), segment_size=1 << 20)
+    assert new_store.get(sha256(live).hexdigest()) == live
+    assert not new_store._index
+    # Processes that knew where the blob was find where it's gone.
+    assert other_store.get(sha256(live).hexdigest()) == live
+    assert other_store.get(sha256(dead).hexdigest()) is None
+    assert store.compact(referenced) == 0
+
+    # Blobs are stored again if they were deleted after we'd seen them.
+    generation = other_store.generation()
+    other_store.put(sha256(dead).hexdigest(), dead)
+    assert store.get(sha256(dead).hexdigest()) == dead
+    store.compact(referenced)
+    assert other_store.generation() != generation
+    other_store.put(sha256(dead).hexdigest(), dead)
+    assert store.get(sha256(dead).hexdigest()) == dead
+
+
+def test_packed_store_compaction_keeps_blobs_referenced_again(tmpdir,
+                                                              monkeypatch):
+    import os
+    from inbox.util import packstore
+    monkeypatch.setattr(packstore, 'IDLE_SEGMENT_AGE', -1)
+    store = packstore.PackedStore(str(tmpdir), segment_size=1 << 20)
+    blobs = [os.urandom(100) for _ in range(3)]
+    for data in blobs:
+        store.put(sha256(data).hexdigest(), data)
+    referenced_again = sha256(blobs[1]).hexdigest()
+    other_store = packstore.PackedStore(str(tmpdir), segment_size=1 << 20)
+
+    # Segments stored in recently aren't compacted.
+    assert store.compact(lambda hashes: set()) == 0
+    monkeypatch.setattr(packstore, 'GRACE_PERIOD', -1)
+
+    def referenced(hashes):
+        if referenced_again not in hashes:
+            return set()
+        # A block with this blob is committed during the compaction.
+        calls.append(hashes)
+        return {referenced_again} if len(calls) > 1 else set()
+    calls = []
+    assert store.compact(referenced) > 0
+    assert store.get(referenced_again) == blobs[1]
+    assert store.get(sha256(blobs[0]).hexdigest()) is None
+
+    # Another process stores a blob in the segment while it's compacted.
+    for data in blobs:
+        store.put(sha256(data).hexdigest(), data)
+
+    def referenced(hashes):
+        if referenced_again in hashes and not calls:
+            other_store.put(referenced_again, blobs[1])
+            calls.append(hashes)
+        return set()
+    calls = []
+    store.compact(referenced)
+    assert other_store.get(referenced_again) == blobs[1]
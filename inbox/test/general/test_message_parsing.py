@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 """Sanity-check our construction of a Message object from raw synced data."""
 import datetime
+import pickle
 import pkgutil
 
 import pytest
 from flanker import mime
 
 from inbox.models import Message, Block
+from inbox.models.message import parse_message
+from inbox.mailsync.parser import MessageParserPool
 from inbox.util.blockstore import get_from_blockstore
 
 from inbox.util.addr import parse_mimepart_address_header
@@ -87,6 +90,24 @@ def raw_message_with_long_message_id():
     return pkgutil.get_data('inbox', 'test/data/raw_message_with_long_message_id.txt')
 
 
+@pytest.fixture
+def parser_pool(request):
+    """Returns a MessageParserPool factory; the pools' workers are stopped
+    when the test finishes."""
+    pools = []
+
+    def make_pool(*args, **kwargs):
+        pool = MessageParserPool(*args, **kwargs)
+        pools.append(pool)
+        return pool
+
+    def close_pools():
+        for pool in pools:
+            pool.close()
+    request.addfinalizer(close_pools)
+    return make_pool
+
+
 def test_message_from_synced(db, new_message_from_synced, default_namespace):
     thread = add_fake_thread(db.session, default_namespace.id)
     m = new_message_from_synced
@@ -478,3 +499,43 @@ def test_long_message_id(db, default_account, thread,
     # Check that no database error is raised.
     db.session.commit()
     assert len(m.message_id_header) <= 998
+
+
+def test_create_from_parsed(default_account, raw_message_with_filename_attachment):
+    received_date = datetime.datetime(2014, 9, 22, 17, 25, 46)
+    parsed_message = parse_message(default_account.id, 22, '[Gmail]/All Mail',
+                                   received_date,
+                                   raw_message_with_filename_attachment)
+    # Parse results are passed between processes.
+    parsed_message = pickle.loads(pickle.dumps(parsed_message))
+    m = Message.create_from_parsed(default_account, parsed_message)
+    expected = Message.create_from_synced(
+        default_account, 22, '[Gmail]/All Mail', received_date,
+        raw_message_with_filename_attachment)
+    for field in ('data_sha256', 'subject', 'from_addr', 'to_addr',
+                  'received_date', 'size', 'body', 'snippet', 'decode_error'):
+        assert getattr(m, field) == getattr(expected, field)
+    assert [(p.block.filename, p.block.data) for p in m.parts] == \
+        [(p.block.filename, p.block.data) for p in expected.parts]
+
+
+def test_parser_pool(default_account, mime_message, parser_pool):
+    received_date = datetime.datetime(2014, 9, 22, 17, 25, 46)
+    pool = parser_pool(2)
+    raw_message = mime_message.to_string()
+    results = pool.parse_all(
+        [(default_account.id, uid, '[Gmail]/All Mail', received_date,
+          raw_message) for uid in range(3)])
+    assert results == [parse_message(default_account.id, 0, '[Gmail]/All Mail',
+                                     received_date, raw_message)] * 3
+
+
+def test_parser_pool_timeout(default_account, mime_message, parser_pool):
+    received_date = datetime.datetime(2014, 9, 22, 17, 25, 46)
+    pool = parser_pool(1, timeout=0)
+    parsed_message = pool.parse(default_account.id, 22, '[Gmail]/All Mail',
+                                received_date, mime_message.to_string())
+    m = Message.create_from_parsed(default_account, parsed_message)
+    assert m.decode_error
+    assert m.received_date == received_date
+    assert m.body == ''
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 # flake8: noqa: F401
 import pytest
-from inbox.util.threading import fetch_corresponding_thread
+from inbox.util.threading import (fetch_corresponding_thread, ThreadingIndex,
+                                  threading_index, drop_threading_index)
 from inbox.util.misc import cleanup_subject
 from inbox.test.util.base import (add_fake_message, add_fake_thread,
                              add_fake_imapuid)
@@ -77,5 +78,51 @@ def test_self_send(db, default_namespace):
     assert matched_thread is first_thread, "Should match on self-send"
 
 
+def test_threading_index(db, default_namespace):
+    index = ThreadingIndex(default_namespace.id)
+    first_thread = add_fake_thread(db.session, default_namespace.id)
+    first_thread.subject = 'Some kind of test'
+    add_fake_message(db.session, default_namespace.id,
+                     thread=first_thread,
+                     subject='Some kind of test',
+                     from_addr=[('Karim Hamidou', 'karim@nilas.com')],
+                     to_addr=[('Eben Freeman', 'emfree@nilas.com')])
+
+    msg2 = add_fake_message(db.session, default_namespace.id, thread=None,
+                            subject='Re: Some kind of test',
+                            from_addr=[('Some random dude',
+                                        'random@pobox.com')],
+                            to_addr=[('Karim Hamidou', 'karim@nilas.com')])
+    assert index.fetch_corresponding_thread(db.session, msg2) is None
+
+    # Threads created after the subject was loaded are found via add().
+    second_thread = add_fake_thread(db.session, default_namespace.id)
+    second_thread.subject = 'Some kind of test'
+    msg2.thread = second_thread
+    db.session.commit()
+    index.add(msg2)
+
+    msg3 = add_fake_message(db.session, default_namespace.id, thread=None,
+                            subject='RE: some kind of test',
+                            from_addr=[('Karim Hamidou', 'karim@nilas.com')],
+                            to_addr=[('Some random dude',
+                                      'random@pobox.com')])
+    assert index.fetch_corresponding_thread(db.session, msg3) is second_thread
+
+    msg4 = add_fake_message(db.session, default_namespace.id, thread=None,
+                            subject='Re: Some kind of test',
+                            from_addr=[('Eben Freeman', 'emfree@nilas.com')],
+                            to_addr=[('Karim Hamidou', 'karim@nilas.com')])
+    assert index.fetch_corresponding_thread(db.session, msg4) is first_thread
+
+
+def test_threading_index_is_dropped(default_namespace):
+    index = threading_index(default_namespace.id)
+    assert threading_index(default_namespace.id) is index
+    drop_threading_index(default_namespace.id)
+    assert threading_index(default_namespace.id) is not index
+    drop_threading_index(default_namespace.id)
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
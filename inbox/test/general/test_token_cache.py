@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+from inbox.util.token_cache import (CachedToken, TokenCache,
+                                    RedisTokenStore, cached_token)
+
+
+class DictTokenStore(object):
+
+    def __init__(self):
+        self.tokens = {}
+        self.locks = {}
+
+    def get(self, key):
+        return self.tokens.get(key)
+
+    def put(self, key, token):
+        self.tokens[key] = token
+
+    def delete(self, key):
+        self.tokens.pop(key, None)
+
+    def acquire_lock(self, key):
+        if key in self.locks:
+            return None
+        lock_id = self.locks[key] = object()
+        return lock_id
+
+    def release_lock(self, key, lock_id):
+        if self.locks.get(key) is lock_id:
+            del self.locks[key]
+
+
+def token_source(lifetime=3600):
+    tokens = []
+
+    def new_token():
+        tokens.append('token{}'.format(len(tokens) + 1))
+        return tokens[-1], datetime.utcnow() + timedelta(seconds=lifetime)
+    return new_token, tokens
+
+
+def test_token_cache_shares_tokens_between_processes():
+    store = DictTokenStore()
+    cache, other_cache = TokenCache(store), TokenCache(store)
+    new_token, tokens = token_source()
+
+    assert cache.get('key', new_token).value == 'token1'
+    assert other_cache.get('key', new_token).value == 'token1'
+    assert cache.get('key', new_token).value == 'token1'
+    assert tokens == ['token1']
+
+    # A token that a caller found invalid is only refreshed once.
+    assert other_cache.get('key', new_token,
+                           force_refresh=True).value == 'token2'
+    assert cache.get('key', new_token, force_refresh=True).value == 'token2'
+    assert tokens == ['token1', 'token2']
+
+    cache.delete('key')
+    assert other_cache.peek('key').value == 'token2'
+    assert cache.peek('key') is None
+    assert other_cache.get('key', new_token).value == 'token2'
+
+
+def test_token_cache_refreshes_tokens_before_they_expire():
+    store = DictTokenStore()
+    cache, other_cache = TokenCache(store), TokenCache(store)
+    new_token, tokens = token_source(lifetime=60)
+    token = cache.get('key', new_token)
+    # Short-lived tokens are refreshed halfway through their lifetime.
+    assert timedelta(seconds=29) < token.expiration - token.refresh_at <= \
+        timedelta(seconds=30)
+
+    now = datetime.utcnow()
+    store.put('key', CachedToken('expiring', now + timedelta(seconds=10),
+                                 now - timedelta(seconds=1)))
+    # Another process is refreshing the token, so keep using this one.
+    lock_id = store.acquire_lock('key')
+    assert other_cache.get('key', new_token).value == 'expiring'
+    store.release_lock('key', lock_id)
+    assert other_cache.get('key', new_token).value == 'token2'
+    assert store.get('key').value == 'token2'
+    assert tokens == ['token1', 'token2']
+
+
+def test_redis_token_store(redis_client):
+    store = RedisTokenStore(redis_client)
+    expiration = datetime.utcnow().replace(microsecond=0) + \
+        timedelta(seconds=3600)
+    token = cached_token(['token', ['scope']], expiration)
+    store.put('key', token)
+    assert store.get('key') == token
+    assert redis_client.ttl('token:key') > 3500
+
+    lock_id = store.acquire_lock('key')
+    assert lock_id is not None
+    assert store.acquire_lock('key') is None
+
+    store.delete('key')
+    assert store.get('key') is None
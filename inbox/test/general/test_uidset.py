@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+from inbox.util.uidset import UIDSet
+
+
+def test_uid_set_operations_match_sets():
+    rng = random.Random(0)
+    for _ in xrange(500):
+        a = set(rng.sample(xrange(1, 200), rng.randint(0, 120)))
+        b = set(rng.sample(xrange(1, 200), rng.randint(0, 120)))
+        uids_a, uids_b = UIDSet(a), UIDSet(sorted(b))
+        assert list(uids_a) == sorted(a)
+        assert list(reversed(uids_a)) == sorted(a, reverse=True)
+        assert len(uids_a) == len(a)
+        assert list(uids_a - uids_b) == sorted(a - b)
+        assert list(uids_a - b) == sorted(a - b)
+        assert list(uids_a & uids_b) == sorted(a & b)
+        assert list(uids_a | uids_b) == sorted(a | b)
+        assert len(uids_a - uids_b) == len(a - b)
+        assert {uid for uid in xrange(201) if uid in uids_a} == a
+        assert UIDSet(uids_a) == uids_a == UIDSet(list(a)) == \
+            UIDSet.from_sorted(iter(sorted(a)))
+
+
+def test_uid_set_stores_ranges():
+    uids = UIDSet([7, 1, 2, 3, 5, 8, 3])
+    assert list(uids.ranges()) == [(1, 3), (5, 5), (7, 8)]
+    assert repr(uids) == "UIDSet('1:3,5,7:8')"
+    assert (uids.min(), uids.max()) == (1, 8)
+    assert not UIDSet()
+    with pytest.raises(ValueError):
+        UIDSet().max()
+
+    uids = UIDSet(xrange(1, 1000001)) - UIDSet([500000])
+    assert len(uids) == 999999
+    assert list(uids.ranges()) == [(1, 499999), (500001, 1000000)]
@@ -202,6 +202,30 @@ def test_flags(generic_client, constants):
     assert generic_client.flags([uid]) == {uid: Flags(flags, None)}
 
 
+def test_condstore_changes_with_qresync(generic_client, constants):
+    expected_resp = '{seq} (FLAGS {flags} ' \
+                    'UID {uid} MODSEQ ({modseq}))'.format(**constants)
+    imap = generic_client.conn._imap
+    imap._command_complete.return_value = ('OK', ['Success'])
+    # A stale response, e.g. from IDLE in another folder.
+    imap.untagged_responses = {'VANISHED': ['12']}
+
+    def untagged_response(typ, data, name):
+        imap.untagged_responses['VANISHED'] = ['(EARLIER) 300:310,405,411',
+                                               '402:401']
+        return 'OK', [expected_resp]
+    imap._untagged_response.side_effect = untagged_response
+
+    uid = constants['uid']
+    flags = constants['flags']
+    modseq = constants['modseq']
+    generic_client.qresync_enabled = True
+    changed_flags, vanished_uids = generic_client.condstore_changes(1)
+    assert changed_flags == {uid: Flags(flags, modseq)}
+    assert list(vanished_uids) == range(300, 311) + [401, 402, 405, 411]
+    assert 'VANISHED' not in imap.untagged_responses
+
+
 def test_body(generic_client, constants):
     expected_resp = ('{seq} (UID {uid} MODSEQ ({modseq}) '
                      'INTERNALDATE "{internaldate}" FLAGS {flags} '
@@ -225,6 +249,36 @@ def test_body(generic_client, constants):
     ]
 
 
+def test_batched_body_fetch_fallback(monkeypatch, generic_client, constants):
+    """ Test that we fall back to single-UID fetches, and remember to keep
+        doing so, if a server rejects a multi-UID body fetch.
+    """
+    from inbox.crispin import _no_batch_fetch
+    fetched = []
+
+    def fetch(uids, data, modifiers=None):
+        if isinstance(uids, list):
+            raise imapclient.IMAPClient.Error('UID FETCH Bad sequence set')
+        fetched.append(uids)
+        return {uids: {'INTERNALDATE': datetime(2015, 3, 2, 23, 36, 20),
+                       'FLAGS': constants['flags'],
+                       'BODY[]': constants['body'],
+                       'SEQ': constants['seq']}}
+
+    monkeypatch.setattr(generic_client.conn, 'fetch', fetch)
+    try:
+        messages = generic_client.uids([1, 2, 3])
+        assert [m.uid for m in messages] == [1, 2, 3]
+        assert sorted(fetched) == [1, 2, 3]
+        assert generic_client.account_id in _no_batch_fetch
+
+        del fetched[:]
+        generic_client.uids([4, 5])
+        assert sorted(fetched) == [4, 5]
+    finally:
+        _no_batch_fetch.discard(generic_client.account_id)
+
+
 def test_internaldate(generic_client, constants):
     """ Test that our monkeypatched imaplib works through imapclient """
     dates_to_test = [
@@ -75,6 +75,41 @@ def test_deleting_from_a_message_with_multiple_uids(db, default_account,
         "The message should have only one imapuid."
 
 
+def test_remove_deleted_uids_in_chunks(db, default_account, thread, folder,
+                                       monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.DELETE_CHUNK_SIZE', 2)
+    messages = []
+    for msg_uid in range(1, 6):
+        message = add_fake_message(db.session, default_account.namespace.id,
+                                   thread)
+        add_fake_imapuid(db.session, default_account.id, message, folder,
+                         msg_uid)
+        messages.append(message)
+    draft = messages[-1]
+    draft.is_draft = True
+    db.session.commit()
+    draft_id = draft.id
+    latest_transaction = db.session.query(Transaction).order_by(
+        desc(Transaction.id)).first()
+
+    remove_deleted_uids(default_account.id, folder.id, range(1, 6))
+    db.session.expire_all()
+
+    for message in messages[:-1]:
+        assert message.deleted_at is not None
+        assert message.imapuids == []
+    with pytest.raises(ObjectDeletedError):
+        draft.id
+    # Every message still gets its own transaction log entry.
+    transactions = db.session.query(Transaction).filter(
+        Transaction.id > latest_transaction.id,
+        Transaction.object_type.in_(['message', 'draft'])).all()
+    assert sorted((t.record_id, t.command) for t in transactions) == \
+        sorted([(m.id, 'update') for m in messages[:-1]] +
+               [(draft_id, 'delete')])
+
+
 def test_deletion_with_short_ttl(db, default_account, default_namespace,
                                  marked_deleted_message, thread, folder):
     handler = DeleteHandler(account_id=default_account.id,
@@ -1,5 +1,6 @@
 # flake8: noqa: F401, F811
 import pytest
+from datetime import datetime
 from hashlib import sha256
 from gevent.lock import BoundedSemaphore
 from sqlalchemy.orm.exc import ObjectDeletedError
@@ -10,6 +11,7 @@ from inbox.mailsync.backends.imap.generic import (FolderSyncEngine, UidInvalid,
                                                   MAX_UIDINVALID_RESYNCS)
 from inbox.mailsync.backends.gmail import GmailFolderSyncEngine
 from inbox.mailsync.backends.base import MailsyncDone
+from inbox.crispin import CrispinClient
 from inbox.test.imap.data import uids, uid_data # noqa
 from inbox.util.testutils import mock_imapclient  # noqa
 
@@ -71,6 +73,88 @@ def test_initial_sync(db, generic_account, inbox_folder, mock_imapclient):
                                     uid_dict.values()}
 
 
+def test_initial_sync_downloads_in_batches(db, generic_account, inbox_folder,
+                                           mock_imapclient):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    body_fetches = []
+    original_fetch = mock_imapclient.fetch
+
+    def fetch(items, data, modifiers=None):
+        if 'BODY.PEEK[]' in data:
+            body_fetches.append(items)
+        return original_fetch(items, data, modifiers)
+    mock_imapclient.fetch = fetch
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    # A handful of small messages should all come down in a single FETCH.
+    assert len(body_fetches) == 1
+    assert sorted(body_fetches[0]) == sorted(uid_dict)
+
+
+def test_download_pipeline_commits_in_fetch_order(db, generic_account,
+                                                  inbox_folder,
+                                                  mock_imapclient):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    committed = []
+    commit_uids = folder_sync_engine.commit_uids
+
+    def recording_commit_uids(raw_messages, start, parsed_messages=None):
+        # Every message should have been parsed ahead of the commit stage.
+        assert set(parsed_messages) == {m.uid for m in raw_messages}
+        committed.append([m.uid for m in raw_messages])
+        return commit_uids(raw_messages, start, parsed_messages)
+    folder_sync_engine.commit_uids = recording_commit_uids
+
+    batches = [[uid] for uid in sorted(uid_dict, reverse=True)]
+    with folder_sync_engine.conn_pool.get() as crispin_client:
+        crispin_client.select_folder(inbox_folder.name, lambda *args: True)
+        yielded = list(folder_sync_engine.download_pipelined(crispin_client,
+                                                             batches))
+    assert yielded == batches
+    assert committed == batches
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+
+
+def test_download_pipeline_reraises_fetch_errors(db, generic_account,
+                                                 inbox_folder):
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+
+    class FailingCrispinClient(object):
+        def uids(self, uids):
+            raise ValueError('fetch failed')
+
+    with pytest.raises(ValueError):
+        list(folder_sync_engine.download_pipelined(FailingCrispinClient(),
+                                                   [[1], [2], [3]]))
+
+
 def test_new_uids_synced_when_polling(db, generic_account, inbox_folder,
                                       mock_imapclient):
     uid_dict = uids.example()
@@ -129,6 +213,85 @@ def test_condstore_flags_refresh(db, default_account, all_mail_folder,
         all_mail_folder.name, ['HIGHESTMODSEQ'])['HIGHESTMODSEQ']
 
 
+def test_condstore_flags_refresh_expunges_vanished_uids(
+        db, default_account, all_mail_folder, mock_imapclient, monkeypatch):
+    uid_dict = uids.example()
+    for k, v in uid_dict.items():
+        v['MODSEQ'] = (k,)
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    mock_imapclient.capabilities = lambda: ['CONDSTORE', 'QRESYNC']
+
+    folder_sync_engine = FolderSyncEngine(default_account.id,
+                                          default_account.namespace.id,
+                                          all_mail_folder.name,
+                                          default_account.email_address,
+                                          'gmail',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+    # The server tells us which UIDs were expunged, so there's no need to
+    # compare all of them.
+    monkeypatch.setattr(CrispinClient, 'all_uids',
+                        lambda self: pytest.fail('fetched all UIDs'))
+
+    expunged_uid = min(uid_dict)
+    remaining_uids = set(uid_dict) - {expunged_uid}
+    mock_imapclient.select_folder(all_mail_folder.name)
+    mock_imapclient.delete_messages([expunged_uid])
+    folder_sync_engine.highestmodseq = 0
+    # Don't sleep at the end of poll_impl before returning.
+    folder_sync_engine.poll_frequency = 0
+    folder_sync_engine.poll_impl()
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == all_mail_folder.id)
+    assert {u.msg_uid for u in saved_uids} == remaining_uids
+
+
+def test_condstore_flags_refresh_checks_for_expunges_without_qresync(
+        db, default_account, all_mail_folder, mock_imapclient, monkeypatch):
+    uid_dict = uids.example()
+    for k, v in uid_dict.items():
+        v['MODSEQ'] = (k,)
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    mock_imapclient.capabilities = lambda: ['CONDSTORE']
+
+    folder_sync_engine = FolderSyncEngine(default_account.id,
+                                          default_account.namespace.id,
+                                          all_mail_folder.name,
+                                          default_account.email_address,
+                                          'gmail',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+    folder_sync_engine.last_expunge_check = datetime.utcnow()
+    all_uids = CrispinClient.all_uids
+    all_uids_calls = []
+
+    def counting_all_uids(self):
+        all_uids_calls.append(self)
+        return all_uids(self)
+    monkeypatch.setattr(CrispinClient, 'all_uids', counting_all_uids)
+
+    # Flag changes alone don't need all of the folder's UIDs...
+    for v in uid_dict.values():
+        v['X-GM-LABELS'] = ('newlabel',)
+    folder_sync_engine.highestmodseq = 0
+    # Don't sleep at the end of poll_impl before returning.
+    folder_sync_engine.poll_frequency = 0
+    folder_sync_engine.poll_impl()
+    assert not all_uids_calls
+
+    # ...but a drop in the folder's message count does.
+    expunged_uid = min(uid_dict)
+    remaining_uids = set(uid_dict) - {expunged_uid}
+    mock_imapclient.select_folder(all_mail_folder.name)
+    mock_imapclient.delete_messages([expunged_uid])
+    folder_sync_engine.highestmodseq = 0
+    folder_sync_engine.poll_impl()
+    assert len(all_uids_calls) == 1
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == all_mail_folder.id)
+    assert {u.msg_uid for u in saved_uids} == remaining_uids
+
+
 def test_generic_flags_refresh_expunges_transient_uids(
         db, generic_account, inbox_folder, mock_imapclient, monkeypatch):
     # Check that we delete UIDs which are synced but quickly deleted, so never
@@ -291,6 +454,140 @@ def test_gmail_message_deduplication(db, default_account, all_mail_folder,
         Message.g_msgid == uid_values['X-GM-MSGID']).count() == 1
 
 
+def test_gmail_thread_expansion_uses_thread_map(db, default_account,
+                                                all_mail_folder,
+                                                mock_imapclient):
+    uid_dict = uids.example()
+    # Put all the messages on one thread, started by the oldest.
+    g_thrid = uid_dict[min(uid_dict)]['X-GM-MSGID']
+    for uid, values in uid_dict.items():
+        values['X-GM-THRID'] = g_thrid
+        values['X-GM-MSGID'] = g_thrid + uid - min(uid_dict)
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    mock_imapclient.list_folders = lambda: [(('\\All', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/All Mail')]
+    mock_imapclient.idle = lambda: None
+    mock_imapclient.idle_check = raise_imap_error
+
+    searches = []
+    original_search = mock_imapclient.search
+
+    def search(criteria):
+        searches.append(criteria)
+        return original_search(criteria)
+    mock_imapclient.search = search
+
+    folder_sync_engine = GmailFolderSyncEngine(default_account.id,
+                                               default_account.namespace.id,
+                                               all_mail_folder.name,
+                                               default_account.email_address,
+                                               'gmail',
+                                               BoundedSemaphore(1))
+    thread_maps = []
+    build_thread_map = folder_sync_engine.build_thread_map
+
+    def record_thread_map(crispin_client, uids):
+        thread_maps.append(build_thread_map(crispin_client, uids))
+        return thread_maps[-1]
+    folder_sync_engine.build_thread_map = record_thread_map
+    folder_sync_engine.initial_sync()
+
+    assert thread_maps == [{g_thrid: sorted(uid_dict)}]
+    # It's dropped once the initial sync is done.
+    assert folder_sync_engine.thread_map is None
+    assert not [c for c in searches if c[0] == 'X-GM-THRID']
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == all_mail_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+
+
+def test_gmail_skips_bodies_of_known_messages(db, default_account,
+                                              all_mail_folder, trash_folder,
+                                              mock_imapclient):
+    uid_dict = uids.example()
+    mock_imapclient.list_folders = lambda: [(('\\All', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/All Mail'),
+                                            (('\\Trash', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/Trash')]
+    mock_imapclient.idle = lambda: None
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    mock_imapclient.add_folder_data(trash_folder.name, dict(uid_dict))
+    mock_imapclient.idle_check = raise_imap_error
+
+    all_folder_sync_engine = GmailFolderSyncEngine(
+        default_account.id, default_account.namespace.id, all_mail_folder.name,
+        default_account.email_address, 'gmail',
+        BoundedSemaphore(1))
+    all_folder_sync_engine.initial_sync()
+
+    body_fetches = []
+    original_fetch = mock_imapclient.fetch
+
+    def fetch(items, data, modifiers=None):
+        if 'BODY.PEEK[]' in data:
+            body_fetches.append(items)
+        return original_fetch(items, data, modifiers)
+    mock_imapclient.fetch = fetch
+
+    trash_folder_sync_engine = GmailFolderSyncEngine(
+        default_account.id, default_account.namespace.id, trash_folder.name,
+        default_account.email_address, 'gmail',
+        BoundedSemaphore(1))
+    trash_folder_sync_engine.initial_sync()
+
+    # The messages were only downloaded from All Mail, but are in both.
+    assert body_fetches == []
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == trash_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    assert db.session.query(Message).filter(
+        Message.namespace_id == default_account.namespace.id,
+        Message.g_msgid.in_([v['X-GM-MSGID'] for v in uid_dict.values()])). \
+        count() == len({v['X-GM-MSGID'] for v in uid_dict.values()})
+
+
+def test_gmail_downloads_known_messages_deleted_before_commit(
+        db, default_account, all_mail_folder, trash_folder, mock_imapclient):
+    uid_dict = uids.example()
+    mock_imapclient.list_folders = lambda: [(('\\All', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/All Mail'),
+                                            (('\\Trash', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/Trash')]
+    mock_imapclient.idle = lambda: None
+    mock_imapclient.add_folder_data(all_mail_folder.name, uid_dict)
+    mock_imapclient.add_folder_data(trash_folder.name, dict(uid_dict))
+    mock_imapclient.idle_check = raise_imap_error
+
+    all_folder_sync_engine = GmailFolderSyncEngine(
+        default_account.id, default_account.namespace.id, all_mail_folder.name,
+        default_account.email_address, 'gmail',
+        BoundedSemaphore(1))
+    all_folder_sync_engine.initial_sync()
+
+    trash_folder_sync_engine = GmailFolderSyncEngine(
+        default_account.id, default_account.namespace.id, trash_folder.name,
+        default_account.email_address, 'gmail',
+        BoundedSemaphore(1))
+    fetch_known_uids = trash_folder_sync_engine.fetch_known_uids
+
+    def fetch_and_delete(crispin_client, uids, metadata):
+        raw_messages = fetch_known_uids(crispin_client, uids, metadata)
+        # The messages are deleted before their new UIDs are committed.
+        for message in db.session.query(Message).filter(
+                Message.namespace_id == default_account.namespace.id,
+                Message.g_msgid.in_([m.g_msgid for m in raw_messages])):
+            db.session.delete(message)
+        db.session.commit()
+        return raw_messages
+    trash_folder_sync_engine.fetch_known_uids = fetch_and_delete
+    trash_folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == trash_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    assert not trash_folder_sync_engine.redownload_uids
+
+
 def test_imap_message_deduplication(db, generic_account, inbox_folder,
                                     generic_trash_folder, mock_imapclient):
     uid = 22
@@ -1,5 +1,6 @@
 import pytest
 import json
+from sqlalchemy import event
 from inbox.crispin import GmailFlags, Flags
 from inbox.models.backends.imap import ImapUid
 from inbox.mailsync.backends.imap.common import (update_metadata,
@@ -52,6 +53,31 @@ def test_generic_drafts_flag_constrained_by_folder(db, generic_account,
     assert message.is_draft == (folder_role == 'drafts')
 
 
+def test_update_metadata_commits_once_per_batch(db, generic_account):
+    thread = add_fake_thread(db.session, generic_account.namespace.id)
+    folder = add_fake_folder(db.session, generic_account)
+    messages = []
+    for msg_uid in range(1, 6):
+        message = add_fake_message(db.session, generic_account.namespace.id,
+                                   thread)
+        add_fake_imapuid(db.session, generic_account.id, message, folder,
+                         msg_uid)
+        messages.append(message)
+
+    commits = []
+    event.listen(db.session, 'after_commit', commits.append)
+    try:
+        new_flags = {msg_uid: Flags(('\\Seen',), None)
+                     for msg_uid in range(1, 6)}
+        update_metadata(generic_account.id, folder.id, folder.canonical_name,
+                        new_flags, db.session)
+    finally:
+        event.remove(db.session, 'after_commit', commits.append)
+
+    assert len(commits) == 1
+    assert all(message.is_read for message in messages)
+
+
 def test_update_categories_when_actionlog_entry_missing(
         db, default_account, message, imapuid):
     message.categories_changes = True
@@ -0,0 +1,96 @@
+# flake8: noqa: F401, F811
+import contextlib
+import json
+
+import gevent
+import pytest
+
+from inbox.models import Folder
+from inbox.search.backends.imap import IMAPSearchClient
+from inbox.test.util.base import (add_fake_message, add_fake_imapuid,
+                                  add_fake_thread, generic_account)
+
+
+class FakeConnection(object):
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.selected = None
+
+    def search(self, criteria, charset=None):
+        delay, uids = self.folders[self.selected]
+        gevent.sleep(delay)
+        return uids
+
+
+class FakeCrispinClient(object):
+
+    def __init__(self, folders):
+        self.conn = FakeConnection(folders)
+
+    def select_folder(self, folder_name, uidvalidity_cb):
+        self.conn.selected = folder_name
+
+
+class FakePool(object):
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.connections = 0
+
+    @contextlib.contextmanager
+    def get(self):
+        self.connections += 1
+        yield FakeCrispinClient(self.folders)
+
+
+@pytest.fixture
+def search_folders(db, generic_account, monkeypatch):
+    # Folder name -> (time the server takes to search it, matching UIDs).
+    folders = {'slow': (0.5, [1]), 'medium': (0.2, [2]), 'fast': (0, [3])}
+    namespace_id = generic_account.namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    messages = {}
+    for name, (_, uids) in folders.items():
+        folder = Folder.find_or_create(db.session, generic_account, name)
+        message = add_fake_message(db.session, namespace_id, thread,
+                                   subject=name)
+        add_fake_imapuid(db.session, generic_account.id, message, folder,
+                         uids[0])
+        messages[name] = message
+    db.session.commit()
+
+    pool = FakePool(folders)
+    monkeypatch.setattr('inbox.search.backends.imap.connection_pool',
+                        lambda account_id: pool)
+    monkeypatch.setattr('inbox.search.backends.imap.SEARCH_CONNECTIONS', 3)
+    return messages
+
+
+def test_search_streams_folders_as_they_finish(db, generic_account,
+                                               search_folders):
+    search_client = IMAPSearchClient(generic_account)
+    lines = [json.loads(line) for line in
+             search_client.stream_messages('foo')()]
+    assert [[m['subject'] for m in line] for line in lines] == \
+        [['fast'], ['medium'], ['slow']]
+    assert not search_client.partial
+
+
+def test_search_folder_timeout(db, generic_account, search_folders,
+                               monkeypatch):
+    monkeypatch.setattr('inbox.search.backends.imap.SEARCH_FOLDER_TIMEOUT',
+                        0.3)
+    search_client = IMAPSearchClient(generic_account)
+    results = search_client.search_messages(db.session, 'foo')
+    assert set(results) == {search_folders['fast'], search_folders['medium']}
+    assert search_client.partial
+
+
+def test_search_deadline(db, generic_account, search_folders, monkeypatch):
+    monkeypatch.setattr('inbox.search.backends.imap.SEARCH_TIMEOUT', 0.1)
+    search_client = IMAPSearchClient(generic_account)
+    lines = [json.loads(line) for line in
+             search_client.stream_messages('foo')()]
+    assert lines == [[lines[0][0]], {'partial': True}]
+    assert lines[0][0]['subject'] == 'fast'
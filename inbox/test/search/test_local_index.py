@@ -0,0 +1,77 @@
+# flake8: noqa: F401, F811
+import pytest
+
+from inbox.config import config
+from inbox.search.local import LocalSearchIndex
+from inbox.search.backends.imap import IMAPSearchClient
+from inbox.transactions.search import LocalSearchIndexService
+from inbox.test.util.base import (add_fake_message, add_fake_thread,
+                                  generic_account)
+
+
+@pytest.fixture
+def local_index_dir(monkeypatch, tmpdir):
+    monkeypatch.setitem(config, 'LOCAL_SEARCH_INDEX_DIRECTORY', str(tmpdir))
+    monkeypatch.setattr('inbox.search.local._indexes', {})
+    return tmpdir
+
+
+@pytest.fixture
+def invoice_messages(db, generic_account):
+    namespace_id = generic_account.namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    in_subject = add_fake_message(
+        db.session, namespace_id, thread, subject='Your invoice',
+        from_addr=[('Ben Bitdiddle', 'ben@bitdiddle.com')])
+    in_body = add_fake_message(
+        db.session, namespace_id, add_fake_thread(db.session, namespace_id),
+        subject='Hello', body='<p>Please find the invoices attached</p>')
+    add_fake_message(db.session, namespace_id, thread, subject='Unrelated')
+    return [in_subject, in_body]
+
+
+def test_local_index_search(db, tmpdir, invoice_messages):
+    index = LocalSearchIndex(str(tmpdir.join('index.db')))
+    in_subject, in_body = invoice_messages
+    namespace_id = in_subject.namespace_id
+    index.index_messages(invoice_messages)
+
+    # Subject matches rank above body matches, and prefixes match.
+    assert index.search_messages(namespace_id, 'invoice') == \
+        [in_subject.id, in_body.id]
+    assert index.search_messages(namespace_id, 'invoice', offset=1,
+                                 limit=1) == [in_body.id]
+    assert index.search_messages(namespace_id, 'bitdiddle') == \
+        [in_subject.id]
+    assert index.search_threads(namespace_id, 'invoice') == \
+        [in_subject.thread_id, in_body.thread_id]
+    assert index.search_messages(namespace_id + 1, 'invoice') == []
+    # Query syntax is treated as text.
+    assert index.search_messages(namespace_id, 'invoice" OR "hello') == []
+
+    index.delete_messages([in_subject.id])
+    assert index.search_messages(namespace_id, 'invoice') == [in_body.id]
+
+
+def test_imap_search_uses_complete_local_index(db, generic_account,
+                                               local_index_dir,
+                                               invoice_messages):
+    search_client = IMAPSearchClient(generic_account)
+    service = LocalSearchIndexService()
+    # The first pass starts following the transaction log and backfills the
+    # namespace's existing messages.
+    service._index_shard(0)
+
+    # No IMAP connection is needed.
+    assert search_client.search_messages(db.session, 'invoice') == \
+        invoice_messages
+    assert search_client.search_threads(db.session, 'invoice', limit=1) == \
+        [invoice_messages[0].thread]
+
+    # New messages are picked up from the transaction log.
+    new_message = add_fake_message(
+        db.session, generic_account.namespace.id, invoice_messages[0].thread,
+        subject='Another invoice')
+    service._index_shard(0)
+    assert new_message in search_client.search_messages(db.session,
+                                                        'invoice')
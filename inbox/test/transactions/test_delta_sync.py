@@ -223,3 +223,29 @@ def test_account_delta_for_different_namespace_id(db):
     txns, _ = format_transactions_after_pointer(namespace, 0, db.session, 10,
                                                 exclude_account=False)
     assert txns
+
+
+def test_deltas_are_scoped_to_namespace(db, default_namespace, thread):
+    from sqlalchemy import func
+    from inbox.models import Transaction
+    from inbox.test.util.base import add_generic_imap_account, add_fake_thread
+    from inbox.transactions.delta_sync import format_transactions_after_pointer
+
+    other_namespace = add_generic_imap_account(
+        db.session, email_address='other@example.com').namespace
+    pointer = db.session.query(func.max(Transaction.id)).scalar()
+    add_fake_message(db.session, other_namespace.id,
+                     add_fake_thread(db.session, other_namespace.id))
+    message = add_fake_message(db.session, default_namespace.id, thread)
+    add_fake_message(db.session, other_namespace.id,
+                     add_fake_thread(db.session, other_namespace.id))
+
+    deltas, new_pointer = format_transactions_after_pointer(
+        default_namespace, pointer, db.session, 100)
+    delta_ids = {d['id'] for d in deltas}
+    assert message.public_id in delta_ids
+    assert delta_ids <= {message.public_id, thread.public_id}
+    assert all(d['attributes']['account_id'] == default_namespace.public_id
+               for d in deltas)
+    assert new_pointer == db.session.query(func.max(Transaction.id)). \
+        filter(Transaction.namespace_id == default_namespace.id).scalar()
@@ -0,0 +1,44 @@
+from inbox.transactions.notifier import ChangeNotifier
+from inbox.test.util.base import add_fake_message
+
+
+def test_committed_transactions_notify_watches(db, default_namespace, thread,
+                                               monkeypatch):
+    notifier = ChangeNotifier()
+    monkeypatch.setattr('inbox.transactions.notifier._notifier', notifier)
+    with notifier.watch(default_namespace.id, 1) as watch, \
+            notifier.watch(default_namespace.id + 1, 1) as other_watch:
+        assert watch.check()
+        assert other_watch.check()
+
+        add_fake_message(db.session, default_namespace.id, thread)
+        assert watch.event.is_set()
+        assert not other_watch.event.is_set()
+
+        db.session.rollback()
+        assert not db.session.info.get('new_transactions')
+
+
+def test_watch_checks_only_when_notified(monkeypatch):
+    notifier = ChangeNotifier()
+    notifier.listening = True
+    with notifier.watch(1, 0) as watch:
+        assert watch.check()
+        assert not watch.check()
+
+        notifier._notify(2)
+        assert not watch.check()
+        notifier._notify(1)
+        assert watch.check()
+        assert not watch.check()
+
+        # Check every so often anyway, in case a notification went missing.
+        monkeypatch.setattr('inbox.transactions.notifier.MAX_WAIT', 0)
+        assert watch.check()
+
+        # Poll while we aren't listening to notifications.
+        monkeypatch.setattr('inbox.transactions.notifier.MAX_WAIT', 30)
+        notifier.listening = False
+        assert watch.check()
+        assert watch.check()
+    assert not notifier._watches
@@ -0,0 +1,178 @@
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import asc, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import func
+from gevent import Greenlet, sleep
+
+from inbox.api import filtering
+from inbox.contacts.rankings import ContactScores
+from inbox.ignition import engine_manager
+from inbox.models import Transaction, Message, Namespace
+from inbox.models.data_processing import (DataProcessingCache,
+                                          DataProcessingCursor)
+from inbox.models.session import session_scope_by_shard_id
+from inbox.util.stats import statsd_client
+
+from nylas.logging import get_logger
+from nylas.logging.sentry import log_uncaught_errors
+
+log = get_logger()
+
+
+class ContactRankingsService(Greenlet):
+    """
+    Keep namespaces' contact rankings and groups (see inbox.contacts.rankings)
+    up to date: poll the transaction log for messages on every shard, and
+    backfill the sent messages of namespaces that haven't been scored yet.
+
+    """
+
+    def __init__(self, poll_interval=30, chunk_size=1000):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+
+        self.log = log.new(component='contact-rankings')
+        Greenlet.__init__(self)
+
+    def _run(self):
+        try:
+            self.log.info('Starting contact-rankings service')
+            while True:
+                statsd_client.incr('contact_rankings.heartbeat')
+                should_sleep = True
+                for key in engine_manager.engines:
+                    if self._process_shard(key):
+                        should_sleep = False
+                if should_sleep:
+                    sleep(self.poll_interval)
+        except Exception:
+            log_uncaught_errors(log)
+
+    def _process_shard(self, key):
+        """Returns True if there was anything to process."""
+        try:
+            with session_scope_by_shard_id(key) as db_session:
+                processed = self._process_transactions(db_session)
+                backfilled = self._backfill(db_session)
+        except Exception:
+            # Keep going with the other shards, and retry this one later.
+            self.log.error('Error processing shard', shard_id=key,
+                           exc_info=True)
+            return False
+        return processed or backfilled
+
+    def _process_transactions(self, db_session):
+        cursor = db_session.query(DataProcessingCursor).first()
+        if cursor is None:
+            # Never start from 0; namespaces' existing messages are
+            # backfilled instead.
+            cursor = DataProcessingCursor(transaction_id=db_session.query(
+                func.max(Transaction.id)).scalar())
+            db_session.add(cursor)
+            db_session.commit()
+
+        transactions = db_session.query(Transaction).filter(
+            Transaction.id > (cursor.transaction_id or 0),
+            Transaction.object_type == 'message',
+            Transaction.command != 'delete'). \
+            order_by(asc(Transaction.id)).limit(self.chunk_size).all()
+        if not transactions:
+            return False
+
+        message_ids = defaultdict(set)
+        for transaction in transactions:
+            message_ids[transaction.namespace_id].add(transaction.record_id)
+        # Namespaces that haven't started being backfilled count these
+        # messages when they do.
+        dpcaches = db_session.query(DataProcessingCache).filter(
+            DataProcessingCache.namespace_id.in_(message_ids),
+            DataProcessingCache._contact_scores.isnot(None)).all()
+        # Work out every namespace's scores before changing any, so that a
+        # namespace that fails can be skipped without losing the others.
+        states = []
+        for dpcache in dpcaches:
+            namespace_id = dpcache.namespace_id
+            try:
+                messages = filtering.messages_for_contact_scores(
+                    db_session, namespace_id,
+                    message_ids=message_ids[namespace_id])
+                if not messages:
+                    continue
+                scores = ContactScores(dpcache.contact_scores)
+                scores.add_messages(messages,
+                                    _user_email(db_session, dpcache))
+                if dpcache.contact_scores_backfilled and \
+                        scores.groups_due():
+                    scores.recalculate_groups()
+            except Exception:
+                db_session.rollback()
+                self.log.error('Error updating contact scores',
+                               namespace_id=namespace_id, exc_info=True)
+                continue
+            states.append((dpcache, scores.to_state()))
+        for dpcache, state in states:
+            dpcache.contact_scores = state
+
+        cursor.transaction_id = transactions[-1].id
+        db_session.commit()
+
+        latency = (datetime.utcnow() - transactions[0].created_at).seconds
+        statsd_client.timing('contact_rankings.transactions.latency', latency)
+        return True
+
+    def _backfill(self, db_session):
+        namespace_ids = [namespace_id for namespace_id, in db_session.query(
+            Namespace.id).outerjoin(
+                DataProcessingCache,
+                DataProcessingCache.namespace_id == Namespace.id).filter(
+                    or_(DataProcessingCache.id.is_(None),
+                        ~DataProcessingCache.contact_scores_backfilled))]
+        for namespace_id in namespace_ids:
+            try:
+                try:
+                    self._backfill_namespace(db_session, namespace_id)
+                except IntegrityError:
+                    # The API created the namespace's DataProcessingCache at
+                    # the same time as we did; use that one.
+                    db_session.rollback()
+                    self._backfill_namespace(db_session, namespace_id)
+            except Exception:
+                db_session.rollback()
+                self.log.error('Error backfilling contact scores',
+                               namespace_id=namespace_id, exc_info=True)
+        return bool(namespace_ids)
+
+    def _backfill_namespace(self, db_session, namespace_id):
+        dpcache = db_session.query(DataProcessingCache).filter(
+            DataProcessingCache.namespace_id == namespace_id).first()
+        if dpcache is None:
+            dpcache = DataProcessingCache(namespace_id=namespace_id)
+            db_session.add(dpcache)
+        state = dpcache.contact_scores
+        if state is None:
+            # Count messages from now on, and backfill the ones before.
+            scores = ContactScores()
+            scores.start_backfill(db_session.query(
+                func.max(Message.id)).filter(
+                    Message.namespace_id == namespace_id).scalar() or 0)
+            dpcache.contact_scores = scores.to_state()
+            db_session.commit()
+        else:
+            scores = ContactScores(state)
+
+        messages = filtering.messages_for_contact_scores(
+            db_session, namespace_id, after_id=scores.backfill_pointer,
+            max_id=scores.backfill_until, limit=self.chunk_size)
+        scores.backfill(messages, _user_email(db_session, dpcache))
+        if len(messages) < self.chunk_size:
+            scores.recalculate_groups()
+            dpcache.contact_scores_backfilled = True
+            self.log.info('namespace backfilled', namespace_id=namespace_id)
+        dpcache.contact_scores = scores.to_state()
+        db_session.commit()
+
+
+def _user_email(db_session, dpcache):
+    return db_session.query(Namespace).get(dpcache.namespace_id).email_address
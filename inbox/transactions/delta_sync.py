@@ -1,14 +1,14 @@
 import time
-import gevent
 import collections
 from datetime import datetime
 
 from sqlalchemy import asc, desc, bindparam
 from inbox.api.kellogs import APIEncoder, encode
-from inbox.models import Transaction, Message, Thread, Account, Namespace
+from inbox.models import Transaction, Message, Account, Namespace
 from inbox.models.session import session_scope
 from inbox.models.util import transaction_objects
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.transactions.notifier import get_change_notifier
 
 
 EVENT_NAME_FOR_COMMAND = {
@@ -141,7 +141,14 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
         transactions = db_session.query(Transaction).filter(Transaction.id > pointer)
 
         if filter_for_namespace:
-            transactions.filter(Transaction.namespace_id == namespace.id)
+            # Only read the namespace's own transactions. Left to itself,
+            # MySQL tends to walk the primary key from `pointer` instead,
+            # reading every other namespace's transactions on the shard too.
+            # InnoDB secondary indexes end with the primary key, so
+            # idx_namespace is already ordered by id within a namespace.
+            transactions = transactions.filter(
+                Transaction.namespace_id == namespace.id). \
+                with_hint(Transaction, 'FORCE INDEX (idx_namespace)', 'mysql')
 
         if exclude_types is not None:
             transactions = transactions.filter(
@@ -177,7 +184,10 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
 
             object_cls = transaction_objects()[obj_type]
 
-            if object_cls == Account:
+            if not ids_to_query:
+                # Deletes don't need their objects.
+                objects = {}
+            elif object_cls == Account:
                 # The base query for Account queries the /Namespace/ table
                 # since the API-returned "`account`" is a `namespace`
                 # under-the-hood.
@@ -185,7 +195,7 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
                     Account.id.in_(ids_to_query))
 
                 if filter_for_namespace:
-                    query.filter(Namespace.id == namespace.id)
+                    query = query.filter(Namespace.id == namespace.id)
 
                 # Key by /namespace.account_id/ --
                 # namespace.id may not be equal to account.id
@@ -196,12 +206,13 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
                     object_cls.id.in_(ids_to_query))
 
                 if filter_for_namespace:
-                    query.filter(object_cls.namespace_id == namespace.id)
+                    query = query.filter(
+                        object_cls.namespace_id == namespace.id)
 
-                if object_cls == Thread:
-                    query = query.options(*Thread.api_loading_options(expand))
+                if hasattr(object_cls, 'api_loading_options'):
+                    query = query.options(
+                        *object_cls.api_loading_options(expand))
                 if object_cls == Message:
-                    query = query.options(*Message.api_loading_options(expand))
                     # T7045: Workaround for some SQLAlchemy bugs.
                     objects = {obj.id: obj for obj in query if obj.thread is not None}
                 else:
@@ -254,7 +265,8 @@ def streaming_change_generator(namespace, poll_interval, timeout,
     namespace_id: int
         Id of the namespace for which to check changes.
     poll_interval: float
-        How often to check for changes.
+        How often to check for changes. When changes are pushed by the
+        ChangeNotifier, how often to send a keep-alive instead.
     timeout: float
         How many seconds to allow the connection to remain open.
     transaction_pointer: int, optional
@@ -264,17 +276,26 @@ def streaming_change_generator(namespace, poll_interval, timeout,
     """
     encoder = APIEncoder(is_n1=is_n1)
     start_time = time.time()
-    while time.time() - start_time < timeout:
-        with session_scope(namespace.id) as db_session:
-            deltas, new_pointer = format_transactions_after_pointer(
-                namespace, transaction_pointer, db_session, 100,
-                exclude_types, include_types, exclude_folders,
-                exclude_metadata, exclude_account, expand=expand, is_n1=is_n1)
-
-        if new_pointer is not None and new_pointer != transaction_pointer:
-            transaction_pointer = new_pointer
-            for delta in deltas:
-                yield encoder.cereal(delta) + '\n'
-        else:
+    with get_change_notifier().watch(namespace.id, poll_interval) as watch:
+        while time.time() - start_time < timeout:
+            # Only query the transaction log if the namespace may have changed
+            # since we last did.
+            if watch.check():
+                with session_scope(namespace.id) as db_session:
+                    deltas, new_pointer = format_transactions_after_pointer(
+                        namespace, transaction_pointer, db_session, 100,
+                        exclude_types, include_types, exclude_folders,
+                        exclude_metadata, exclude_account, expand=expand,
+                        is_n1=is_n1)
+
+                if (new_pointer is not None and
+                        new_pointer != transaction_pointer):
+                    transaction_pointer = new_pointer
+                    for delta in deltas:
+                        yield encoder.cereal(delta) + '\n'
+                    # There may be more.
+                    watch.event.set()
+                    continue
+
             yield '\n'
-            gevent.sleep(poll_interval)
+            watch.wait()
@@ -0,0 +1,209 @@
+"""
+Change notifications for the delta APIs.
+
+Open /delta/longpoll and /delta/streaming requests used to query the
+transaction log every second or so, whether or not anything had changed.
+Instead, sessions publish the namespace ids and latest transaction ids of
+the transactions they commit, and waiting requests only query the log when
+their namespace has changed.
+
+Notifications are published on a Redis pub/sub channel, which each API
+process listens to with a single connection. If
+DELTA_NOTIFICATIONS_REDIS_HOSTNAME isn't set, notifications are only
+delivered within the process that committed the transactions, so requests
+keep polling at their usual interval. Requests also query the log at least
+every DELTA_NOTIFICATIONS_MAX_WAIT seconds, and whenever the connection to
+Redis is lost, in case a notification went missing.
+
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import gevent
+from gevent.event import Event
+from redis import StrictRedis
+from sqlalchemy import inspect
+
+from inbox.config import config
+from nylas.logging import get_logger
+log = get_logger()
+
+CHANNEL = 'delta_notifications'
+SOCKET_CONNECT_TIMEOUT = 5
+SOCKET_TIMEOUT = 5
+RECONNECT_INTERVAL = 5
+
+MAX_WAIT = config.get('DELTA_NOTIFICATIONS_MAX_WAIT', 30)
+
+_notifier = None
+
+
+def get_change_notifier():
+    global _notifier
+    if _notifier is None:
+        redis = None
+        redis_host = config.get('DELTA_NOTIFICATIONS_REDIS_HOSTNAME')
+        if redis_host:
+            redis = StrictRedis(
+                host=redis_host,
+                port=config.get('DELTA_NOTIFICATIONS_REDIS_PORT', 6379),
+                db=config.get('DELTA_NOTIFICATIONS_REDIS_DB', 0),
+                socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                socket_timeout=SOCKET_TIMEOUT)
+        _notifier = ChangeNotifier(redis)
+    return _notifier
+
+
+def record_transaction(session, transaction):
+    """Record that `transaction` was added to the session."""
+    session.info.setdefault('new_transactions', []).append(transaction)
+
+
+def publish_committed_transactions(session):
+    """
+    Publish the transactions committed by the session. Must be called after
+    commit.
+
+    """
+    transactions = session.info.pop('new_transactions', None)
+    if not transactions:
+        return
+    latest = {}
+    for transaction in transactions:
+        # The transaction's attributes were expired by the commit, so read
+        # its id from its identity rather than loading it again.
+        identity = inspect(transaction).identity
+        if identity is None:
+            continue
+        latest[transaction.namespace_id] = max(
+            identity[0], latest.get(transaction.namespace_id, 0))
+    if latest:
+        get_change_notifier().publish(latest)
+
+
+def discard_transactions(session):
+    """Forget the session's transactions, which were rolled back."""
+    session.info.pop('new_transactions', None)
+
+
+class ChangeNotifier(object):
+    """
+    Delivers the notifications published by every process (or, without
+    Redis, by this process) to watches on the namespaces they're for.
+
+    """
+
+    def __init__(self, redis=None):
+        self.redis = redis
+        # namespace id -> Events of the watches on that namespace.
+        self._watches = defaultdict(set)
+        self._listener = None
+        # Whether we're receiving every process's notifications.
+        self.listening = False
+
+    def publish(self, latest):
+        """
+        Publish a dictionary of namespace id -> id of its latest committed
+        transaction.
+
+        """
+        if self.redis is None:
+            for namespace_id in latest:
+                self._notify(namespace_id)
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for namespace_id, transaction_id in latest.iteritems():
+                pipe.publish(CHANNEL, '{}:{}'.format(namespace_id,
+                                                     transaction_id))
+            pipe.execute()
+        except Exception:
+            # Waiting requests will find the changes when they next query the
+            # transaction log anyway.
+            log.warning('Error publishing delta notifications', exc_info=True)
+
+    @contextmanager
+    def watch(self, namespace_id, poll_interval):
+        """
+        Watch a namespace for changes. Yields a Watch, whose check() says
+        whether the namespace may have changed since it was last called.
+
+        """
+        if self.redis is not None and self._listener is None:
+            self._listener = gevent.spawn(self._listen)
+        watch = Watch(self, poll_interval)
+        self._watches[namespace_id].add(watch.event)
+        try:
+            yield watch
+        finally:
+            events = self._watches[namespace_id]
+            events.discard(watch.event)
+            if not events:
+                del self._watches[namespace_id]
+
+    def _notify(self, namespace_id):
+        for event in self._watches.get(namespace_id, ()):
+            event.set()
+
+    def _notify_all(self):
+        for events in self._watches.values():
+            for event in events:
+                event.set()
+
+    def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(CHANNEL)
+                self.listening = True
+                # Changes may have been published while we weren't listening.
+                self._notify_all()
+                while True:
+                    message = pubsub.get_message(timeout=SOCKET_TIMEOUT)
+                    if message is None:
+                        continue
+                    namespace_id, _ = message['data'].split(':')
+                    self._notify(int(namespace_id))
+            except Exception:
+                log.warning('Lost connection to delta notifications',
+                            exc_info=True)
+            finally:
+                self.listening = False
+                self._notify_all()
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            gevent.sleep(RECONNECT_INTERVAL)
+
+
+class Watch(object):
+
+    def __init__(self, notifier, poll_interval):
+        self.notifier = notifier
+        self.poll_interval = poll_interval
+        self.event = Event()
+        self.last_checked = None
+
+    def check(self):
+        """
+        Whether to query the transaction log: when a notification arrived
+        since we last did, if we can't rely on notifications, or if we
+        haven't for a while.
+
+        """
+        now = time.time()
+        if (self.event.is_set() or not self.notifier.listening or
+                self.last_checked is None or
+                now - self.last_checked >= MAX_WAIT):
+            # Clear before querying, so that changes committed while we query
+            # aren't missed.
+            self.event.clear()
+            self.last_checked = now
+            return True
+        return False
+
+    def wait(self):
+        """Wait for a notification, for up to the poll interval."""
+        self.event.wait(self.poll_interval)
@@ -6,14 +6,21 @@ from sqlalchemy.sql import func
 from sqlalchemy.orm import joinedload
 from gevent import Greenlet, sleep
 
+from inbox.config import config
 from inbox.ignition import engine_manager
 from inbox.util.itert import partition
-from inbox.models import Transaction, Contact
+from inbox.models import Transaction, Contact, Message, Namespace
+from inbox.models.data_processing import DataProcessingCache
 from inbox.util.stats import statsd_client
 from inbox.models.session import session_scope_by_shard_id
 from inbox.models.search import ContactSearchIndexCursor
 from inbox.contacts.search import (get_doc_service, DOC_UPLOAD_CHUNK_SIZE,
                                    cloudsearch_contact_repr)
+from inbox.contacts.local_search import (get_local_contact_index,
+                                         local_contact_index_enabled,
+                                         scores_due)
+from inbox.contacts.rankings import ContactScores
+from inbox.search.local import get_local_index, uses_local_index
 
 from nylas.logging import get_logger
 from nylas.logging.sentry import log_uncaught_errors
@@ -25,11 +32,15 @@ class ContactSearchIndexService(Greenlet):
     """
     Poll the transaction log for contact operations
     (inserts, updates, deletes) for all namespaces and perform the
-    corresponding CloudSearch index operations.
+    corresponding CloudSearch index operations, or update the local contact
+    index (see inbox.contacts.local_search) if that's the configured backend.
 
     """
 
     def __init__(self, poll_interval=30, chunk_size=DOC_UPLOAD_CHUNK_SIZE):
+        if local_contact_index_enabled():
+            # Fail at startup rather than on the first contact transaction.
+            config.get_required('CONTACT_SEARCH_INDEX_DIRECTORY')
         self.poll_interval = poll_interval
         self.chunk_size = chunk_size
         self.transaction_pointers = {}
@@ -102,7 +113,7 @@ class ContactSearchIndexService(Greenlet):
                 # index up to chunk_size transactions
                 should_sleep = False
                 if transactions:
-                    self.index(transactions, db_session)
+                    self.index(transactions, db_session, key)
                     oldest_transaction = min(
                         transactions, key=lambda t: t.created_at)
                     current_timestamp = datetime.utcnow()
@@ -114,6 +125,8 @@ class ContactSearchIndexService(Greenlet):
                     db_session.commit()
                 else:
                     should_sleep = True
+                if local_contact_index_enabled():
+                    self.refresh_scores(key, db_session)
             shard_should_sleep.append(should_sleep)
         if all(shard_should_sleep):
             log.info('sleeping')
@@ -137,22 +150,32 @@ class ContactSearchIndexService(Greenlet):
         except Exception:
             log_uncaught_errors(log)
 
-    def index(self, transactions, db_session):
+    def index(self, transactions, db_session, shard_id):
         """
         Translate database operations to CloudSearch index operations
         and perform them.
 
         """
-        docs = []
-        doc_service = get_doc_service()
         add_txns, delete_txns = partition(
             lambda trx: trx.command == 'delete', transactions)
-        delete_docs = [{'type': 'delete', 'id': txn.record_id}
-                       for txn in delete_txns]
         add_record_ids = [txn.record_id for txn in add_txns]
         add_records = db_session.query(Contact).options(
             joinedload("phone_numbers")).filter(
                 Contact.id.in_(add_record_ids))
+
+        if local_contact_index_enabled():
+            index = get_local_contact_index(shard_id)
+            index.delete_contacts([txn.record_id for txn in delete_txns])
+            add_records = add_records.all()
+            index.index_contacts(add_records)
+            self.log.info('contacts indexed', adds=len(add_records),
+                          deletes=len(delete_txns))
+            return
+
+        docs = []
+        doc_service = get_doc_service()
+        delete_docs = [{'type': 'delete', 'id': txn.record_id}
+                       for txn in delete_txns]
         add_docs = [{'type': 'add', 'id': obj.id,
                      'fields': cloudsearch_contact_repr(obj)}
                     for obj in add_records]
@@ -167,6 +190,27 @@ class ContactSearchIndexService(Greenlet):
         self.log.info('docs indexed', adds=len(add_docs),
                       deletes=len(delete_docs))
 
+    def refresh_scores(self, shard_id, db_session):
+        """
+        Copy the shard's namespaces' contact rankings into the local index,
+        so that search results are ranked by them.
+
+        """
+        index = get_local_contact_index(shard_id)
+        index_state = index.scores_state()
+        for namespace_id, updated_at in db_session.query(
+                DataProcessingCache.namespace_id,
+                DataProcessingCache.contact_scores_last_updated).filter(
+                    DataProcessingCache.contact_scores_backfilled):
+            if not scores_due(updated_at, index_state.get(namespace_id)):
+                continue
+            dpcache = db_session.query(DataProcessingCache).filter(
+                DataProcessingCache.namespace_id == namespace_id).one()
+            scores = ContactScores(dpcache.contact_scores)
+            index.update_scores(namespace_id, scores.rankings(), updated_at)
+            self.log.info('contact scores refreshed',
+                          namespace_id=namespace_id)
+
     def update_pointer(self, new_pointer, shard_key, db_session):
         """
         Persist transaction pointer to support restarts, update
@@ -179,3 +223,101 @@ class ContactSearchIndexService(Greenlet):
             db_session.add(pointer)
         pointer.transaction_id = new_pointer
         self.transaction_pointers[shard_key] = new_pointer
+
+
+class LocalSearchIndexService(Greenlet):
+    """
+    Keep the local message search index (see inbox.search.local) up to date:
+    poll the transaction log for message operations on every shard, and
+    backfill the messages of namespaces that haven't been completely indexed
+    yet.
+
+    """
+
+    def __init__(self, poll_interval=30, chunk_size=100):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+
+        self.log = log.new(component='local-search-index')
+        Greenlet.__init__(self)
+
+    def _run(self):
+        try:
+            self.log.info('Starting local-search-index service')
+            while True:
+                statsd_client.incr('local_search_index.heartbeat')
+                should_sleep = True
+                for key in engine_manager.engines:
+                    if self._index_shard(key):
+                        should_sleep = False
+                if should_sleep:
+                    sleep(self.poll_interval)
+        except Exception:
+            log_uncaught_errors(log)
+
+    def _index_shard(self, key):
+        """Returns True if there was anything to index."""
+        index = get_local_index(key)
+        with session_scope_by_shard_id(key) as db_session:
+            namespace_ids = {
+                namespace.id for namespace in db_session.query(Namespace).
+                options(joinedload(Namespace.account))
+                if namespace.account is not None and
+                uses_local_index(namespace.account)}
+            indexed = self._index_transactions(index, namespace_ids,
+                                               db_session)
+            backfilled = self._backfill(index, namespace_ids, db_session)
+        return indexed or backfilled
+
+    def _index_transactions(self, index, namespace_ids, db_session):
+        pointer = index.transaction_pointer()
+        if pointer is None:
+            # Never start from 0; namespaces' existing messages are
+            # backfilled instead.
+            pointer = db_session.query(func.max(Transaction.id)).scalar() or 0
+            index.update_transaction_pointer(pointer)
+
+        transactions = db_session.query(Transaction).filter(
+            Transaction.id > pointer,
+            Transaction.object_type.in_(['message', 'draft'])). \
+            order_by(asc(Transaction.id)).limit(self.chunk_size).all()
+        if not transactions:
+            return False
+
+        update_txns, delete_txns = partition(
+            lambda trx: trx.command == 'delete',
+            [trx for trx in transactions if trx.namespace_id in namespace_ids])
+        index.delete_messages([txn.record_id for txn in delete_txns])
+        update_record_ids = {txn.record_id for txn in update_txns}
+        if update_record_ids:
+            index.index_messages(db_session.query(Message).filter(
+                Message.id.in_(update_record_ids)))
+        index.update_transaction_pointer(transactions[-1].id)
+
+        latency = (datetime.utcnow() - transactions[0].created_at).seconds
+        statsd_client.timing('local_search_index.transactions.latency',
+                             latency)
+        self.log.info('messages indexed', updates=len(update_record_ids),
+                      deletes=len(delete_txns))
+        return True
+
+    def _backfill(self, index, namespace_ids, db_session):
+        backfilled = False
+        for namespace_id in namespace_ids:
+            if index.is_complete(namespace_id):
+                continue
+            pointer = index.backfill_pointer(namespace_id)
+            messages = db_session.query(Message).filter(
+                Message.namespace_id == namespace_id,
+                Message.id > pointer).order_by(asc(Message.id)). \
+                limit(self.chunk_size).all()
+            index.index_messages(messages)
+            if messages:
+                pointer = messages[-1].id
+            complete = len(messages) < self.chunk_size
+            index.update_backfill(namespace_id, pointer, complete)
+            if complete:
+                self.log.info('namespace backfilled',
+                              namespace_id=namespace_id)
+            backfilled = True
+        return backfilled
@@ -0,0 +1,294 @@
+"""
+A read cache in front of the blockstore.
+
+Blockstore data is addressed by its hash, so it never changes and cached
+copies never need invalidating. The cache has two tiers, each of which can be
+turned on or off:
+
+* An in-memory LRU cache of small blobs (BLOCKSTORE_MEMORY_CACHE).
+* An LRU cache of blobs of any size in a local directory
+  (BLOCKSTORE_DISK_CACHE), which is mostly useful when the blockstore is S3.
+
+Data is verified against its hash before it's cached, so cached data isn't
+verified again when it's read. Files are written to the disk cache under a
+temporary name and renamed into place, so partly written files are never
+read.
+
+The disk cache's size limit is enforced by each process for the files it knows
+about: the ones that were in the directory when it started, and the ones it
+has cached since.
+
+"""
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from inbox.config import config
+from inbox.util.file import mkdirp, remove_file
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+MEMORY_CACHE = config.get('BLOCKSTORE_MEMORY_CACHE', True)
+MEMORY_CACHE_SIZE = config.get('BLOCKSTORE_MEMORY_CACHE_SIZE', 64 << 20)
+MEMORY_CACHE_MAX_BLOB_SIZE = config.get(
+    'BLOCKSTORE_MEMORY_CACHE_MAX_BLOB_SIZE', 256 << 10)
+DISK_CACHE = config.get('BLOCKSTORE_DISK_CACHE', False)
+DISK_CACHE_SIZE = config.get('BLOCKSTORE_DISK_CACHE_SIZE', 10 << 30)
+STALE_TEMPORARY_FILE_AGE = 3600
+
+_cache = None
+
+
+def get_blob_cache():
+    global _cache
+    if _cache is None:
+        memory = disk = None
+        if MEMORY_CACHE:
+            memory = MemoryTier(MEMORY_CACHE_SIZE, MEMORY_CACHE_MAX_BLOB_SIZE)
+        if DISK_CACHE:
+            disk = DiskTier(
+                config.get_required('BLOCKSTORE_DISK_CACHE_DIRECTORY'),
+                DISK_CACHE_SIZE)
+        _cache = BlobCache(memory, disk)
+    return _cache
+
+
+class BlobCache(object):
+
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, data_sha256):
+        """ Return the cached data with the given hash, or None. """
+        if self.memory is not None:
+            data = self.memory.get(data_sha256)
+            if data is not None:
+                return data
+        if self.disk is not None:
+            data = self.disk.get(data_sha256)
+            if data is not None:
+                if self.memory is not None:
+                    self.memory.put(data_sha256, data)
+                return data
+        return None
+
+    def put(self, data_sha256, data):
+        """ Cache data, which must have been verified against its hash. """
+        if self.memory is not None:
+            self.memory.put(data_sha256, data)
+        if self.disk is not None:
+            try:
+                self.disk.put(data_sha256, data)
+            except (IOError, OSError):
+                log.warning('Error writing to the blockstore disk cache',
+                            exc_info=True)
+
+    def fill(self, data_sha256, size):
+        """
+        Return a CacheFill to cache data with the given hash and size as it's
+        read a chunk at a time, or None if no tier would cache it.
+
+        """
+        memory = self.memory is not None and \
+            size <= self.memory.max_blob_size
+        if not memory and self.disk is None:
+            return None
+        return CacheFill(self, data_sha256, memory)
+
+
+class CacheFill(object):
+    """
+    Caches data as it's read from the blockstore a chunk at a time, if it's
+    read in full and verified: call write() with each chunk, and then either
+    commit() or discard().
+
+    """
+
+    def __init__(self, cache, data_sha256, memory):
+        self.cache = cache
+        self.data_sha256 = data_sha256
+        self.chunks = [] if memory else None
+        self.file = None
+        if cache.disk is not None:
+            try:
+                self.file = cache.disk.begin(data_sha256)
+            except (IOError, OSError):
+                self._disk_error()
+
+    def write(self, chunk):
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+        if self.file is not None:
+            try:
+                self.file.write(chunk)
+            except (IOError, OSError):
+                self._disk_error()
+
+    def commit(self):
+        if self.chunks is not None:
+            self.cache.memory.put(self.data_sha256, ''.join(self.chunks))
+        if self.file is not None:
+            try:
+                self.cache.disk.commit(self.data_sha256, self.file)
+            except (IOError, OSError):
+                self._disk_error()
+            self.file = None
+
+    def discard(self):
+        if self.file is not None:
+            self.cache.disk.discard(self.file)
+            self.file = None
+
+    def _disk_error(self):
+        # Failing to cache data mustn't stop it being read.
+        log.warning('Error writing to the blockstore disk cache',
+                    exc_info=True)
+        self.discard()
+
+
+class MemoryTier(object):
+
+    def __init__(self, max_size, max_blob_size):
+        self.max_size = max_size
+        self.max_blob_size = max_blob_size
+        self.size = 0
+        # data_sha256 -> data, least recently used first.
+        self._blobs = OrderedDict()
+
+    def get(self, data_sha256):
+        data = self._blobs.pop(data_sha256, None)
+        if data is None:
+            statsd_client.incr('blockstore.cache.memory.miss')
+            return None
+        statsd_client.incr('blockstore.cache.memory.hit')
+        self._blobs[data_sha256] = data
+        return data
+
+    def put(self, data_sha256, data):
+        if len(data) > self.max_blob_size or data_sha256 in self._blobs:
+            return
+        self._blobs[data_sha256] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self._blobs.popitem(last=False)
+            self.size -= len(evicted)
+            statsd_client.incr('blockstore.cache.memory.eviction')
+
+
+class DiskTier(object):
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        # data_sha256 -> file size, least recently used first.
+        self._files = None
+
+    def path(self, data_sha256):
+        """ The path of the cached file with the given hash, or None. """
+        self._load()
+        size = self._files.pop(data_sha256, None)
+        if size is None:
+            statsd_client.incr('blockstore.cache.disk.miss')
+            return None
+        path = self._path(data_sha256)
+        if not os.path.exists(path):
+            # Another process evicted it.
+            self.size -= size
+            statsd_client.incr('blockstore.cache.disk.miss')
+            return None
+        statsd_client.incr('blockstore.cache.disk.hit')
+        self._files[data_sha256] = size
+        return path
+
+    def get(self, data_sha256):
+        path = self.path(data_sha256)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            self._forget(data_sha256)
+            return None
+
+    def put(self, data_sha256, data):
+        f = self.begin(data_sha256)
+        if f is None:
+            return
+        try:
+            f.write(data)
+        except Exception:
+            self.discard(f)
+            raise
+        self.commit(data_sha256, f)
+
+    def begin(self, data_sha256):
+        """
+        Open a temporary file to write data with the given hash to, or return
+        None if it's already cached.
+
+        """
+        self._load()
+        if data_sha256 in self._files:
+            return None
+        path = self._path(data_sha256)
+        mkdirp(os.path.dirname(path))
+        return open('{}.{}.tmp'.format(path, uuid.uuid4().hex), 'wb')
+
+    def commit(self, data_sha256, f):
+        f.close()
+        size = os.path.getsize(f.name)
+        os.rename(f.name, self._path(data_sha256))
+        if data_sha256 not in self._files:
+            self._files[data_sha256] = size
+            self.size += size
+        while self.size > self.max_size and self._files:
+            self._forget(next(iter(self._files)))
+            statsd_client.incr('blockstore.cache.disk.eviction')
+
+    def discard(self, f):
+        try:
+            f.close()
+        finally:
+            remove_file(f.name)
+
+    def _forget(self, data_sha256):
+        size = self._files.pop(data_sha256, None)
+        if size is not None:
+            self.size -= size
+            remove_file(self._path(data_sha256))
+
+    def _path(self, data_sha256):
+        return os.path.join(self.directory, data_sha256[:2], data_sha256)
+
+    def _load(self):
+        # Index the files that are already cached, least recently used first,
+        # the first time the cache is used.
+        if self._files is not None:
+            return
+        files = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith('.tmp'):
+                    # Left over from a process that didn't finish writing it
+                    # (unless another process is writing it now).
+                    if time.time() - stat.st_mtime > STALE_TEMPORARY_FILE_AGE:
+                        remove_file(path)
+                    continue
+                files.append((stat.st_atime, filename, stat.st_size))
+        files.sort()
+        self._files = OrderedDict()
+        for _, data_sha256, size in files:
+            self._files[data_sha256] = size
+            self.size += size
+        log.info('Indexed blockstore disk cache', directory=self.directory,
+                 files=len(self._files), size=self.size)
@@ -1,20 +1,41 @@
 import os
 import time
+from collections import OrderedDict
 from hashlib import sha256
 
+import gevent
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+
 from inbox.config import config
+from inbox.util.blobcache import get_blob_cache
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
 
 # TODO: store AWS credentials in a better way.
 STORE_MSG_ON_S3 = config.get('STORE_MESSAGES_ON_S3', None)
+# Whether to pack data on disk into segment files (see inbox.util.packstore),
+# rather than store each blob in a file of its own. Data that hasn't been
+# packed yet is still read from its own file.
+PACKED_BLOCKSTORE = config.get('PACKED_BLOCKSTORE', False)
+
+# How much data to read at a time when streaming from the blockstore.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The background writer's workers, how many saves can queue up for them before
+# callers have to wait, and how many of the hashes it has saved it remembers.
+WRITERS = config.get('BLOCKSTORE_WRITERS', 8)
+WRITE_QUEUE_SIZE = config.get('BLOCKSTORE_WRITE_QUEUE_SIZE', 100)
+KNOWN_HASHES = config.get('BLOCKSTORE_KNOWN_HASHES', 10000)
+WRITE_TIMEOUT = config.get('BLOCKSTORE_WRITE_TIMEOUT', 60)
 
 if STORE_MSG_ON_S3:
     from boto.s3.connection import S3Connection
     from boto.s3.key import Key
 else:
     from inbox.util.file import mkdirp
+    from inbox.util.packstore import get_packed_store, CODEC_RAW
 
     def _data_file_directory(h):
         return os.path.join(config.get_required('MSG_PARTS_DIRECTORY'),
@@ -32,8 +53,14 @@ def save_to_blockstore(data_sha256, data):
         log.warning('Not saving 0-length data blob')
         return
 
+    _save(data_sha256, data)
+
+
+def _save(data_sha256, data, bucket=None):
     if STORE_MSG_ON_S3:
-        _save_to_s3(data_sha256, data)
+        _save_to_s3(data_sha256, data, bucket)
+    elif PACKED_BLOCKSTORE:
+        get_packed_store().put(data_sha256, data)
     else:
         directory = _data_file_directory(data_sha256)
         mkdirp(directory)
@@ -42,29 +69,33 @@ def save_to_blockstore(data_sha256, data):
             f.write(data)
 
 
-def _save_to_s3(data_sha256, data):
+def _save_to_s3(data_sha256, data, bucket=None):
     assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
         'Need temp bucket name to store message data!'
 
     _save_to_s3_bucket(data_sha256,
-                       config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'), data)
+                       config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'), data,
+                       bucket)
 
 
-def _save_to_s3_bucket(data_sha256, bucket_name, data):
+def _get_s3_bucket(bucket_name):
     assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
     assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
-    start = time.time()
 
     # Boto pools connections at the class level
     conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
                         config.get('AWS_SECRET_ACCESS_KEY'))
-    bucket = conn.get_bucket(bucket_name, validate=False)
+    return conn.get_bucket(bucket_name, validate=False)
 
-    # See if it already exists; if so, don't recreate.
-    key = bucket.get_key(data_sha256)
-    if key:
-        return
 
+def _save_to_s3_bucket(data_sha256, bucket_name, data, bucket=None):
+    start = time.time()
+
+    if bucket is None:
+        bucket = _get_s3_bucket(bucket_name)
+
+    # Keys are the data's hash, so overwriting one that already exists is
+    # harmless, and cheaper than checking for it first.
     key = Key(bucket)
     key.key = data_sha256
     key.set_contents_from_string(data)
@@ -75,6 +106,13 @@ def _save_to_s3_bucket(data_sha256, bucket_name, data):
 
 
 def get_from_blockstore(data_sha256):
+    _wait_for_pending_write(data_sha256)
+
+    cache = get_blob_cache()
+    value = cache.get(data_sha256)
+    if value is not None:
+        return value
+
     if STORE_MSG_ON_S3:
         value = _get_from_s3(data_sha256)
     else:
@@ -87,6 +125,7 @@ def get_from_blockstore(data_sha256):
 
     assert data_sha256 == sha256(value).hexdigest(), \
         "Returned data doesn't match stored hash!"
+    cache.put(data_sha256, value)
     return value
 
 
@@ -134,9 +173,355 @@ def _get_from_disk(data_sha256):
     if not data_sha256:
         return None
 
+    if PACKED_BLOCKSTORE:
+        data = get_packed_store().get(data_sha256)
+        if data is not None:
+            return data
+
     try:
         with open(_data_file_path(data_sha256), 'rb') as f:
             return f.read()
     except IOError:
         log.error('No file with name: {}!'.format(data_sha256))
         return
+
+
+def open_from_blockstore(data_sha256):
+    """
+    Open the data with the given hash so that it can be streamed, rather than
+    read into memory all at once. Returns a StoredBlob, or None if the
+    blockstore doesn't have the data.
+
+    """
+    if not data_sha256:
+        return None
+
+    _wait_for_pending_write(data_sha256)
+
+    cache = get_blob_cache()
+    if cache.memory is not None:
+        data = cache.memory.get(data_sha256)
+        if data is not None:
+            return _MemoryBlob(data_sha256, data)
+    if cache.disk is not None:
+        path = cache.disk.path(data_sha256)
+        if path is not None:
+            try:
+                # Open the file now, so that it can still be read if another
+                # process evicts it before we're done.
+                f = open(path, 'rb')
+            except IOError:
+                pass
+            else:
+                return _DiskBlob(data_sha256, os.fstat(f.fileno()).st_size,
+                                 path, f, verified=True)
+
+    if STORE_MSG_ON_S3:
+        blob = _open_from_s3(data_sha256)
+    else:
+        blob = _open_from_disk(data_sha256)
+    if blob is not None:
+        blob.cache = cache
+    return blob
+
+
+class StoredBlob(object):
+    """ Data in the blockstore, which can be read a chunk at a time. """
+
+    def __init__(self, data_sha256, size, verified=False):
+        self.data_sha256 = data_sha256
+        self.size = size
+        # Whether the data has already been checked against its hash.
+        self.verified = verified
+        # The BlobCache to cache the data in when it's streamed in full.
+        self.cache = None
+
+    def stream(self, start=0, stop=None):
+        """
+        Yield the data from byte `start` up to (but not including) byte
+        `stop`, or the end of the data, a chunk at a time.
+
+        When streaming all of the data, it's checked against its hash as it
+        goes by, and the last chunk is only yielded once it has been, so that
+        corrupt data is never delivered in full. Then it's cached.
+
+        """
+        if stop is None:
+            stop = self.size
+        verify = start == 0 and stop == self.size and not self.verified
+        fill = None
+        if verify and self.cache is not None:
+            fill = self.cache.fill(self.data_sha256, self.size)
+        hash_ = sha256()
+        previous = None
+        try:
+            for chunk in self._read_range(start, stop):
+                if verify:
+                    hash_.update(chunk)
+                if fill is not None:
+                    fill.write(chunk)
+                if previous is not None:
+                    yield previous
+                previous = chunk
+
+            if verify:
+                assert self.data_sha256 == hash_.hexdigest(), \
+                    "Returned data doesn't match stored hash!"
+            if fill is not None:
+                fill.commit()
+                fill = None
+        finally:
+            if fill is not None:
+                fill.discard()
+        if previous is not None:
+            yield previous
+
+    def _read_range(self, start, stop):
+        raise NotImplementedError
+
+
+class _MemoryBlob(StoredBlob):
+
+    def __init__(self, data_sha256, data, verified=True):
+        StoredBlob.__init__(self, data_sha256, len(data), verified)
+        self.data = data
+
+    def _read_range(self, start, stop):
+        for offset in xrange(start, stop, STREAM_CHUNK_SIZE):
+            yield self.data[offset:min(offset + STREAM_CHUNK_SIZE, stop)]
+
+
+class _DiskBlob(StoredBlob):
+
+    def __init__(self, data_sha256, size, path, f=None, verified=False,
+                 offset=0):
+        StoredBlob.__init__(self, data_sha256, size, verified)
+        self.path = path
+        self.file = f
+        # Where the data starts in the file.
+        self.offset = offset
+
+    def _read_range(self, start, stop):
+        # Unless we were given an open file, only open the file once we start
+        # streaming, so that streams which are never read don't leak file
+        # descriptors.
+        f = self.file if self.file is not None else open(self.path, 'rb')
+        with f:
+            f.seek(self.offset + start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class _S3Blob(StoredBlob):
+
+    def __init__(self, data_sha256, size, key):
+        StoredBlob.__init__(self, data_sha256, size)
+        self.key = key
+
+    def _read_range(self, start, stop):
+        if start >= stop:
+            return
+        # Only ask S3 for the bytes we need, and read the response a chunk at
+        # a time.
+        self.key.open_read(headers={
+            'Range': 'bytes={}-{}'.format(start, stop - 1)})
+        try:
+            while True:
+                chunk = self.key.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.key.close()
+
+
+def _open_from_s3(data_sha256):
+    assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
+    assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
+
+    assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
+        'Need temp bucket name to store message data!'
+
+    conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
+                        config.get('AWS_SECRET_ACCESS_KEY'))
+    bucket = conn.get_bucket(config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'),
+                             validate=False)
+
+    # get_key() only makes a HEAD request, which tells us the data's size.
+    key = bucket.get_key(data_sha256)
+
+    if not key:
+        log.info("Couldn't find data in blockstore",
+                 sha256=data_sha256, logstash_tag='s3_direct')
+        return None
+
+    return _S3Blob(data_sha256, key.size, key)
+
+
+def _open_from_disk(data_sha256):
+    if PACKED_BLOCKSTORE:
+        blob = _open_from_packed_store(data_sha256)
+        if blob is not None:
+            return blob
+
+    path = _data_file_path(data_sha256)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        log.error('No file with name: {}!'.format(data_sha256))
+        return None
+
+    return _DiskBlob(data_sha256, size, path)
+
+
+def _open_from_packed_store(data_sha256):
+    store = get_packed_store()
+    location = store.locate(data_sha256)
+    if location is None:
+        return None
+    if location.codec != CODEC_RAW:
+        # Compressed data is small, so just decompress it all.
+        data = store.get(data_sha256)
+        if data is None:
+            return None
+        return _MemoryBlob(data_sha256, data, verified=False)
+    try:
+        # Open the segment now, so that it can still be read if it's
+        # compacted before we're done.
+        f = open(location.path, 'rb')
+    except IOError:
+        # It just was.
+        data = store.get(data_sha256)
+        if data is None:
+            return None
+        return _MemoryBlob(data_sha256, data, verified=False)
+    return _DiskBlob(data_sha256, location.length, location.path, f,
+                     offset=location.offset)
+
+
+_writer = None
+
+
+def get_blockstore_writer():
+    global _writer
+    if _writer is None:
+        _writer = BlockstoreWriter(WRITERS, WRITE_QUEUE_SIZE, KNOWN_HASHES)
+    return _writer
+
+
+def save_to_blockstore_async(data_sha256, data):
+    """
+    Save data to the blockstore in the background. Returns an AsyncResult
+    that's set once the data has been saved, or None if it already has been.
+    Use wait_for_writes() to wait for it.
+
+    """
+    assert data is not None
+    assert type(data) is not unicode
+
+    return get_blockstore_writer().save(data_sha256, data)
+
+
+def wait_for_writes(writes, timeout=WRITE_TIMEOUT):
+    """
+    Wait for the given background saves to finish, raising the error of any
+    that failed.
+
+    """
+    with gevent.Timeout(timeout):
+        for write in writes:
+            write.get()
+
+
+def _store_generation():
+    # Only the packed store ever deletes data.
+    if PACKED_BLOCKSTORE and not STORE_MSG_ON_S3:
+        return get_packed_store().generation()
+    return None
+
+
+def _wait_for_pending_write(data_sha256):
+    # Data that this process is still saving may not be readable yet.
+    if _writer is not None:
+        _writer.wait(data_sha256)
+
+
+class BlockstoreWriter(object):
+    """
+    Saves data to the blockstore in a pool of worker greenlets, so that
+    callers don't wait on the blockstore for every save. Each worker keeps
+    its own S3 connection.
+
+    Saves of the same data are only made once: attachments are often shared
+    between messages, so the writer remembers the hashes of the data it has
+    saved, and saves of data that's already being saved share its result. It
+    forgets them when the packed store has been compacted, since the data may
+    have been deleted since.
+
+    """
+
+    def __init__(self, num_workers, queue_size, known_hashes):
+        self._queue = Queue(maxsize=queue_size)
+        # data_sha256 -> AsyncResult of the queued or in-progress save.
+        self._pending = {}
+        # The hashes of the data we've saved, least recently saved first.
+        self._saved = OrderedDict()
+        self._store_generation = _store_generation()
+        self.known_hashes = known_hashes
+        self._workers = [gevent.spawn(self._work) for _ in range(num_workers)]
+
+    def save(self, data_sha256, data):
+        """
+        Queue data to be saved, waiting for room in the queue if it's full.
+        Returns an AsyncResult, or None if the data's already been saved.
+
+        """
+        generation = _store_generation()
+        if generation != self._store_generation:
+            self._saved.clear()
+            self._store_generation = generation
+        if len(data) == 0 or data_sha256 in self._saved:
+            statsd_client.incr('blockstore.writer.skipped')
+            return None
+        result = self._pending.get(data_sha256)
+        if result is None:
+            result = AsyncResult()
+            self._pending[data_sha256] = result
+            self._queue.put((data_sha256, data, result))
+        return result
+
+    def wait(self, data_sha256):
+        """ Wait for any pending save of the data, without raising its error.
+        """
+        result = self._pending.get(data_sha256)
+        if result is not None:
+            result.wait(WRITE_TIMEOUT)
+
+    def _work(self):
+        bucket = None
+        while True:
+            data_sha256, data, result = self._queue.get()
+            try:
+                if STORE_MSG_ON_S3 and bucket is None:
+                    bucket = _get_s3_bucket(
+                        config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+                with statsd_client.timer('blockstore.writer.save_latency'):
+                    _save(data_sha256, data, bucket)
+            except Exception as e:
+                log.error('Error saving data to the blockstore',
+                          sha256=data_sha256, exc_info=True)
+                # Reconnect, in case it was the connection that failed.
+                bucket = None
+                del self._pending[data_sha256]
+                result.set_exception(e)
+            else:
+                self._saved[data_sha256] = True
+                if len(self._saved) > self.known_hashes:
+                    self._saved.popitem(last=False)
+                del self._pending[data_sha256]
+                result.set(None)
@@ -0,0 +1,577 @@
+"""
+A blockstore backend that packs blobs into large, append-only segment files,
+instead of writing a file per blob.
+
+Each process appends to its own segment file, `<name>.seg`, and starts a new
+one once it's bigger than PACKED_BLOCKSTORE_SEGMENT_SIZE. Segments are made of
+records:
+
++----------------+-------+--------+------------
+| sha256 (32)    | codec | length | payload
++----------------+-------+--------+------------
+
+where the payload is either the blob itself, or the blob encoded by
+inbox.security.blobstorage.encode_blob() (compressed, and encrypted if
+ENCRYPT_SECRETS is set). Blobs are compressed when they're small enough and
+compress well, and always encoded when encryption is on.
+
+Each segment has an index file, `<name>.idx`, listing where its blobs are.
+Index entries are only appended once their record has been written, so
+readers never see partial records. Compaction merges the indexes of sealed
+segments (see below) into a single file, `<name>.midx`, sorted by hash, which
+processes map into memory and search. They only keep the entries of the
+other segments in memory, and read any new ones when they're asked for a
+blob they don't know about, or, when storing one, at most once every
+REFRESH_INTERVAL seconds. So that they only have to check the segments that
+are still being appended to, processes start a new segment rather than append
+to one they haven't used for IDLE_SEGMENT_AGE seconds.
+
+A process holds an exclusive lock on the segment it's appending to. Segments
+that aren't locked and haven't been appended to for a while are sealed, and
+can be compacted: compact() rewrites the blobs that are still referenced into
+a new segment and deletes the old one. Processes that try to read from a
+deleted segment reload the index.
+
+Blobs are only stored once, so a blob that was garbage when compaction
+started may be referenced again before it's done. To keep from deleting it,
+put() touches the segment of a blob it finds already stored, and checks that
+the segment's index is still there: compaction leaves segments alone that
+were touched in the last PACKED_BLOCKSTORE_COMPACTION_GRACE_PERIOD seconds,
+checks which blobs are referenced again once it's rewritten the live ones,
+and deletes a segment's index before checking whether it was touched in the
+meantime. It also touches the store's `compacted` file, so that callers that
+remember what they've stored know to forget it (see generation()).
+
+"""
+import errno
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import time
+import uuid
+from collections import namedtuple
+
+from gevent.coros import BoundedSemaphore
+
+from inbox.config import config
+from inbox.security.blobstorage import encode_blob, decode_blob
+from inbox.util.file import mkdirp, remove_file
+from nylas.logging import get_logger
+log = get_logger()
+
+SEGMENT_SIZE = config.get('PACKED_BLOCKSTORE_SEGMENT_SIZE', 256 << 20)
+# Larger blobs are stored uncompressed, so that they can be streamed.
+COMPRESS_MAX_SIZE = config.get('PACKED_BLOCKSTORE_COMPRESS_MAX_SIZE', 1 << 20)
+# Only keep the compressed version of a blob if it's this much smaller.
+MIN_COMPRESSION_RATIO = 0.9
+# Only compact segments that are at least this much garbage.
+MIN_GARBAGE = config.get('PACKED_BLOCKSTORE_MIN_GARBAGE', 0.25)
+IDLE_SEGMENT_AGE = 600
+# How often to read new index entries when storing blobs. Blobs that other
+# processes stored since may be stored twice, which only wastes space.
+REFRESH_INTERVAL = 1
+# Don't compact segments that blobs were stored in more recently than this.
+GRACE_PERIOD = config.get('PACKED_BLOCKSTORE_COMPACTION_GRACE_PERIOD', 3600)
+
+CODEC_RAW = 0
+CODEC_BLOB = 1
+
+RECORD_HEADER = struct.Struct('<32sBI')
+INDEX_ENTRY = struct.Struct('<32sQIB')
+# Merged indexes start with the number of segments they cover, and their
+# names, followed by their entries.
+MERGED_INDEX_HEADER = struct.Struct('<I')
+SEGMENT_NAME = struct.Struct('26s')
+MERGED_INDEX_ENTRY = struct.Struct('<32s26sQIB')
+
+# Where a blob is: `offset` and `length` are those of its payload.
+Location = namedtuple('Location', ['path', 'offset', 'length', 'codec'])
+
+_store = None
+
+
+def get_packed_store():
+    global _store
+    if _store is None:
+        directory = config.get('PACKED_BLOCKSTORE_DIRECTORY') or \
+            os.path.join(config.get_required('MSG_PARTS_DIRECTORY'), 'packed')
+        _store = PackedStore(directory, SEGMENT_SIZE)
+    return _store
+
+
+def encode(data):
+    """ Return the codec and payload to store data with. """
+    if config.get('ENCRYPT_SECRETS'):
+        return CODEC_BLOB, encode_blob(data)
+    if len(data) <= COMPRESS_MAX_SIZE:
+        encoded = encode_blob(data)
+        if len(encoded) < len(data) * MIN_COMPRESSION_RATIO:
+            return CODEC_BLOB, encoded
+    return CODEC_RAW, data
+
+
+def decode(codec, payload):
+    if codec == CODEC_RAW:
+        return payload
+    assert codec == CODEC_BLOB, 'Unknown codec {}'.format(codec)
+    return decode_blob(payload)
+
+
+class PackedStore(object):
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        mkdirp(directory)
+        # The latest merged index, if any.
+        self._merged = None
+        # sha256 digest -> (segment name, offset, length, codec), for the
+        # segments that the merged index doesn't cover.
+        self._index = {}
+        # segment name -> how much of its index file we've read
+        self._index_read = {}
+        # The segments that nobody will append to again, and that the merged
+        # index doesn't cover.
+        self._sealed = set()
+        self._refreshed_at = 0
+        self._segment = None
+        self._lock = BoundedSemaphore(1)
+
+    def __contains__(self, data_sha256):
+        return self._lookup(data_sha256, wait=True) is not None
+
+    def put(self, data_sha256, data):
+        entry = self._lookup(data_sha256, wait=True)
+        if entry is not None and self._touch(entry[0]):
+            return
+        codec, payload = encode(data)
+        self._append(data_sha256.decode('hex'), codec, payload)
+
+    def get(self, data_sha256):
+        """ Return the data with the given hash, or None. """
+        location = self.locate(data_sha256)
+        if location is None:
+            return None
+        try:
+            payload = self.read(location)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # The segment has been compacted.
+            self._refresh(reload=True)
+            location = self.locate(data_sha256)
+            if location is None:
+                return None
+            payload = self.read(location)
+        return decode(location.codec, payload)
+
+    def locate(self, data_sha256):
+        """ Return the Location of the blob with the given hash, or None. """
+        entry = self._lookup(data_sha256)
+        if entry is None:
+            return None
+        name, offset, length, codec = entry
+        return Location(self._path(name, '.seg'), offset, length, codec)
+
+    def read(self, location):
+        with open(location.path, 'rb') as f:
+            f.seek(location.offset)
+            return f.read(location.length)
+
+    def generation(self):
+        """
+        Return a value that changes whenever a compaction starts or finishes,
+        and so blobs may have been deleted.
+
+        """
+        try:
+            return os.stat(self._path('compacted', '')).st_mtime
+        except OSError:
+            return None
+
+    def compact(self, referenced, min_garbage=MIN_GARBAGE):
+        """
+        Rewrite sealed segments that are at least `min_garbage` garbage: the
+        records of blobs that are no longer referenced, stored again in a
+        later segment, or never indexed.
+
+        `referenced` is called with a list of the hashes of a segment's blobs
+        and returns the set of those that are still referenced.
+
+        Returns the number of bytes reclaimed.
+
+        """
+        self._seal()
+        self._refresh(reload=True)
+        self._mark_compacted()
+        reclaimed = 0
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.seg'):
+                continue
+            name = filename[:-len('.seg')]
+            try:
+                f = open(self._path(name, '.seg'), 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # Another process is appending to it, or compacting it.
+                    continue
+                if not os.path.exists(self._path(name, '.idx')):
+                    # Left over from a compaction that didn't finish.
+                    reclaimed += os.fstat(f.fileno()).st_size
+                    remove_file(f.name)
+                    continue
+                if name not in self._sealed and (
+                        self._merged is None or
+                        name not in self._merged.segments):
+                    # It's new, or may still be appended to.
+                    continue
+                reclaimed += self._compact_segment(f, name, referenced,
+                                                   min_garbage)
+        self._seal()
+        self._merge_index()
+        self._mark_compacted()
+        return reclaimed
+
+    def _compact_segment(self, f, name, referenced, min_garbage):
+        path = self._path(name, '.seg')
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        if time.time() - stat.st_mtime < GRACE_PERIOD:
+            # Blobs in it may be about to be referenced again.
+            return 0
+        current = {}
+        for digest, offset, length, codec in self._read_index(name):
+            entry = self._find(digest)
+            if entry is not None and entry[0] == name:
+                current[digest.encode('hex')] = entry
+        live = referenced(current.keys()) if current else set()
+        live_size = sum(RECORD_HEADER.size + current[h][2] for h in live)
+        if size and float(size - live_size) / size < min_garbage:
+            return 0
+
+        log.info('Compacting blockstore segment', segment=name, size=size,
+                 live_size=live_size)
+        self._copy_records(f, current, live)
+        # Blocks may have been committed since we looked.
+        dead = [h for h in current if h not in live]
+        live = live | self._copy_records(f, current,
+                                         referenced(dead) if dead else ())
+        # The blobs we kept are indexed in their new segment, so the old one
+        # can go. Delete its index first, so that nobody reads it again, and
+        # then keep all of its blobs if put() found one of them in it since
+        # we started.
+        remove_file(self._path(name, '.idx'))
+        if os.fstat(f.fileno()).st_mtime != stat.st_mtime:
+            log.info('Blockstore segment was used while compacting it',
+                     segment=name)
+            live = live | self._copy_records(
+                f, current, [h for h in current if h not in live])
+        remove_file(path)
+        self._index_read.pop(name, None)
+        self._sealed.discard(name)
+        for data_sha256 in current:
+            if data_sha256 not in live:
+                # Entries in the merged index go when it's next merged.
+                self._index.pop(data_sha256.decode('hex'), None)
+        return size - sum(RECORD_HEADER.size + current[h][2] for h in live)
+
+    def _copy_records(self, f, current, hashes):
+        """ Append the records of `hashes` to our segment, and return them.
+        """
+        hashes = set(hashes)
+        for data_sha256 in hashes:
+            _, offset, length, codec = current[data_sha256]
+            f.seek(offset)
+            self._append(data_sha256.decode('hex'), codec, f.read(length))
+        return hashes
+
+    def _merge_index(self):
+        """
+        Merge the indexes of the sealed segments into a new merged index, and
+        delete the old one.
+
+        """
+        self._refresh()
+        names = set(filename[:-len('.idx')]
+                    for filename in os.listdir(self.directory)
+                    if filename.endswith('.idx'))
+        old = self._merged
+        merged = set(old.segments) & names if old is not None else set()
+        new = self._sealed & names
+        if not new and (old is None or merged == old.segments):
+            return
+        segments = sorted(merged | new)
+        # Only the entries of the segments that are new to the merged index
+        # are held in memory.
+        entries = sorted((digest, name, offset, length, codec)
+                         for name in new
+                         for digest, offset, length, codec in
+                         self._read_index(name))
+        if old is not None:
+            entries = heapq.merge((entry for entry in old
+                                   if entry[1] in merged), entries)
+
+        tmp_path = self._path('merging', '.tmp')
+        with open(tmp_path, 'ab') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process is merging.
+                return
+            f.truncate(0)
+            f.write(MERGED_INDEX_HEADER.pack(len(segments)))
+            for name in segments:
+                f.write(SEGMENT_NAME.pack(name))
+            count = 0
+            last = None
+            for entry in entries:
+                # Blobs stored again are indexed in the later segment.
+                if last is not None and entry[0] != last[0]:
+                    f.write(MERGED_INDEX_ENTRY.pack(*last))
+                    count += 1
+                last = entry
+            if last is not None:
+                f.write(MERGED_INDEX_ENTRY.pack(*last))
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+            name = _segment_name()
+            os.rename(tmp_path, self._path(name, '.midx'))
+        log.info('Merged blockstore index', segments=len(segments),
+                 entries=count)
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.midx') and filename != name + '.midx':
+                remove_file(self._path(filename[:-len('.midx')], '.midx'))
+        self._refresh()
+
+    def _mark_compacted(self):
+        with open(self._path('compacted', ''), 'a'):
+            pass
+        os.utime(self._path('compacted', ''), None)
+
+    def _touch(self, name):
+        """
+        Keep the segment from being compacted for now, and return whether it
+        still exists.
+
+        """
+        try:
+            os.utime(self._path(name, '.seg'), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        # If it's being compacted, either the compaction will see that we
+        # touched it, or it's deleted the index already.
+        return os.path.exists(self._path(name, '.idx'))
+
+    def _append(self, digest, codec, payload):
+        with self._lock:
+            if self._segment is not None and (
+                    self._segment.size + len(payload) > self.segment_size or
+                    time.time() - self._segment.appended_at >
+                    IDLE_SEGMENT_AGE):
+                self._seal()
+            if self._segment is None:
+                self._segment = _Segment(self.directory)
+                self._index_read[self._segment.name] = 0
+            segment = self._segment
+            offset = segment.append(digest, codec, payload)
+            self._index[digest] = (segment.name, offset, len(payload), codec)
+            # We've indexed our own entry already.
+            self._index_read[segment.name] += INDEX_ENTRY.size
+
+    def _seal(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _lookup(self, data_sha256, wait=False):
+        """
+        Return the index entry for the given hash, or None. If we don't know
+        about it, read new index entries first, unless `wait` and we did
+        that less than REFRESH_INTERVAL seconds ago.
+
+        """
+        digest = data_sha256.decode('hex')
+        entry = self._find(digest)
+        if entry is None and (not wait or time.time() - self._refreshed_at >=
+                              REFRESH_INTERVAL):
+            # Another process may have stored it since we last looked.
+            self._refresh()
+            entry = self._find(digest)
+        return entry
+
+    def _find(self, digest):
+        entry = self._index.get(digest)
+        if entry is None and self._merged is not None:
+            entry = self._merged.find(digest)
+        return entry
+
+    def _refresh(self, reload=False):
+        """ Read new index entries, or the whole index if `reload`. """
+        if reload:
+            self._use_merged_index(None)
+        self._refreshed_at = time.time()
+        filenames = os.listdir(self.directory)
+        merged_names = sorted(filename[:-len('.midx')]
+                              for filename in filenames
+                              if filename.endswith('.midx'))
+        if merged_names and (self._merged is None or
+                             merged_names[-1] != self._merged.name):
+            try:
+                self._use_merged_index(_MergedIndex(
+                    merged_names[-1], self._path(merged_names[-1], '.midx')))
+            except (IOError, OSError) as e:
+                # It's been replaced already.
+                if e.errno != errno.ENOENT:
+                    raise
+        covered = self._merged.segments if self._merged is not None else ()
+        # Segments are named in the order they were started, so blobs stored
+        # again in later segments are indexed in those.
+        names = sorted(filename[:-len('.idx')] for filename in filenames
+                       if filename.endswith('.idx') and
+                       filename[:-len('.idx')] not in covered)
+        now = time.time()
+        for name in names:
+            if name in self._sealed or (self._segment is not None and
+                                        name == self._segment.name and
+                                        not reload):
+                continue
+            try:
+                stat = os.stat(self._path(name, '.idx'))
+            except OSError:
+                continue
+            read = self._index_read.get(name, 0)
+            if stat.st_size - read >= INDEX_ENTRY.size:
+                for digest, offset, length, codec in \
+                        self._read_index(name, read):
+                    self._index[digest] = (name, offset, length, codec)
+                    read += INDEX_ENTRY.size
+            self._index_read[name] = read
+            # Leave plenty of leeway for processes that are about to append.
+            if now - stat.st_mtime > 2 * IDLE_SEGMENT_AGE:
+                self._sealed.add(name)
+
+    def _use_merged_index(self, merged):
+        # Only keep the entries of the segments it doesn't cover.
+        if self._merged is not None:
+            self._merged.close()
+        self._merged = merged
+        if merged is None:
+            self._index = {}
+            self._index_read = {}
+            self._sealed = set()
+            return
+        self._index = {digest: entry
+                       for digest, entry in self._index.iteritems()
+                       if entry[0] not in merged.segments}
+        self._index_read = {name: read
+                            for name, read in self._index_read.iteritems()
+                            if name not in merged.segments}
+        self._sealed -= merged.segments
+
+    def _read_index(self, name, start=0):
+        try:
+            with open(self._path(name, '.idx'), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        # Ignore a partly written last entry.
+        for offset in xrange(0, len(data) - INDEX_ENTRY.size + 1,
+                             INDEX_ENTRY.size):
+            yield INDEX_ENTRY.unpack_from(data, offset)
+
+    def _path(self, name, extension):
+        return os.path.join(self.directory, name + extension)
+
+
+class _Segment(object):
+    """ The segment this process is appending to. """
+
+    def __init__(self, directory):
+        self.name = _segment_name()
+        # Create the index first: segments without one are left over from
+        # compactions.
+        self.index_file = open(os.path.join(directory, self.name + '.idx'),
+                               'ab')
+        self.file = open(os.path.join(directory, self.name + '.seg'), 'ab')
+        # Keep the segment from being compacted while we're appending to it.
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.size = 0
+        self.appended_at = time.time()
+
+    def append(self, digest, codec, payload):
+        """ Append a record, and return the offset of its payload. """
+        self.file.write(RECORD_HEADER.pack(digest, codec, len(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        offset = self.size + RECORD_HEADER.size
+        self.size = offset + len(payload)
+        self.index_file.write(INDEX_ENTRY.pack(digest, offset, len(payload),
+                                               codec))
+        self.index_file.flush()
+        self.appended_at = time.time()
+        return offset
+
+    def close(self):
+        self.index_file.close()
+        self.file.close()
+
+
+class _MergedIndex(object):
+    """ A merged index, mapped into memory. """
+
+    def __init__(self, name, path):
+        self.name = name
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        num_segments, = MERGED_INDEX_HEADER.unpack_from(self._map)
+        self._start = MERGED_INDEX_HEADER.size
+        self.segments = set()
+        for _ in xrange(num_segments):
+            name, = SEGMENT_NAME.unpack_from(self._map, self._start)
+            self.segments.add(name)
+            self._start += SEGMENT_NAME.size
+        self._count = (len(self._map) - self._start) // \
+            MERGED_INDEX_ENTRY.size
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield MERGED_INDEX_ENTRY.unpack_from(
+                self._map, self._start + i * MERGED_INDEX_ENTRY.size)
+
+    def find(self, digest):
+        """ Return the (name, offset, length, codec) of a blob, or None. """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            position = self._start + mid * MERGED_INDEX_ENTRY.size
+            key = self._map[position:position + len(digest)]
+            if key < digest:
+                lo = mid + 1
+            elif key > digest:
+                hi = mid
+            else:
+                return MERGED_INDEX_ENTRY.unpack_from(self._map,
+                                                      position)[1:]
+        return None
+
+    def close(self):
+        self._map.close()
+
+
+def _segment_name():
+    # Names sort in the order they were made.
+    return '{:013d}-{}'.format(int(time.time() * 1000), uuid.uuid4().hex[:12])
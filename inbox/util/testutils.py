@@ -115,12 +115,21 @@ def dump_dns_queries(monkeypatch):
     print json.dumps(query_results, indent=4, sort_keys=True)
 
 
+class MockIMAP4(object):
+    """Stands in for the imaplib connection that IMAPClient wraps."""
+
+    def __init__(self):
+        self.untagged_responses = {}
+
+
 class MockIMAPClient(object):
     """A bare-bones stand-in for an IMAPClient instance, used to test sync
     logic without requiring a real IMAP account and server."""
 
     def __init__(self):
+        self._imap = MockIMAP4()
         self._data = {}
+        self._expunged = {}
         self.selected_folder = None
         self.uidvalidity = 1
         self.logins = {}
@@ -178,7 +187,9 @@ class MockIMAPClient(object):
 
     def select_folder(self, folder_name, readonly=False):
         self.selected_folder = folder_name
-        return self.folder_status(folder_name)
+        resp = self.folder_status(folder_name)
+        resp['EXISTS'] = len(self._data[folder_name])
+        return resp
 
     def fetch(self, items, data, modifiers=None):
         assert self.selected_folder is not None
@@ -198,6 +209,13 @@ class MockIMAPClient(object):
                     modseq = int(m.group('modseq'))
                     items = {u for u in items
                              if uid_dict[u]['MODSEQ'][0] > modseq}
+                expunged = self._expunged.get(self.selected_folder)
+                if 'VANISHED' in modifiers[0] and expunged:
+                    # Report every expunged UID, whatever the modseq, as
+                    # servers that don't keep track of them may.
+                    self._imap.untagged_responses.setdefault(
+                        'VANISHED', []).append('(EARLIER) {}'.format(
+                            ','.join(str(u) for u in sorted(expunged))))
         for u in items:
             if u in uid_dict:
                 resp[u] = {k: v for k, v in uid_dict[u].items() if k in data or
@@ -230,6 +248,9 @@ class MockIMAPClient(object):
     def capabilities(self):
         return []
 
+    def enable(self, *capabilities):
+        return [c for c in capabilities if c in self.capabilities()]
+
     def folder_status(self, folder_name, data=None):
         folder_data = self._data[folder_name]
         lastuid = max(folder_data) if folder_data else 0
@@ -245,6 +266,7 @@ class MockIMAPClient(object):
     def delete_messages(self, uids, silent=False):
         for u in uids:
             del self._data[self.selected_folder][u]
+            self._expunged.setdefault(self.selected_folder, set()).add(u)
 
     def remove_flags(self, uids, flags):
         pass
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from inbox.config import config
 from inbox.models.thread import Thread
 from sqlalchemy import desc
 from sqlalchemy.orm import joinedload, load_only
 from inbox.util.misc import cleanup_subject
+from inbox.util.stats import statsd_client
 
 
 MAX_THREAD_LENGTH = 500
 
+# Bounds on the size of each namespace's ThreadingIndex.
+THREADING_INDEX_MAX_SUBJECTS = config.get('THREADING_INDEX_MAX_SUBJECTS', 500)
+THREADING_INDEX_MAX_THREADS = config.get('THREADING_INDEX_MAX_THREADS', 20)
+
+# namespace_id -> ThreadingIndex, for the accounts this process syncs. Each
+# is dropped when its account's sync stops (see drop_threading_index()).
+_threading_indexes = {}
+
 
 def fetch_corresponding_thread(db_session, namespace_id, message):
     """fetch a thread matching the corresponding message. Returns None if
@@ -15,6 +27,144 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
     # to a message always has a similar subject. This is only
     # right 95% of the time.
     clean_subject = cleanup_subject(message.subject)
+    threads = _threads_with_subject(db_session, namespace_id, clean_subject)
+    return _match_thread(message, (
+        (thread, len(thread.messages),
+         [_participant_summary(match) for match in thread.messages])
+        for thread in threads))
+
+
+def threading_index(namespace_id):
+    """Return the ThreadingIndex for the given namespace."""
+    index = _threading_indexes.get(namespace_id)
+    if index is None:
+        index = _threading_indexes[namespace_id] = ThreadingIndex(namespace_id)
+    return index
+
+
+def drop_threading_index(namespace_id):
+    """Forget the ThreadingIndex for the given namespace, if any."""
+    _threading_indexes.pop(namespace_id, None)
+
+
+class ThreadingIndex(object):
+    """
+    An in-memory index of a namespace's threads by cleaned subject, so that
+    threading a new message doesn't mean loading the participants of every
+    message of every thread with the same subject -- which can be thousands
+    of threads for subjects like "Re: Invoice", or no subject at all.
+
+    For each of the `max_subjects` most recently used subjects, the index
+    holds the ids, message counts and participants of the `max_threads`
+    most recent threads with that subject. A subject is loaded from the
+    database the first time it's needed, and kept up to date by add() as
+    new messages are threaded.
+
+    """
+
+    def __init__(self, namespace_id,
+                 max_subjects=THREADING_INDEX_MAX_SUBJECTS,
+                 max_threads=THREADING_INDEX_MAX_THREADS):
+        self.namespace_id = namespace_id
+        self.max_subjects = max_subjects
+        self.max_threads = max_threads
+        # subject key -> list of _IndexedThreads, most recent first.
+        self._subjects = OrderedDict()
+
+    def fetch_corresponding_thread(self, db_session, message):
+        """
+        Like fetch_corresponding_thread(), but matches the message against
+        the index. Only the matching thread (if any) is loaded from the
+        database.
+
+        """
+        clean_subject = cleanup_subject(message.subject)
+        key = _subject_key(clean_subject)
+        threads = self._subjects.pop(key, None)
+        if threads is None:
+            statsd_client.incr('mailsync.threading_index.miss')
+            threads = self._load(db_session, clean_subject)
+        else:
+            statsd_client.incr('mailsync.threading_index.hit')
+        self._put(key, threads)
+
+        thread_id = _match_thread(message, (
+            (t.thread_id, t.message_count, t.summaries) for t in threads))
+        if thread_id is None:
+            return None
+        thread = db_session.query(Thread).get(thread_id)
+        if (thread is None or thread.namespace_id != self.namespace_id or
+                _subject_key(thread._cleaned_subject or '') != key):
+            # The thread was deleted, or the transaction that created it was
+            # rolled back, after we indexed it. Start over from the database.
+            statsd_client.incr('mailsync.threading_index.stale')
+            del self._subjects[key]
+            return fetch_corresponding_thread(db_session, self.namespace_id,
+                                              message)
+        return thread
+
+    def add(self, message):
+        """
+        Record that `message` was added to its thread. The message must have
+        been flushed, so that its thread has an id.
+
+        """
+        threads = self._subjects.get(
+            _subject_key(cleanup_subject(message.subject)))
+        if threads is None:
+            # We'll load the subject, including this message, when it's
+            # needed.
+            return
+        for indexed_thread in threads:
+            if indexed_thread.thread_id == message.thread_id:
+                indexed_thread.add(message)
+                return
+        indexed_thread = _IndexedThread(message.thread_id)
+        indexed_thread.add(message)
+        threads.insert(0, indexed_thread)
+        del threads[self.max_threads:]
+
+    def _load(self, db_session, clean_subject):
+        threads = []
+        for thread in _threads_with_subject(db_session, self.namespace_id,
+                                            clean_subject,
+                                            limit=self.max_threads):
+            indexed_thread = _IndexedThread(thread.id)
+            for match in thread.messages:
+                indexed_thread.add(match)
+            threads.append(indexed_thread)
+        return threads
+
+    def _put(self, clean_subject, threads):
+        self._subjects[clean_subject] = threads
+        while len(self._subjects) > self.max_subjects:
+            self._subjects.popitem(last=False)
+
+
+class _IndexedThread(object):
+    __slots__ = ('thread_id', 'message_count', 'summaries')
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.message_count = 0
+        # The distinct participant summaries of the thread's messages, in
+        # order. Most threads are between the same few people, so this is
+        # usually much shorter than the thread.
+        self.summaries = []
+
+    def add(self, message):
+        self.message_count += 1
+        summary = _participant_summary(message)
+        if summary not in self.summaries:
+            self.summaries.append(summary)
+
+
+def _subject_key(clean_subject):
+    # The database compares subjects case-insensitively, so we do too.
+    return clean_subject.lower()
+
+
+def _threads_with_subject(db_session, namespace_id, clean_subject, limit=None):
     threads = db_session.query(Thread). \
         filter(Thread.namespace_id == namespace_id,
                Thread._cleaned_subject == clean_subject). \
@@ -22,47 +172,61 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
         options(load_only('id', 'discriminator'),
                 joinedload(Thread.messages).load_only(
                     'from_addr', 'to_addr', 'bcc_addr', 'cc_addr'))
+    if limit is not None:
+        threads = threads.limit(limit)
+    return threads
+
+
+def _participant_summary(message):
+    # Everything _match_thread() needs to know about a thread's message: its
+    # participants' email addresses and its senders' addresses.
+    # A lot of people BCC some address when sending mass
+    # emails so ignore BCC.
+    bcc = message.bcc_addr if message.bcc_addr else []
+    emails = frozenset([t[1].lower() for t in message.participants
+                        if t not in bcc])
+    return emails, [t[1] for t in message.from_addr]
+
 
-    for thread in threads:
-        for match in thread.messages:
-            # A lot of people BCC some address when sending mass
-            # emails so ignore BCC.
-            match_bcc = match.bcc_addr if match.bcc_addr else []
-            message_bcc = message.bcc_addr if message.bcc_addr else []
+def _match_thread(message, candidates):
+    """
+    Pick the thread that `message` belongs to from `candidates`, an iterable
+    of (thread, message count, participant summaries of its messages) tuples
+    in order of preference. Returns the chosen thread, or None.
 
-            match_emails = set([t[1].lower() for t in match.participants
-                                if t not in match_bcc])
-            message_emails = set([t[1].lower() for t in message.participants
-                                  if t not in message_bcc])
+    """
+    message_bcc = message.bcc_addr if message.bcc_addr else []
+    message_emails = set([t[1].lower() for t in message.participants
+                          if t not in message_bcc])
 
+    for thread, message_count, summaries in candidates:
+        for match_emails, match_from in summaries:
             # A conversation takes place between two or more persons.
             # Are there more than two participants in common in this
             # thread? If yes, it's probably a related thread.
             if len(match_emails & message_emails) >= 2:
                 # No need to loop through the rest of the messages
                 # in the thread
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
+                if message_count >= MAX_THREAD_LENGTH:
                     break
                 else:
-                    return match.thread
+                    return thread
 
             # handle the case where someone is self-sending an email.
             if not message.from_addr or not message.to_addr:
                 return
 
-            match_from = [t[1] for t in match.from_addr]
-            match_to = [t[1] for t in match.from_addr]
             message_from = [t[1] for t in message.from_addr]
             message_to = [t[1] for t in message.to_addr]
 
             if (len(message_to) == 1 and message_from == message_to and
-                    match_from == match_to and message_to == match_from):
+                    message_to == match_from):
                 # Check that we're not over max thread length in this case
                 # No need to loop through the rest of the messages
                 # in the thread.
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
+                if message_count >= MAX_THREAD_LENGTH:
                     break
                 else:
-                    return match.thread
+                    return thread
 
     return
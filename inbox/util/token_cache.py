@@ -0,0 +1,286 @@
+"""
+A cache of OAuth access tokens, shared between processes.
+
+Every process that syncs an account or serves it in the API needs its access
+tokens, and each used to get its own from the provider, so right after a
+deploy the same account's token was refreshed by every mailsync, syncback and
+API process on every host. That burns provider quota and slows down the
+first connection.
+
+Tokens are cached in memory in each process and, if
+TOKEN_CACHE_REDIS_HOSTNAME is set, in Redis, encrypted like other secrets
+(see inbox.security.oracles), until they expire. Only one caller refreshes a
+given token at a time, across all the processes sharing the store: the others
+wait for it and then use the token it stored. Tokens are refreshed up to
+TOKEN_CACHE_REFRESH_MARGIN seconds before they expire, and while one is being
+refreshed, callers in other processes and greenlets keep using it, so they
+don't have to wait.
+
+If Redis is unavailable, each process just refreshes tokens for itself.
+
+"""
+import json
+import time
+import uuid
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+import gevent
+from gevent.lock import BoundedSemaphore
+from nacl.exceptions import CryptoError
+from redis import RedisError, StrictRedis
+
+from inbox.config import config
+from inbox.security.oracles import (get_decryption_oracle,
+                                    get_encryption_oracle)
+from nylas.logging import get_logger
+log = get_logger()
+
+REFRESH_MARGIN = config.get('TOKEN_CACHE_REFRESH_MARGIN', 300)
+# How long a process may hold the lock for refreshing a token, in case it
+# dies while holding it, and how often the others check whether it's done.
+LOCK_TIMEOUT = 30
+LOCK_POLL_INTERVAL = 0.1
+
+SOCKET_CONNECT_TIMEOUT = 5
+SOCKET_TIMEOUT = 5
+
+# `value` is anything that can be serialized as JSON; `expiration` and
+# `refresh_at` are naive UTC datetimes.
+CachedToken = namedtuple('CachedToken', 'value expiration refresh_at')
+
+_cache = None
+
+
+def get_token_cache():
+    global _cache
+    if _cache is None:
+        store = None
+        redis_host = config.get('TOKEN_CACHE_REDIS_HOSTNAME')
+        if redis_host:
+            store = RedisTokenStore(StrictRedis(
+                host=redis_host,
+                port=config.get('TOKEN_CACHE_REDIS_PORT', 6379),
+                db=config.get('TOKEN_CACHE_REDIS_DB', 0),
+                socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                socket_timeout=SOCKET_TIMEOUT))
+        _cache = TokenCache(store)
+    return _cache
+
+
+def cached_token(value, expiration):
+    """
+    A CachedToken that expires at `expiration`, and is due to be refreshed
+    REFRESH_MARGIN seconds before that, or halfway through its lifetime if
+    that's sooner.
+
+    """
+    lifetime = max((expiration - datetime.utcnow()).total_seconds(), 0)
+    margin = timedelta(seconds=min(REFRESH_MARGIN, lifetime / 2))
+    return CachedToken(value, expiration, expiration - margin)
+
+
+class TokenCache(object):
+    """
+    Caches tokens in memory and, if `store` is given, in a store shared with
+    other processes. A store implements get(key), put(key, token) and
+    delete(key) for CachedTokens, and acquire_lock(key), which returns a lock
+    id, or None if another process holds the lock, and
+    release_lock(key, lock_id). See RedisTokenStore.
+
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._tokens = {}
+        self._locks = defaultdict(BoundedSemaphore)
+
+    def get(self, key, new_token, force_refresh=False):
+        """
+        Return the CachedToken for `key`, refreshing it with `new_token()`,
+        which returns a (value, expiration) pair, if there's none that's
+        usable or it's due to be refreshed. Callers pass `force_refresh` when
+        the token they got last turned out to be invalid.
+
+        """
+        token = self._tokens.get(key)
+        rejected = token if force_refresh else None
+        if force_refresh:
+            token = None
+        elif token is not None and not _refresh_due(token):
+            return token
+
+        lock = self._locks[key]
+        if token is not None and _usable(token) and lock.locked():
+            # Another greenlet is refreshing it.
+            return token
+        with lock:
+            latest = self._tokens.get(key)
+            if _current(latest, rejected) and not _refresh_due(latest):
+                return latest
+            token = self._refresh(key, new_token, token, rejected)
+            self._tokens[key] = token
+            return token
+
+    def peek(self, key):
+        """ Return the usable CachedToken for `key`, if any, or None. """
+        token = self._tokens.get(key)
+        if (token is None or not _usable(token)) and self.store is not None:
+            token = self.store.get(key)
+            if token is not None:
+                self._tokens[key] = token
+        return token if token is not None and _usable(token) else None
+
+    def put(self, key, value, expiration):
+        token = cached_token(value, expiration)
+        self._tokens[key] = token
+        if self.store is not None:
+            self.store.put(key, token)
+
+    def delete(self, key):
+        self._tokens.pop(key, None)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def _refresh(self, key, new_token, token, rejected):
+        if self.store is None:
+            return cached_token(*new_token())
+
+        shared_token = self.store.get(key)
+        if _current(shared_token, rejected):
+            if not _refresh_due(shared_token):
+                return shared_token
+            if token is None:
+                token = shared_token
+
+        deadline = time.time() + LOCK_TIMEOUT
+        lock_id = self.store.acquire_lock(key)
+        while lock_id is None:
+            # Another process is refreshing it.
+            if token is not None and _usable(token):
+                return token
+            if time.time() > deadline:
+                log.warning('Timed out waiting for token refresh', key=key)
+                token = cached_token(*new_token())
+                self.store.put(key, token)
+                return token
+            gevent.sleep(LOCK_POLL_INTERVAL)
+            shared_token = self.store.get(key)
+            if _current(shared_token, rejected) and \
+                    not _refresh_due(shared_token):
+                return shared_token
+            lock_id = self.store.acquire_lock(key)
+
+        try:
+            # It may have been refreshed before we got the lock.
+            shared_token = self.store.get(key)
+            if _current(shared_token, rejected) and \
+                    not _refresh_due(shared_token):
+                return shared_token
+            token = cached_token(*new_token())
+            self.store.put(key, token)
+            return token
+        finally:
+            self.store.release_lock(key, lock_id)
+
+
+class RedisTokenStore(object):
+    """ Stores encrypted tokens in Redis until they expire. """
+
+    # Only delete the lock if we still hold it.
+    RELEASE_LOCK = '''
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    else
+        return 0
+    end
+    '''
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._release_lock = redis.register_script(self.RELEASE_LOCK)
+
+    def get(self, key):
+        try:
+            data = self.redis.get(_token_key(key))
+        except RedisError:
+            log.warning('Error reading cached token', key=key, exc_info=True)
+            return None
+        if data is None:
+            return None
+        try:
+            scheme, _, ciphertext = data.partition(':')
+            with get_decryption_oracle('SECRET_ENCRYPTION_KEY') as d_oracle:
+                fields = json.loads(d_oracle.decrypt(ciphertext, int(scheme)))
+        except (ValueError, CryptoError):
+            # E.g. encrypted with a key that's since been rotated.
+            log.warning('Discarding unreadable cached token', key=key,
+                        exc_info=True)
+            return None
+        return CachedToken(fields['value'],
+                           datetime.utcfromtimestamp(fields['expiration']),
+                           datetime.utcfromtimestamp(fields['refresh_at']))
+
+    def put(self, key, token):
+        ttl = int((token.expiration - datetime.utcnow()).total_seconds())
+        if ttl <= 0:
+            return
+        plaintext = json.dumps({'value': token.value,
+                                'expiration': _timestamp(token.expiration),
+                                'refresh_at': _timestamp(token.refresh_at)})
+        with get_encryption_oracle('SECRET_ENCRYPTION_KEY') as e_oracle:
+            ciphertext, scheme = e_oracle.encrypt(plaintext)
+        try:
+            self.redis.set(_token_key(key), '{}:{}'.format(scheme, ciphertext),
+                           ex=ttl)
+        except RedisError:
+            log.warning('Error caching token', key=key, exc_info=True)
+
+    def delete(self, key):
+        try:
+            self.redis.delete(_token_key(key))
+        except RedisError:
+            log.warning('Error deleting cached token', key=key, exc_info=True)
+
+    def acquire_lock(self, key):
+        lock_id = uuid.uuid4().hex
+        try:
+            acquired = self.redis.set(_lock_key(key), lock_id, nx=True,
+                                      px=LOCK_TIMEOUT * 1000)
+        except RedisError:
+            # Refresh the token without the lock, rather than not at all.
+            log.warning('Error locking cached token', key=key, exc_info=True)
+            return lock_id
+        return lock_id if acquired else None
+
+    def release_lock(self, key, lock_id):
+        try:
+            self._release_lock(keys=[_lock_key(key)], args=[lock_id])
+        except RedisError:
+            log.warning('Error unlocking cached token', key=key, exc_info=True)
+
+
+def _usable(token):
+    return datetime.utcnow() < token.expiration
+
+
+def _refresh_due(token):
+    return datetime.utcnow() >= token.refresh_at
+
+
+def _current(token, rejected):
+    # Whether `token` is usable, and isn't the one a caller found invalid.
+    return token is not None and _usable(token) and \
+        (rejected is None or token.value != rejected.value)
+
+
+def _timestamp(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def _token_key(key):
+    return 'token:{}'.format(key)
+
+
+def _lock_key(key):
+    return 'token_lock:{}'.format(key)
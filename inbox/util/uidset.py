@@ -0,0 +1,188 @@
+"""
+A compact set of IMAP UIDs.
+
+Syncing a folder means comparing all of its UIDs on the server with the ones
+we've saved. A Python set or list of longs costs upwards of 60 bytes per UID,
+which for a folder of a couple of million messages is hundreds of megabytes
+per folder sync engine. UIDs mostly come in long runs, though, so a UIDSet
+stores them as ranges, in a pair of arrays of unsigned integers, and
+computes differences and intersections range by range.
+
+"""
+from array import array
+from bisect import bisect_right
+from heapq import merge
+from itertools import islice, izip
+
+# UIDs are unsigned 32-bit integers (RFC 3501, section 2.3.1.1), but are
+# stored as BigIntegers, so allow for anything that fits in one.
+_TYPECODE = 'L'
+
+
+class UIDSet(object):
+    """
+    An immutable set of UIDs, which iterates over them in ascending order.
+
+    Can be built from any iterable of UIDs, but is quickest to build from
+    one that's already sorted, and UIDSet.from_sorted() builds one from an
+    iterator of sorted UIDs without reading them into a list.
+
+    """
+
+    def __init__(self, uids=()):
+        self._starts = array(_TYPECODE)
+        self._ends = array(_TYPECODE)
+        self._len = 0
+        if isinstance(uids, UIDSet):
+            self._starts.extend(uids._starts)
+            self._ends.extend(uids._ends)
+            self._len = uids._len
+            return
+        if not isinstance(uids, (list, tuple)) or not _ascending(uids):
+            uids = sorted(uids)
+        self._extend_sorted(uids)
+
+    @classmethod
+    def from_sorted(cls, uids):
+        """ Build a UIDSet from UIDs in ascending order. """
+        uid_set = cls()
+        uid_set._extend_sorted(uids)
+        return uid_set
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """ Build a UIDSet from (first, last) pairs, in ascending order. """
+        uid_set = cls()
+        for first, last in ranges:
+            uid_set._add_range(first, last)
+        return uid_set
+
+    def _extend_sorted(self, uids):
+        # The _add_range() loop, inlined, since this is the hot path.
+        starts, ends = self._starts, self._ends
+        first = last = None
+        for uid in uids:
+            if last is not None and uid <= last + 1:
+                if uid > last:
+                    last = uid
+                continue
+            if last is not None:
+                starts.append(first)
+                ends.append(last)
+            first = last = uid
+        if last is not None:
+            starts.append(first)
+            ends.append(last)
+        self._len = sum(last - first + 1 for first, last in self.ranges())
+
+    def _add_range(self, first, last):
+        if self._ends and first <= self._ends[-1] + 1:
+            if last > self._ends[-1]:
+                self._len += last - self._ends[-1]
+                self._ends[-1] = last
+            return
+        self._starts.append(first)
+        self._ends.append(last)
+        self._len += last - first + 1
+
+    def ranges(self):
+        """ Iterate over the (first, last) pairs of the runs of consecutive
+        UIDs. """
+        return izip(self._starts, self._ends)
+
+    def min(self):
+        if not self._len:
+            raise ValueError('empty UIDSet')
+        return self._starts[0]
+
+    def max(self):
+        if not self._len:
+            raise ValueError('empty UIDSet')
+        return self._ends[-1]
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for first, last in self.ranges():
+            for uid in xrange(first, last + 1):
+                yield uid
+
+    def __reversed__(self):
+        for i in xrange(len(self._starts) - 1, -1, -1):
+            for uid in xrange(self._ends[i], self._starts[i] - 1, -1):
+                yield uid
+
+    def __contains__(self, uid):
+        i = bisect_right(self._starts, uid) - 1
+        return i >= 0 and uid <= self._ends[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, UIDSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __sub__(self, other):
+        return UIDSet.from_ranges(_difference(self, _uid_set(other)))
+
+    def __and__(self, other):
+        return UIDSet.from_ranges(_intersection(self, _uid_set(other)))
+
+    def __or__(self, other):
+        return UIDSet.from_ranges(merge(self.ranges(),
+                                        _uid_set(other).ranges()))
+
+    def __repr__(self):
+        return 'UIDSet({!r})'.format(','.join(
+            str(first) if first == last else '{}:{}'.format(first, last)
+            for first, last in self.ranges()))
+
+
+def _uid_set(uids):
+    return uids if isinstance(uids, UIDSet) else UIDSet(uids)
+
+
+def _ascending(uids):
+    return all(a <= b for a, b in izip(uids, islice(uids, 1, None)))
+
+
+def _difference(uids, other):
+    other_starts, other_ends = other._starts, other._ends
+    j = 0
+    for first, last in uids.ranges():
+        # Skip the other ranges that end before this one starts; they can't
+        # overlap the later ranges either.
+        while j < len(other_ends) and other_ends[j] < first:
+            j += 1
+        k = j
+        while k < len(other_starts) and other_starts[k] <= last:
+            if other_starts[k] > first:
+                yield first, other_starts[k] - 1
+            first = max(first, other_ends[k] + 1)
+            if first > last:
+                break
+            k += 1
+        if first <= last:
+            yield first, last
+
+
+def _intersection(uids, other):
+    starts, ends = uids._starts, uids._ends
+    other_starts, other_ends = other._starts, other._ends
+    i = j = 0
+    while i < len(starts) and j < len(other_starts):
+        first = max(starts[i], other_starts[j])
+        last = min(ends[i], other_ends[j])
+        if first <= last:
+            yield first, last
+        if ends[i] < other_ends[j]:
+            i += 1
+        else:
+            j += 1
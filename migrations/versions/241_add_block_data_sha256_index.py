@@ -0,0 +1,25 @@
+"""table block - add index on data_sha256 for blockstore compaction
+
+Revision ID: 7093a0e2892e
+Revises: 3999dc24642d
+Create Date: 2026-10-17 09:12:47.603914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7093a0e2892e'
+down_revision = '3999dc24642d'
+
+from alembic import op
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE block "
+                      " ADD INDEX ix_block_data_sha256(data_sha256(191))"))
+
+
+def downgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE block DROP INDEX ix_block_data_sha256"))
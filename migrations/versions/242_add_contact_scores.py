@@ -0,0 +1,54 @@
+"""add incrementally maintained contact scores to dataprocessingcache
+
+Revision ID: bb66a4e2e708
+Revises: 7093a0e2892e
+Create Date: 2026-10-17 13:40:21.118042
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'bb66a4e2e708'
+down_revision = '7093a0e2892e'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE dataprocessingcache "
+                      "ADD COLUMN contact_scores MEDIUMBLOB, "
+                      "ADD COLUMN contact_scores_last_updated DATETIME, "
+                      "ADD COLUMN contact_scores_backfilled TINYINT(1) "
+                      "NOT NULL DEFAULT 0"))
+
+    op.create_table('dataprocessingcursor',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('transaction_id', sa.BigInteger(),
+                              nullable=True),
+                    sa.ForeignKeyConstraint(['transaction_id'],
+                                            [u'transaction.id'], ),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_dataprocessingcursor_created_at',
+                    'dataprocessingcursor', ['created_at'], unique=False)
+    op.create_index('ix_dataprocessingcursor_deleted_at',
+                    'dataprocessingcursor', ['deleted_at'], unique=False)
+    op.create_index('ix_dataprocessingcursor_transaction_id',
+                    'dataprocessingcursor', ['transaction_id'], unique=False)
+    op.create_index('ix_dataprocessingcursor_updated_at',
+                    'dataprocessingcursor', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_table('dataprocessingcursor')
+
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE dataprocessingcache "
+                      "DROP COLUMN contact_scores, "
+                      "DROP COLUMN contact_scores_last_updated, "
+                      "DROP COLUMN contact_scores_backfilled"))
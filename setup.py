@@ -43,6 +43,8 @@ setup(
              'bin/contact-search-service',
              'bin/contact-search-backfill',
              'bin/contact-search-delete-index',
+             'bin/local-search-service',
+             'bin/contact-rankings-service',
              'bin/backfix-generic-imap-separators.py',
              'bin/backfix-duplicate-categories.py',
              'bin/correct-autoincrements',
@@ -58,6 +60,8 @@ setup(
              'bin/balance-fleet',
              'bin/get-account-loads',
              'bin/restart-forgotten-accounts',
+             'bin/pack-blockstore',
+             'bin/compact-blockstore',
              ],
 
     # See: